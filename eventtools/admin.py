@@ -11,15 +11,17 @@ from django.core.urlresolvers import reverse
 from django.db import models
 from django.http import QueryDict
 from django.shortcuts import get_object_or_404, redirect
-from django.forms.models import BaseInlineFormSet
+from django.forms.models import BaseInlineFormSet, BaseModelFormSet
 from mptt.forms import TreeNodeChoiceField
 from mptt.admin import MPTTModelAdmin
-from django.utils.translation import ugettext, ugettext_lazy as _
+from django.utils.translation import ugettext, ungettext, ugettext_lazy as _
 from django.template.defaultfilters import date, time
 
 from utils.diff import generate_diff
 
 from .models import Rule
+from .models.event import LISTED_SQL, _sql_names
+from .models.exclusion import EXCLUSION_BATCH_SIZE
 
 import django
 if django.VERSION[0] == 1 and django.VERSION[1] >= 4:
@@ -42,47 +44,147 @@ class TreeModelChoiceField(forms.ModelChoiceField):
 
 
 # ADMIN ACTIONS
+def _event_ids(queryset):
+    return set(queryset.order_by().values_list('event_id', flat=True).distinct())
+
+def _occurrences_changed(queryset, event_ids):
+    queryset.model.EventModel().occurrences_changed(event_ids)
+
+def _exclude_generated(queryset):
+    """
+    Adds exclusions for the generated occurrences in queryset, so that they
+    aren't generated again, skipping those that are already excluded. Returns
+    the number of exclusions added.
+    """
+    ExclusionModel = queryset.model.EventModel().ExclusionModel()
+    wanted = set(queryset.filter(generated_by__isnull=False).order_by()\
+        .values_list('event_id', 'start'))
+    if not wanted:
+        return 0
+    event_ids = set(event_id for event_id, start in wanted)
+    starts = [start for event_id, start in wanted]
+    wanted -= set(ExclusionModel._default_manager.filter(
+        event__in=event_ids,
+        start__gte=min(starts),
+        start__lte=max(starts),
+    ).values_list('event_id', 'start'))
+    exclusions = [ExclusionModel(event_id=event_id, start=start)
+        for event_id, start in sorted(wanted)]
+    for i in range(0, len(exclusions), EXCLUSION_BATCH_SIZE):
+        ExclusionModel._default_manager.bulk_create(
+            exclusions[i:i+EXCLUSION_BATCH_SIZE])
+    return len(exclusions)
+
 def _remove_occurrences(modeladmin, request, queryset):
-    for m in queryset:
-        # if the occurrence was generated, then add it as an exclusion.
-        if m.generated_by is not None:
-            m.event.exclusions.get_or_create(start=m.start)
-        m.delete()
+    event_ids = _event_ids(queryset)
+    # if the occurrences were generated, then add them as exclusions.
+    excluded = _exclude_generated(queryset)
+    # occurrences with tickets etc can't be deleted, so are made one-off.
+    deleted, unhooked = queryset.delete_or_unhook()
+    _occurrences_changed(queryset, event_ids)
+    modeladmin.message_user(request, ugettext("%(deleted)d occurrences deleted, "
+        "%(unhooked)d made one-off (they can't be deleted), and "
+        "%(excluded)d exclusions added.") % {
+        'deleted': deleted, 'unhooked': unhooked, 'excluded': excluded})
 _remove_occurrences.short_description = "Delete occurrences (and prevent recreation by a repeating occurrence)"
 
 def _wipe_occurrences(modeladmin, request, queryset):
+    event_ids = _event_ids(queryset)
     queryset.delete()
+    _occurrences_changed(queryset, event_ids)
 _wipe_occurrences.short_description = "Delete occurrences (but allow recreation by a repeating occurrence)"
 
 def _convert_to_oneoff(modeladmin, request, queryset):
-    for m in queryset:
-        # if the occurrence was generated, then add it as an exclusion.
-        if m.generated_by is not None:
-            m.event.exclusions.get_or_create(start=m.start)
-    queryset.update(generated_by=None)
+    # if the occurrences were generated, then add them as exclusions.
+    excluded = _exclude_generated(queryset)
+    converted = queryset.filter(generated_by__isnull=False)\
+        .update(generated_by=None)
+    _occurrences_changed(queryset, _event_ids(queryset))
+    modeladmin.message_user(request, ugettext("%(converted)d occurrences made "
+        "one-off, and %(excluded)d exclusions added.") % {
+        'converted': converted, 'excluded': excluded})
 _convert_to_oneoff.short_description = "Make occurrences one-off (and prevent recreation by a repeating occurrence)"
 
 def _cancel(modeladmin, request, queryset):
     queryset.update(status=settings.OCCURRENCE_STATUS_CANCELLED[0])
+    _occurrences_changed(queryset, _event_ids(queryset))
 _cancel.short_description = "Make occurrences cancelled"
 
 def _fully_booked(modeladmin, request, queryset):
     queryset.update(status=settings.OCCURRENCE_STATUS_FULLY_BOOKED[0])
+    _occurrences_changed(queryset, _event_ids(queryset))
 _fully_booked.short_description = "Make occurrences fully booked"
 
 def _clear_status(modeladmin, request, queryset):
     queryset.update(status="")
+    _occurrences_changed(queryset, _event_ids(queryset))
 _clear_status.short_description = "Clear booked/cancelled status"
 
+class EventTreeChoices(object):
+    """
+    The events that each of a page of occurrences can be assigned to (see
+    OccurrenceAdminForm), worked out from one fetch of the trees they're in,
+    rather than with queries for each occurrence.
+    """
+    def __init__(self, EventModel, occurrences):
+        events = [o.event for o in occurrences]
+        q = models.Q(tree_id__in=set(e.tree_id for e in events))
+        if [o for o in occurrences
+                if o.generated_by_id is None and o.event.parent_id is None]:
+            # root events are siblings of each other, which only one-off
+            # occurrences can be moved between
+            q |= models.Q(parent__isnull=True)
+        self.events = list(EventModel._event_manager.filter(q)) if events else []
+
+        # labels may show the parent, so give events their parents.
+        by_pk = dict((e.pk, e) for e in self.events)
+        cache_name = EventModel._meta.get_field('parent').get_cache_name()
+        for e in self.events:
+            if e.parent_id in by_pk:
+                setattr(e, cache_name, by_pk[e.parent_id])
+        self._labels = {}
+
+    def label(self, field, event):
+        try:
+            return self._labels[event.pk]
+        except KeyError:
+            label = self._labels[event.pk] = field.label_from_instance(event)
+            return label
+
+    def for_occurrence(self, occurrence):
+        """
+        The same events, in the same order, as the querysets in
+        OccurrenceAdminForm.
+        """
+        if occurrence.generated_by_id is not None:
+            root = occurrence.generated_by.event
+            return [e for e in self.events if e.tree_id == root.tree_id
+                and root.lft <= e.lft <= root.rght]
+        event = occurrence.event
+        return [e for e in self.events if e.parent_id == event.parent_id or (
+            e.tree_id == event.tree_id and (
+                (event.lft <= e.lft <= event.rght) or # self and descendants
+                (e.lft < event.lft and e.rght > event.rght) # ancestors
+            )
+        )]
+
 class OccurrenceAdminForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
+        event_choices = kwargs.pop('event_choices', None)
         super(OccurrenceAdminForm, self).__init__(*args, **kwargs)
         EventModel = self.instance.EventModel()
         self.fields['event'] = TreeModelChoiceField(EventModel.objects)
 
         event = self.instance.event
         if event:
-            if self.instance.generated_by:
+            if event_choices is not None:
+                field = self.fields['event']
+                events = event_choices.for_occurrence(self.instance)
+                field.queryset = EventModel.objects.filter(
+                    pk__in=[e.pk for e in events])
+                field.choices = [(u"", field.empty_label)] + [
+                    (e.pk, event_choices.label(field, e)) for e in events]
+            elif self.instance.generated_by:
                 #generated_by events are limited to children of the generator event
                 #(otherwise syncing breaks). TODO: make syncing look at ancestors as well?
                 self.fields['event'].queryset = self.instance.generated_by.event.get_descendants(include_self=True)
@@ -94,6 +196,19 @@ class OccurrenceAdminForm(forms.ModelForm):
 
 
 
+class OccurrenceChangelistFormSet(BaseModelFormSet):
+    """
+    Shares one EventTreeChoices between the forms of a changelist page.
+    """
+    def _construct_form(self, i, **kwargs):
+        if not hasattr(self, '_event_choices'):
+            self._event_choices = EventTreeChoices(
+                self.model.EventModel(), self.get_queryset())
+        kwargs['event_choices'] = self._event_choices
+        return super(OccurrenceChangelistFormSet, self)._construct_form(
+            i, **kwargs)
+
+
 def OccurrenceAdmin(OccurrenceModel):
     class _OccurrenceAdmin(admin.ModelAdmin):
         form = OccurrenceAdminForm
@@ -114,7 +229,7 @@ def OccurrenceAdmin(OccurrenceModel):
             self.list_display_links = (None,) #have to specify it here to avoid Django complaining
   
         def edit_link(self, occurrence):
-            if occurrence.generated_by is not None:
+            if occurrence.generated_by_id is not None:
                 change_url = reverse(
                     '%s:%s_%s_change' % (
                         self.admin_site.name,
@@ -144,6 +259,10 @@ def OccurrenceAdmin(OccurrenceModel):
             kwargs.setdefault('form', OccurrenceAdminForm)
             return super(_OccurrenceAdmin, self).get_changelist_form(request, **kwargs)
 
+        def get_changelist_formset(self, request, **kwargs):
+            kwargs.setdefault('formset', OccurrenceChangelistFormSet)
+            return super(_OccurrenceAdmin, self).get_changelist_formset(request, **kwargs)
+
         def event_edit_url(self, event):
             return reverse(
                 '%s:%s_%s_change' % (
@@ -154,7 +273,7 @@ def OccurrenceAdmin(OccurrenceModel):
             )
 
         def from_a_repeating_occurrence(self, occurrence):
-            return occurrence.generated_by is not None
+            return occurrence.generated_by_id is not None
         from_a_repeating_occurrence.boolean = True
   
         def get_urls(self):
@@ -207,10 +326,12 @@ def OccurrenceAdmin(OccurrenceModel):
      
         def queryset(self, request):
             if hasattr(request, '_event'):
-                return request._event.occurrences_in_listing()
+                qs = request._event.occurrences_in_listing()\
+                    .with_virtual(False)
             else:
                 qs = super(_OccurrenceAdmin, self).queryset(request)
-            return qs
+            # edit_link and the event choices use these
+            return qs.select_related('event', 'generated_by__event')
      
         def get_actions(self, request):
             # remove 'delete' action
@@ -226,6 +347,19 @@ def EventForm(EventModel):
 
         class Meta:
             model = EventModel
+
+        def __init__(self, *args, **kwargs):
+            super(_EventForm, self).__init__(*args, **kwargs)
+            # a new child starts with its parent's inherited values, unless
+            # they're given (eg by _create_variation).
+            parent_id = self.initial.get('parent')
+            if parent_id and self.instance.pk is None and not self.is_bound:
+                try:
+                    parent = EventModel._event_manager.get(pk=parent_id)
+                except (EventModel.DoesNotExist, ValueError):
+                    return
+                for name, value in EventModel.inherited_values(parent).items():
+                    self.initial.setdefault(name, value)
     return _EventForm
 
 def EventAdmin(EventModel, SuperModel=MPTTModelAdmin, show_exclusions=False, show_generator=True):
@@ -268,6 +402,16 @@ def EventAdmin(EventModel, SuperModel=MPTTModelAdmin, show_exclusions=False, sho
             super(_EventAdmin, self).__init__(*args, **kwargs)
             self.occurrence_model = EventModel.OccurrenceModel()
 
+        def queryset(self, request):
+            # the changelist's listed flags come with the events, and the
+            # occurrence counts are stored on them, so a page of events takes
+            # a constant number of queries.
+            qs = super(_EventAdmin, self).queryset(request)
+            if hasattr(qs, 'with_listed'):
+                return qs.with_listed()
+            return qs.extra(select={
+                '_is_listed': LISTED_SQL % _sql_names(EventModel)})
+
         def unicode_bold_if_listed(self, obj):
             if obj.is_listed():
                 result = "<span style='font-weight:bold;padding-left:%spx'>%s</span>"
@@ -290,11 +434,8 @@ def EventAdmin(EventModel, SuperModel=MPTTModelAdmin, show_exclusions=False, sho
                 )
 
         def occurrence_link(self, event):
-            try:
-                count = event.occurrences_in_listing().count()
-            except:
-                import pdb; pdb.set_trace()
-            direct_count = event.occurrences.count()
+            count = event.listing_occurrence_count
+            direct_count = event.direct_occurrence_count
 
             url = self.occurrence_edit_url(event)
 
@@ -350,6 +491,14 @@ def EventAdmin(EventModel, SuperModel=MPTTModelAdmin, show_exclusions=False, sho
                     EventModel._meta.module_name)
                 )+"?%s" % GET.urlencode())
 
+        def save_model(self, request, obj, form, change):
+            super(_EventAdmin, self).save_model(request, obj, form, change)
+            if getattr(obj, 'cascaded_count', 0):
+                self.message_user(request, ungettext(
+                    "The changes were also made to %(count)d variation.",
+                    "The changes were also made to %(count)d variations.",
+                    obj.cascaded_count) % {'count': obj.cascaded_count})
+
         def change_view(self, request, object_id, extra_context={}):
             obj = EventModel._event_manager.get(pk=object_id)
 
@@ -403,9 +552,28 @@ def OccurrenceInline(OccurrenceModel):
         readonly_fields = ('generated_by', )
     return _OccurrenceInline
 
+class ExclusionInlineFormSet(BaseInlineFormSet):
+    """
+    Adds new exclusions with one bulk_exclude(), rather than saving each.
+    """
+    def save_new_objects(self, commit=True):
+        if not commit:
+            return super(ExclusionInlineFormSet, self).save_new_objects(commit)
+        starts = []
+        for form in self.extra_forms:
+            if not form.has_changed():
+                continue
+            if self.can_delete and self._should_delete_form(form):
+                continue
+            starts.append(form.cleaned_data['start'])
+        self.new_objects = self.model._default_manager.bulk_exclude(
+            self.instance, starts)
+        return self.new_objects
+
 def ExclusionInline(ExclusionModel):
     class _ExclusionInline(admin.TabularInline):
         model = ExclusionModel
+        formset = ExclusionInlineFormSet
         extra = 0
         fields = ('start',)        
     return _ExclusionInline
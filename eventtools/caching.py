@@ -0,0 +1,123 @@
+"""
+A read-through cache for the occurrences that EventViews render.
+
+Cached values are keyed by a generation counter, as well as by whatever the
+view asks for (the date window, page etc). There's a counter per event, which
+is bumped whenever the event's occurrences (or those of its descendants), its
+generators or its exclusions change, and one per event model, which is bumped
+along with any of its events'. Bumping a counter doesn't delete anything, it
+just means the old keys aren't asked for again, and they expire in time.
+
+Listings, which could include any event's occurrences, are keyed by the
+model's counter; the pages of single events by the event's own counter.
+
+The backend is settings.OCCURRENCE_CACHE_BACKEND (a CACHES alias or a backend
+path), which is a local-memory cache by default. With more than one server
+process, use a shared backend (eg memcached), or changes made in one process
+won't be seen by the others until OCCURRENCE_CACHE_TIMEOUT.
+"""
+import time
+from hashlib import md5
+
+from django.core.cache import get_cache
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from eventtools.conf import settings
+
+# generation counters should outlive the values keyed by them.
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+LOCMEM_BACKEND = 'django.core.cache.backends.locmem.LocMemCache'
+
+
+def _model_label(model):
+    return "%s.%s" % (model._meta.app_label, model._meta.object_name.lower())
+
+def queryset_identity(qs):
+    """
+    A short string that identifies a queryset by its SQL.
+    """
+    try:
+        sql = qs.query.get_compiler(qs.db).as_sql()
+    except EmptyResultSet:
+        sql = None
+    # (virtual occurrences aren't in the SQL)
+    return md5(repr((sql, getattr(qs, '_with_virtual', False)))).hexdigest()
+
+
+class OccurrenceCache(object):
+
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            backend = settings.OCCURRENCE_CACHE_BACKEND
+            if backend is None:
+                self._cache = get_cache(LOCMEM_BACKEND,
+                    LOCATION='eventtools-occurrences')
+            else:
+                self._cache = get_cache(backend)
+        return self._cache
+
+    def is_enabled(self):
+        return settings.OCCURRENCE_CACHE_TIMEOUT > 0
+
+    def _generation_key(self, EventModel, event_id=None):
+        return "eventtools:generation:%s:%s" % (
+            _model_label(EventModel), event_id or "*")
+
+    def generation(self, EventModel, event_id=None):
+        """
+        Returns the current generation of an event, or of the whole model if
+        event_id is None.
+        """
+        key = self._generation_key(EventModel, event_id)
+        generation = self.cache.get(key)
+        if generation is None:
+            # Start from the time, rather than 0, so that values cached
+            # before the counter expired (or was evicted) aren't reused.
+            generation = int(time.time() * 1000000)
+            if not self.cache.add(key, generation, GENERATION_TIMEOUT):
+                generation = self.cache.get(key, generation)
+        return generation
+
+    def invalidate(self, EventModel, event_ids):
+        """
+        Bumps the generations of the given events, and of their model.
+        """
+        if not self.is_enabled():
+            return
+        event_ids = set(event_ids)
+        event_ids.discard(None)
+        if not event_ids:
+            return
+        for event_id in list(event_ids) + [None]:
+            key = self._generation_key(EventModel, event_id)
+            try:
+                self.cache.incr(key)
+            except ValueError: # not cached, so nothing keyed by it is used
+                pass
+
+    def get_or_set(self, name, parts, f, EventModel, event_id=None):
+        """
+        Returns the value cached for name and parts (a tuple of strings, dates
+        etc) at the current generation of the event (or of EventModel, if
+        event_id is None). If there isn't one, f() is called to get it.
+        """
+        if not self.is_enabled():
+            return f()
+        # Read the generation first: if it's bumped while we call f(), the
+        # value is cached under a key that's already out of date.
+        generation = self.generation(EventModel, event_id)
+        key = "eventtools:%s:%s" % (name, md5(repr(
+            (_model_label(EventModel), event_id, generation) + tuple(parts)
+        )).hexdigest())
+        value = self.cache.get(key)
+        if value is None:
+            value = f()
+            self.cache.set(key, value, settings.OCCURRENCE_CACHE_TIMEOUT)
+        return value
+
+occurrence_cache = OccurrenceCache()
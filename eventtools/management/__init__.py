@@ -0,0 +1,22 @@
+from django.core.management.base import CommandError
+from django.db.models import get_model, get_models
+
+
+def models_from_labels(labels, base):
+    """
+    Returns the subclasses of base given as 'app_label.Model' labels, or
+    every installed one if there aren't any labels.
+    """
+    if not labels:
+        return [model for model in get_models() if issubclass(model, base)]
+    models = []
+    for label in labels:
+        try:
+            app_label, model_name = label.split('.')
+        except ValueError:
+            raise CommandError("%r isn't an app_label.Model label" % label)
+        model = get_model(app_label, model_name)
+        if model is None or not issubclass(model, base):
+            raise CommandError("%s isn't a %s" % (label, base.__name__))
+        models.append(model)
+    return models
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from eventtools.management import models_from_labels
+from eventtools.models import EventModel
+
+
+class Command(BaseCommand):
+    help = "Recalculates the occurrence summaries (counts, first and last " \
+        "occurrence) of every event, or of the events of the given models."
+    args = "[app_label.Model ...]"
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for model in models_from_labels(labels, EventModel):
+            events = model._event_manager.all()
+            events.update_occurrence_summaries()
+            if verbosity:
+                self.stdout.write("Updated %s %s\n" % (
+                    events.count(), model._meta.verbose_name_plural))
@@ -0,0 +1,121 @@
+import threading
+import traceback
+from datetime import date
+from Queue import Queue, Empty
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+
+from eventtools.conf import settings
+
+from eventtools.management import models_from_labels
+from eventtools.models import GeneratorModel
+
+
+class Command(BaseCommand):
+    help = "Generates the occurrences of every endless generator (one with " \
+        "no repeat_until) up to today + DEFAULT_GENERATOR_LIMIT (or, if it's " \
+        "set, of every unfinished generator up to today + " \
+        "MATERIALISATION_WINDOW), starting from where each generator last " \
+        "got to. Give app_label.Model labels to roll only those models' " \
+        "generators. Safe to run nightly."
+    args = "[app_label.Model ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', dest='threads', default=1,
+            help="The number of chunks to process at once."),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+            default=100, help="The number of generators in a chunk."),
+    )
+
+    def handle(self, *labels, **options):
+        verbosity = int(options.get('verbosity', 1))
+        threads = max(1, options.get('threads') or 1)
+        chunk_size = max(1, options.get('chunk_size') or 100)
+
+        chunks = []
+        for model in models_from_labels(labels, GeneratorModel):
+            chunks.extend(self._chunks(model, chunk_size))
+
+        queue = Queue()
+        for chunk in chunks:
+            queue.put(chunk)
+        results = []
+        errors = []
+
+        def work():
+            while True:
+                try:
+                    model, pks = queue.get_nowait()
+                except Empty:
+                    return
+                self._roll_chunk(model, pks, results, errors)
+
+        if threads == 1:
+            work()
+        else:
+            def work_in_thread():
+                try:
+                    work()
+                finally:
+                    # each thread has its own connection
+                    connection.close()
+            workers = [threading.Thread(target=work_in_thread)
+                for i in range(threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        if verbosity:
+            self.stdout.write("Rolled forward %s generators, creating %s "
+                "occurrences\n" % (len(results), sum(results)))
+        if errors:
+            if verbosity > 1:
+                for pk, tb in errors:
+                    self.stderr.write("Generator %s:\n%s\n" % (pk, tb))
+            raise CommandError("%s generators failed: %s" % (
+                len(errors), ", ".join(str(pk) for pk, tb in errors)))
+
+    def _roll_chunk(self, model, pks, results, errors):
+        """
+        Rolls forward the generators in a chunk, adding the number of
+        occurrences each creates to results, and (pk, traceback)s to errors
+        for those that fail - all of the chunk's remaining generators, if
+        they can't be fetched.
+        """
+        done = set()
+        try:
+            for generator in model._default_manager.filter(pk__in=pks):
+                try:
+                    results.append(generator.roll_forward() or 0)
+                except Exception:
+                    errors.append((generator.pk, traceback.format_exc()))
+                done.add(generator.pk)
+        except Exception:
+            tb = traceback.format_exc()
+            errors.extend((pk, tb) for pk in pks if pk not in done)
+
+    def _chunks(self, model, chunk_size):
+        """
+        Yields (model, pks) chunks of the generators to roll. The generators
+        of an event tree are always in the same chunk, so no two threads touch
+        the same listing (and its summaries) at once.
+        """
+        to_roll = Q(repeat_until__isnull=True)
+        if settings.MATERIALISATION_WINDOW:
+            to_roll |= Q(repeat_until__gte=date.today())
+        pks = []
+        tree_id = None
+        for pk, tree in model._default_manager.filter(to_roll)\
+                .order_by('event__tree_id', 'pk')\
+                .values_list('pk', 'event__tree_id'):
+            if len(pks) >= chunk_size and tree != tree_id:
+                yield model, pks
+                pks = []
+            pks.append(pk)
+            tree_id = tree
+        if pks:
+            yield model, pks
@@ -0,0 +1,31 @@
+from eventtools.sync import coordinator
+
+
+class DeferredSyncMiddleware(object):
+    """
+    Defers generator syncs until the end of the request, so that each event
+    whose generators were touched is synced once (see eventtools.sync).
+
+    Put this before django.middleware.transaction.TransactionMiddleware in
+    MIDDLEWARE_CLASSES, so that the syncs run (or are queued) after the
+    request's transaction has been committed.
+    """
+
+    def process_request(self, request):
+        # if an earlier request on this thread skipped process_exception and
+        # process_response (eg another middleware handled its exception), its
+        # block is still open, and syncs would be deferred forever.
+        coordinator.reset()
+        coordinator.begin()
+        request._eventtools_sync_deferred = True
+
+    def process_exception(self, request, exception):
+        if getattr(request, '_eventtools_sync_deferred', False):
+            request._eventtools_sync_deferred = False
+            coordinator.discard()
+
+    def process_response(self, request, response):
+        if getattr(request, '_eventtools_sync_deferred', False):
+            request._eventtools_sync_deferred = False
+            coordinator.end()
+        return response
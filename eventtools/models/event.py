@@ -1,9 +1,12 @@
+import datetime
+from itertools import islice
 from operator import itemgetter
 
-from django.db import models
+from django.db import models, connection
 from django.db.models.base import ModelBase
 from django.db.models.fields import FieldDoesNotExist
 from django.db.models import Count
+from django.db.backends.util import typecast_timestamp
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.template.defaultfilters import urlencode, slugify
@@ -11,9 +14,241 @@ from django.template.defaultfilters import urlencode, slugify
 from mptt.models import MPTTModel, MPTTModelBase
 from mptt.managers import TreeManager
 
-from eventtools.utils.inheritingdefault import ModelInstanceAwareDefault #TODO: deprecate
 from eventtools.utils.pprint_timespan import pprint_datetime_span, pprint_date_span
 from eventtools.conf import settings
+from eventtools.caching import occurrence_cache
+from eventtools.sync import coordinator
+
+def _sql_names(EventModel):
+    """
+    Quoted table and column names, for the SQL fragments that query events
+    and their occurrences using the tree fields.
+    """
+    qn = connection.ops.quote_name
+    OccurrenceModel = EventModel.OccurrenceModel()
+    mptt_meta = EventModel._mptt_meta
+    def column(model, field_name):
+        return qn(model._meta.get_field(field_name).column)
+    return {
+        'event': qn(EventModel._meta.db_table),
+        'event_pk': qn(EventModel._meta.pk.column),
+        'tree_id': column(EventModel, mptt_meta.tree_id_attr),
+        'lft': column(EventModel, mptt_meta.left_attr),
+        'rght': column(EventModel, mptt_meta.right_attr),
+        'occurrence': qn(OccurrenceModel._meta.db_table),
+        'occurrence_pk': qn(OccurrenceModel._meta.pk.column),
+        'occurrence_event': column(OccurrenceModel, 'event'),
+        'occurrence_start': column(OccurrenceModel, 'start'),
+        'occurrence_end': column(OccurrenceModel, '_end'),
+        'occurrence_status': column(OccurrenceModel, 'status'),
+    }
+
+def _datetime(value):
+    # some backends (sqlite) return aggregates of datetimes as strings
+    if isinstance(value, basestring):
+        return typecast_timestamp(value)
+    return value
+
+# An event is listed if it has occurrences attached, and none of its ancestors
+# (the events in its tree that enclose its lft and rght) do.
+LISTED_SQL = """(
+    EXISTS (
+        SELECT 1 FROM %(occurrence)s direct_occurrence
+        WHERE direct_occurrence.%(occurrence_event)s = %(event)s.%(event_pk)s
+    ) AND NOT EXISTS (
+        SELECT 1 FROM %(event)s ancestor
+        INNER JOIN %(occurrence)s ancestor_occurrence
+            ON ancestor_occurrence.%(occurrence_event)s = ancestor.%(event_pk)s
+        WHERE ancestor.%(tree_id)s = %(event)s.%(tree_id)s
+            AND ancestor.%(lft)s < %(event)s.%(lft)s
+            AND ancestor.%(rght)s > %(event)s.%(rght)s
+    )
+)"""
+
+# An event is an ancestor of (or is) one of the events in a subquery if it
+# encloses that event's lft and rght.
+ANCESTOR_OF_SQL = """(
+    EXISTS (
+        SELECT 1 FROM %(event)s descendant
+        WHERE descendant.%(tree_id)s = %(event)s.%(tree_id)s
+            AND descendant.%(lft)s BETWEEN %(event)s.%(lft)s AND %(event)s.%(rght)s
+            AND descendant.%(event_pk)s IN (%(pk_subquery)s)
+    )
+)"""
+
+# The opening (or closing) occurrence of an event is the first (or last) of
+# the occurrences attached to it or its descendants. Ties are broken in tree
+# order, as the occurrence ordering ('start', 'event') does.
+END_OCCURRENCE_SQL = """(
+    SELECT end_occurrence.%(occurrence_pk)s
+    FROM %(occurrence)s end_occurrence
+    INNER JOIN %(event)s descendant
+        ON end_occurrence.%(occurrence_event)s = descendant.%(event_pk)s
+    WHERE descendant.%(tree_id)s = %(event)s.%(tree_id)s
+        AND descendant.%(lft)s BETWEEN %(event)s.%(lft)s AND %(event)s.%(rght)s
+    ORDER BY end_occurrence.%(occurrence_start)s %(direction)s,
+        descendant.%(lft)s %(direction)s
+    LIMIT 1
+)"""
+
+# events per chunk, when iterator() fetches their opening/closing occurrences
+# or status summaries.
+FETCH_CHUNK_SIZE = 100
+
+# Summarises the occurrences in the listing of each of a batch of events.
+LISTING_SUMMARY_SQL = """
+    SELECT %(event)s.%(event_pk)s,
+        COUNT(listed.%(occurrence_pk)s),
+        SUM(CASE WHEN listed.%(occurrence_status)s = ''
+            OR listed.%(occurrence_status)s IS NULL THEN 1 ELSE 0 END),
+        MIN(listed.%(occurrence_start)s),
+        MAX(listed.%(occurrence_start)s),
+        MAX(listed.%(occurrence_end)s)
+    FROM %(event)s
+    INNER JOIN %(event)s descendant
+        ON descendant.%(tree_id)s = %(event)s.%(tree_id)s
+        AND descendant.%(lft)s BETWEEN %(event)s.%(lft)s AND %(event)s.%(rght)s
+    INNER JOIN %(occurrence)s listed
+        ON listed.%(occurrence_event)s = descendant.%(event_pk)s
+    WHERE %(event)s.%(event_pk)s IN (%(ids)s)
+    GROUP BY %(event)s.%(event_pk)s
+"""
+
+# Counts the occurrences in the listing of each of a batch of events by
+# status, overall and from a given time (see StatusSummary).
+STATUS_SUMMARY_SQL = """
+    SELECT %(event)s.%(event_pk)s,
+        COUNT(listed.%(occurrence_pk)s),
+        SUM(CASE WHEN listed.%(occurrence_status)s = %%s THEN 1 ELSE 0 END),
+        SUM(CASE WHEN listed.%(occurrence_status)s = %%s THEN 1 ELSE 0 END),
+        SUM(CASE WHEN listed.%(occurrence_status)s = ''
+            OR listed.%(occurrence_status)s IS NULL THEN 1 ELSE 0 END),
+        SUM(CASE WHEN listed.%(occurrence_start)s >= %%s THEN 1 ELSE 0 END),
+        SUM(CASE WHEN listed.%(occurrence_start)s >= %%s
+            AND listed.%(occurrence_status)s = %%s THEN 1 ELSE 0 END),
+        SUM(CASE WHEN listed.%(occurrence_start)s >= %%s
+            AND listed.%(occurrence_status)s = %%s THEN 1 ELSE 0 END),
+        SUM(CASE WHEN listed.%(occurrence_start)s >= %%s
+            AND (listed.%(occurrence_status)s = ''
+                OR listed.%(occurrence_status)s IS NULL) THEN 1 ELSE 0 END),
+        MAX(listed.%(occurrence_end)s)
+    FROM %(event)s
+    INNER JOIN %(event)s descendant
+        ON descendant.%(tree_id)s = %(event)s.%(tree_id)s
+        AND descendant.%(lft)s BETWEEN %(event)s.%(lft)s AND %(event)s.%(rght)s
+    INNER JOIN %(occurrence)s listed
+        ON listed.%(occurrence_event)s = descendant.%(event_pk)s
+    WHERE %(event)s.%(event_pk)s IN (%(ids)s)
+    GROUP BY %(event)s.%(event_pk)s
+"""
+
+class StatusSummary(object):
+    """
+    The numbers of an event's listing occurrences that are cancelled, fully
+    booked and available, overall and of those that are forthcoming (from
+    when the summary was made), and the end of the last one. The status
+    methods of EventModel use this, rather than counting occurrences
+    themselves.
+    """
+    def __init__(self, count=0, cancelled=0, fully_booked=0, available=0,
+            forthcoming=0, forthcoming_cancelled=0,
+            forthcoming_fully_booked=0, forthcoming_available=0,
+            last_end=None):
+        self.count = count
+        self.cancelled = cancelled or 0
+        self.fully_booked = fully_booked or 0
+        self.available = available or 0
+        self.forthcoming = forthcoming or 0
+        self.forthcoming_cancelled = forthcoming_cancelled or 0
+        self.forthcoming_fully_booked = forthcoming_fully_booked or 0
+        self.forthcoming_available = forthcoming_available or 0
+        self.last_end = _datetime(last_end)
+
+    def add_virtual(self, occurrences, now):
+        """
+        Counts virtual occurrences (see OccurrenceQuerySet.with_virtual()),
+        which have no status, as well.
+        """
+        for o in occurrences:
+            self.count += 1
+            self.available += 1
+            if o.start >= now:
+                self.forthcoming += 1
+                self.forthcoming_available += 1
+            if self.last_end is None or o._end > self.last_end:
+                self.last_end = o._end
+
+def virtual_listings(EventModel, events):
+    """
+    Returns a dict of the virtual occurrences in the listing of each of
+    events (see OccurrenceQuerySet.with_virtual()), in start order, by event
+    id. They're computed together, in a few queries.
+    """
+    mptt_meta = EventModel._mptt_meta
+    tree_id, left, right = mptt_meta.tree_id_attr, mptt_meta.left_attr, \
+        mptt_meta.right_attr
+    listings = dict((e.pk, []) for e in events)
+    if not events:
+        return listings
+    qs = EventModel.OccurrenceModel().objects.with_virtual()
+    qs._virtual_generators = {'event__%s__in' % tree_id:
+        set(getattr(e, tree_id) for e in events)}
+    for o in qs._virtual_occurrences():
+        for e in events:
+            if getattr(o.event, tree_id) == getattr(e, tree_id) and \
+                    getattr(e, left) <= getattr(o.event, left) <= \
+                    getattr(e, right):
+                listings[e.pk].append(o)
+    return listings
+
+def status_summaries(EventModel, event_ids):
+    """
+    Returns a dict of StatusSummary by event id, with one grouped query per
+    batch of events (and, with a MATERIALISATION_WINDOW, a few more for the
+    virtual occurrences).
+    """
+    names = _sql_names(EventModel)
+    now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+    cancelled = settings.OCCURRENCE_STATUS_CANCELLED[0]
+    fully_booked = settings.OCCURRENCE_STATUS_FULLY_BOOKED[0]
+    cursor = connection.cursor()
+    event_ids = list(event_ids)
+    summaries = {}
+    for i in range(0, len(event_ids), SUMMARY_BATCH_SIZE):
+        ids = event_ids[i:i+SUMMARY_BATCH_SIZE]
+        names['ids'] = ", ".join(["%s"] * len(ids))
+        cursor.execute(STATUS_SUMMARY_SQL % names, [
+            cancelled, fully_booked, now, now, cancelled, now, fully_booked,
+            now,
+        ] + ids)
+        for row in cursor.fetchall():
+            summaries[row[0]] = StatusSummary(*row[1:])
+    for pk in event_ids:
+        summaries.setdefault(pk, StatusSummary())
+    if settings.MATERIALISATION_WINDOW:
+        now = datetime.datetime.now()
+        for i in range(0, len(event_ids), SUMMARY_BATCH_SIZE):
+            events = EventModel._event_manager.filter(
+                pk__in=event_ids[i:i+SUMMARY_BATCH_SIZE])
+            for pk, occurrences in virtual_listings(EventModel,
+                    list(events)).items():
+                summaries[pk].add_virtual(occurrences, now)
+    return summaries
+
+# The fields on EventModel that summarise its occurrences.
+SUMMARY_FIELDS = (
+    'direct_occurrence_count',
+    'listing_occurrence_count',
+    'available_occurrence_count',
+    'first_occurrence_start',
+    'last_occurrence_start',
+    'last_occurrence_end',
+)
+
+SUMMARY_BATCH_SIZE = 500
+
+# descendants updated per query when cascading inherited fields.
+CASCADE_BATCH_SIZE = 500
 
 class EventQuerySet(models.query.QuerySet):
     # much as you may be tempted to add "starts_between" and other
@@ -32,61 +267,197 @@ class EventQuerySet(models.query.QuerySet):
         Occurrence set, with no repetitions or overlaps. ie, this is probably
         what you want to show in listings.
 
-        Given that the tree is likely to be quite shallow, let's do this breadth-first.
-
-        For each level:
-        * two filter: 1) children of qs having_occurrences and 2) children of qs having_no_occurrences.
-        * 1) is added to result set.
-        * 2) is used as qs for next level
-
-        TODO: For subqueries, this will produce results that are not in the
-        superqueries, because we don't have access to potential missing parents.
-        Maybe this is desired behaviour?
+        This is done in one query, using the tree fields: an event is listed
+        if it has occurrences attached, and none of its ancestors do.
+        Ancestors are looked for in the whole table, so filtering a queryset
+        (eg to a particular level) and then calling in_listings() gives the
+        listed events that are in the filtered queryset.
         """
-        max_level = self.aggregate(models.Max('level'))['level__max']
-
-        result = self.filter(level=0).having_occurrences()
-        qs = self.filter(level=0).having_no_occurrences()
+        return self.extra(where=[LISTED_SQL % _sql_names(self.model)])
 
-        for level in range(1, max_level+1):
-            if qs:
-                result |= self.filter(parent__in=qs).having_occurrences()
-                qs = self.filter(parent__in=qs).having_no_occurrences()
-
-        return result
+    def with_listed(self):
+        """
+        Selects whether each event is in listings (see in_listings()) along
+        with it, so that is_listed() doesn't need more queries.
+        """
+        return self.extra(select={
+            '_is_listed': LISTED_SQL % _sql_names(self.model)})
 
     def occurrences(self):
         """
         Returns the occurrences for events in this queryset. NB that only
         occurrences attached directly to events, ie not child events, are returned.
         """
-        return self.model.OccurrenceModel().objects\
-            .filter(event__in=self)
+        # with_virtual() only computes these events' virtual occurrences, so
+        # the filter needn't be tested on them.
+        qs = self.model.OccurrenceModel().objects.get_query_set()\
+            ._virtual_aware().filter(event__in=self)._filter_virtual()
+        qs._virtual_generators = {'event__in': self}
+        return qs
                 
+    def _end_occurrence_sql(self, which):
+        names = _sql_names(self.model)
+        names['direction'] = {'opening': 'ASC', 'closing': 'DESC'}[which]
+        return END_OCCURRENCE_SQL % names
+
+    def _end_occurrences(self, which):
+        OccurrenceModel = self.model.OccurrenceModel()
+        names = _sql_names(self.model)
+        names['end_occurrence'] = self._end_occurrence_sql(which)
+        names['pk_subquery'], params = self.values_list('pk').query\
+            .get_compiler(self.db).as_sql()
+        return OccurrenceModel.objects.extra(where=["""
+            %(occurrence)s.%(occurrence_pk)s IN (
+                SELECT %(end_occurrence)s FROM %(event)s
+                WHERE %(event)s.%(event_pk)s IN (%(pk_subquery)s)
+            )""" % names], params=params)
+
     def opening_occurrences(self):
         """
-        Returns the opening occurrences for the events in this queryset.
+        Returns the opening occurrences for the events in this queryset, in
+        one query.
         """
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.opening_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences().filter(pk__in=pks)
+        return self._end_occurrences('opening')
         
     def closing_occurrences(self):
         """
-        Returns the closing occurrences for the events in this queryset.
+        Returns the closing occurrences for the events in this queryset, in
+        one query.
         """
-        pks = []
-        for e in self:
-            try:
-                pks.append(e.closing_occurrence().id)
-            except AttributeError:
-                pass
-        return self.occurrences().filter(pk__in=pks)
-                
+        return self._end_occurrences('closing')
+
+    def with_opening_occurrence(self):
+        """
+        Selects the id of each event's opening occurrence, as
+        opening_occurrence_id, and fetches the occurrences (a query per 100
+        events) so that event.opening_occurrence() doesn't need a query.
+        """
+        return self._with_end_occurrence('opening')
+
+    def with_closing_occurrence(self):
+        """
+        As with_opening_occurrence(), for closing_occurrence().
+        """
+        return self._with_end_occurrence('closing')
+
+    def _with_end_occurrence(self, which):
+        qs = self.extra(select={
+            '%s_occurrence_id' % which: self._end_occurrence_sql(which)
+        })
+        qs._end_occurrences_to_fetch = \
+            self._end_occurrences_to_fetch + (which,)
+        return qs
+
+    def with_status_summary(self):
+        """
+        Fetches the status summary of each event (a query per 100 events), so
+        that the status methods (is_cancelled() etc) don't need queries.
+        """
+        return self._clone(_fetch_status_summaries=True)
+
+    _end_occurrences_to_fetch = ()
+    _fetch_status_summaries = False
+
+    def _clone(self, *args, **kwargs):
+        kwargs.setdefault('_end_occurrences_to_fetch',
+            self._end_occurrences_to_fetch)
+        kwargs.setdefault('_fetch_status_summaries',
+            self._fetch_status_summaries)
+        return super(EventQuerySet, self)._clone(*args, **kwargs)
+
+    def iterator(self):
+        events = super(EventQuerySet, self).iterator()
+        if self._end_occurrences_to_fetch or self._fetch_status_summaries:
+            return self._fetch_in_chunks(events)
+        return events
+
+    def _fetch_in_chunks(self, events):
+        while True:
+            chunk = list(islice(events, FETCH_CHUNK_SIZE))
+            if not chunk:
+                break
+            if self._end_occurrences_to_fetch:
+                self._fetch_end_occurrences(chunk)
+            if self._fetch_status_summaries:
+                summaries = status_summaries(self.model,
+                    [e.pk for e in chunk])
+                for e in chunk:
+                    e._status_summary = summaries[e.pk]
+            for e in chunk:
+                yield e
+
+    def _fetch_end_occurrences(self, chunk):
+        OccurrenceModel = self.model.OccurrenceModel()
+        virtual = {}
+        if settings.MATERIALISATION_WINDOW:
+            virtual = virtual_listings(self.model, chunk)
+        for which in self._end_occurrences_to_fetch:
+            attr = '%s_occurrence_id' % which
+            ids = [getattr(e, attr) for e in chunk]
+            occurrences = OccurrenceModel.objects.in_bulk(
+                [pk for pk in ids if pk is not None])
+            for e in chunk:
+                occurrence = occurrences.get(getattr(e, attr))
+                # a virtual occurrence may be first or last (after a saved
+                # one with the same start).
+                listing = virtual.get(e.pk)
+                if listing and which == 'opening':
+                    if occurrence is None or \
+                            listing[0].start < occurrence.start:
+                        occurrence = listing[0]
+                elif listing:
+                    if occurrence is None or \
+                            listing[-1].start >= occurrence.start:
+                        occurrence = listing[-1]
+                setattr(e, '_%s_occurrence' % which, occurrence)
+
+    def with_ancestors(self):
+        """
+        Returns the events in this queryset, and all of their ancestors.
+        """
+        names = _sql_names(self.model)
+        names['pk_subquery'], params = self.values_list('pk').query\
+            .get_compiler(self.db).as_sql()
+        return self.model._event_manager.extra(
+            where=[ANCESTOR_OF_SQL % names], params=params)
+
+    def update_occurrence_summaries(self):
+        """
+        Recalculates the fields that summarise the occurrences of the events
+        in this queryset (see SUMMARY_FIELDS). This takes two grouped queries
+        per batch of events, and an UPDATE per event.
+        """
+        EventModel = self.model
+        OccurrenceModel = EventModel.OccurrenceModel()
+        names = _sql_names(EventModel)
+        event_ids = list(self.values_list('pk', flat=True))
+        cursor = connection.cursor()
+
+        for i in range(0, len(event_ids), SUMMARY_BATCH_SIZE):
+            ids = event_ids[i:i+SUMMARY_BATCH_SIZE]
+            direct_counts = dict(OccurrenceModel._default_manager\
+                .filter(event__in=ids).order_by()\
+                .values_list('event').annotate(Count('pk')))
+
+            names['ids'] = ", ".join(["%s"] * len(ids))
+            cursor.execute(LISTING_SUMMARY_SQL % names, ids)
+            listing = dict((row[0], row[1:]) for row in cursor.fetchall())
+
+            for pk in ids:
+                count, available, first_start, last_start, last_end = \
+                    listing.get(pk, (0, 0, None, None, None))
+                EventModel._event_manager.filter(pk=pk).update(
+                    direct_occurrence_count=direct_counts.get(pk, 0),
+                    listing_occurrence_count=count,
+                    available_occurrence_count=available or 0,
+                    first_occurrence_start=_datetime(first_start),
+                    last_occurrence_start=_datetime(last_start),
+                    last_occurrence_end=_datetime(last_end),
+                )
+
+        # the cached occurrences of these events are out of date too.
+        occurrence_cache.invalidate(EventModel, event_ids)
+
     #some simple annotations
     def having_occurrences(self):
         return self.annotate(num_occurrences=Count('occurrences'))\
@@ -108,6 +479,8 @@ class EventTreeManager(TreeManager):
 
     def in_listings(self):
         return self.get_query_set().in_listings()
+    def with_listed(self):
+        return self.get_query_set().with_listed()
 
     def occurrences(self, *args, **kwargs):
         return self.get_query_set().occurrences(*args, **kwargs)
@@ -117,6 +490,19 @@ class EventTreeManager(TreeManager):
     def closing_occurrences(self, *args, **kwargs):
         return self.get_query_set().closing_occurrences(*args, **kwargs)
 
+    def with_opening_occurrence(self):
+        return self.get_query_set().with_opening_occurrence()
+    def with_closing_occurrence(self):
+        return self.get_query_set().with_closing_occurrence()
+
+    def with_status_summary(self):
+        return self.get_query_set().with_status_summary()
+
+    def with_ancestors(self):
+        return self.get_query_set().with_ancestors()
+    def update_occurrence_summaries(self):
+        return self.get_query_set().update_occurrence_summaries()
+
     def having_occurrences(self):
         return self.get_query_set().having_occurrences()        
     def having_n_occurrences(self, n):
@@ -138,6 +524,8 @@ class EventOptions(object):
     fields_to_inherit = []
     event_manager_class = EventTreeManager
     event_manager_attr = 'eventobjects'
+    # the (non-m2m) fields of fields_to_inherit, set by EventModelBase
+    inherited_fields = ()
     
     def __init__(self, opts):
         # Override defaults with options provided
@@ -169,16 +557,17 @@ class EventModelBase(MPTTModelBase):
             # copies)
             pass
         else:
+            # the fields whose values new children take from their parent (in
+            # EventModel.__init__).
+            inherited_fields = []
             for field_name in class_dict['_event_meta'].fields_to_inherit:
                 try:
                     field = cls._meta.get_field(field_name)
-                    #injecting our fancy inheriting default
-                    field.default = ModelInstanceAwareDefault(
-                        field_name,
-                        field.default
-                    )
                 except models.FieldDoesNotExist:
                     continue
+                if field in cls._meta.fields:
+                    inherited_fields.append(field)
+            cls._event_meta.inherited_fields = tuple(inherited_fields)
             
             # Add a custom manager
             assert issubclass(
@@ -222,13 +611,53 @@ class EventModel(MPTTModel):
         (e.g. \'Tuesdays and Thursdays throughout February, at 10:30am\')"
     )
 
+    # A summary of this event's occurrences, so that listings don't have to
+    # query them. These are kept up to date by occurrence saves and deletes,
+    # generator syncs and admin actions (see occurrences_changed()), and can be
+    # rebuilt with ./manage.py rebuild_event_summaries.
+    direct_occurrence_count = models.PositiveIntegerField(default=0,
+        editable=False)
+    listing_occurrence_count = models.PositiveIntegerField(default=0,
+        editable=False)
+    available_occurrence_count = models.PositiveIntegerField(default=0,
+        editable=False)
+    first_occurrence_start = models.DateTimeField(null=True, editable=False)
+    last_occurrence_start = models.DateTimeField(null=True, editable=False)
+    last_occurrence_end = models.DateTimeField(null=True, editable=False)
+
+    # when the event was last saved, for conditional GETs.
+    modified = models.DateTimeField(auto_now=True, editable=False, db_index=True)
+
     class Meta:
         abstract = True
         ordering = ['tree_id', 'lft'] 
     
+    def __init__(self, *args, **kwargs):
+        super(EventModel, self).__init__(*args, **kwargs)
+        # A new child (eg Event(parent=p, ...)) takes the parent's values for
+        # the fields_to_inherit that aren't given. Rows loaded from the db
+        # come in as args, so this costs them nothing.
+        parent = kwargs.get('parent')
+        if parent is not None:
+            for field in self._event_meta.inherited_fields:
+                if field.name not in kwargs and field.attname not in kwargs:
+                    setattr(self, field.attname,
+                        getattr(parent, field.attname))
+
     def __unicode__(self):
         return self.title
 
+    @classmethod
+    def inherited_values(cls, parent):
+        """
+        Returns a dict of the values a new child of parent takes from it, by
+        field name (foreign keys give ids), eg for form initial data.
+        """
+        return dict(
+            (field.name, getattr(parent, field.attname))
+            for field in cls._event_meta.inherited_fields
+        )
+
     @classmethod
     def OccurrenceModel(cls):
         """
@@ -250,25 +679,94 @@ class EventModel(MPTTModel):
         """
         return cls.exclusions.related.model
 
+    @classmethod
+    def occurrences_changed(cls, event_ids):
+        """
+        Updates the occurrence summaries of the given events, and of their
+        ancestors. Call this after changing occurrences in ways that bypass
+        OccurrenceModel.save() and delete(), eg with queryset.update().
+        """
+        event_ids = set(event_ids)
+        event_ids.discard(None)
+        if event_ids:
+            cls._event_manager.filter(pk__in=event_ids).with_ancestors()\
+                .update_occurrence_summaries()
+
     def save(self, *args, **kwargs):
         """
-        When an event is saved, the changes to fields are cascaded to children,
-        and any endless generators are updated, so that a few more occurrences
-        are generated
+        When an event is saved, the changes to fields are cascaded to children
+        (the number of descendants changed is left in cascaded_count), and any
+        endless generators are updated, so that a few more occurrences
+        are generated (or, if syncs are being deferred, the event is marked
+        for syncing later - see eventtools.sync).
         """
         #this has to happen before super.save, so that we can tell what's
         #changed
         if not self.slug:
             self.slug = slugify(unicode(self))
 
-        self._cascade_changes_to_children()
+        parent_field = self._mptt_meta.parent_attr
+        moved_from = None
+        if self.pk:
+            # don't overwrite the summaries with the values we were loaded
+            # with, and see if I'm being moved in the tree.
+            for saved in type(self)._event_manager.filter(pk=self.pk)\
+                    .values(parent_field, *SUMMARY_FIELDS):
+                old_parent_id = saved.pop(parent_field)
+                if old_parent_id != getattr(self, self._parent_attname()):
+                    moved_from = old_parent_id or self.pk
+                for field, value in saved.items():
+                    setattr(self, field, value)
+
+        self.cascaded_count = self._cascade_changes_to_children()
         r = super(EventModel, self).save(*args, **kwargs)
+        if moved_from is not None:
+            self._moved(moved_from)
+        occurrence_cache.invalidate(type(self), [self.pk])
+        self.__dict__.pop('_status_summary', None)
 
-        endless_generators = self.generators.filter(repeat_until__isnull=True)
-        [g.save() for g in endless_generators]
+        if coordinator.is_deferred():
+            coordinator.mark_dirty(self)
+        else:
+            endless_generators = self.generators.filter(repeat_until__isnull=True)
+            [g._sync_occurrences() for g in endless_generators]
 
         return r
                 
+    def _parent_attname(self):
+        return self._meta.get_field(self._mptt_meta.parent_attr).attname
+
+    def move_to(self, target, position='first-child'):
+        old_parent_id = getattr(self, self._parent_attname())
+        super(EventModel, self).move_to(target, position)
+        self._moved(old_parent_id or self.pk)
+        occurrence_cache.invalidate(type(self), [self.pk])
+
+    def _moved(self, old_parent_id):
+        """
+        After I'm moved in the tree, my old and new ancestors list different
+        occurrences, so their summaries are updated (as are mine, which are
+        reloaded).
+        """
+        self.occurrences_changed([old_parent_id, self.pk])
+        occurrence_cache.invalidate(type(self), [old_parent_id])
+        for saved in type(self)._event_manager.filter(pk=self.pk)\
+                .values(*SUMMARY_FIELDS):
+            for field, value in saved.items():
+                setattr(self, field, value)
+
+    def delete(self, *args, **kwargs):
+        """
+        Deleting an event deletes its descendants and their occurrences, so
+        my ancestors' summaries are updated.
+        """
+        parent_id = getattr(self, self._parent_attname())
+        pk = self.pk
+        r = super(EventModel, self).delete(*args, **kwargs)
+        self.occurrences_changed([parent_id])
+        occurrence_cache.invalidate(type(self), [pk, parent_id])
+        return r
+
     def reload(self):
         """
         Used for refreshing events in a queryset that may have changed.        
@@ -278,8 +776,13 @@ class EventModel(MPTTModel):
         
     def _cascade_changes_to_children(self):
         """
-        Go through the fields_to_inherit, and apply my values to my children,
-        if my children don't have altered values.
+        Go through the fields_to_inherit, and apply my values to my
+        descendants, if they (and the descendants between us) don't have
+        altered values. Returns the number of descendants changed.
+
+        Each changed field takes one walk through the descendants' values and
+        an UPDATE (per batch), rather than saving each descendant, so children
+        don't resync their generators (inherited fields don't affect timing).
 
         Now tries 'inheritable_FOO' attributes for getting attributes where the
         native value isn't in the right form,
@@ -289,23 +792,47 @@ class EventModel(MPTTModel):
         def inheritable_price:
             return self.price.raw
         """
-        if self.pk:
-            saved_self = type(self)._event_manager.get(pk=self.pk)
-            attribs = type(self)._event_meta.fields_to_inherit
-        
-            for child in self.get_children():
-                for a in attribs:
-                    inheritable_attr = "inheritable_%s" % a
-                    try:
-                        saved_value = getattr(saved_self, inheritable_attr, getattr(saved_self, a))
-                        ch_value =  getattr(child, inheritable_attr, getattr(child, a))
-                        if ch_value == saved_value:
-                            #the child's value is unchanged from the parent
-                            new_value = getattr(self, inheritable_attr, getattr(self, a))
-                            setattr(child, a, new_value)
-                    except AttributeError:
-                        continue
-                child.save() #cascades to grandchildren
+        if not self.pk:
+            return 0
+        fields = type(self)._event_meta.inherited_fields
+        if not fields:
+            return 0
+        manager = type(self)._event_manager
+        names = [f.name for f in fields]
+        try:
+            saved = manager.filter(pk=self.pk).values(*names)[0]
+        except IndexError:
+            return 0
+
+        changed = []
+        for field in fields:
+            new_value = getattr(self, "inheritable_%s" % field.name,
+                getattr(self, field.attname))
+            if saved[field.name] != new_value:
+                changed.append((field, new_value))
+        if not changed:
+            return 0
+
+        descendants = list(self.get_descendants()\
+            .values_list('pk', 'parent', *[f.name for f, v in changed]))
+        now = datetime.datetime.now()
+        updated = set()
+        for i, (field, new_value) in enumerate(changed):
+            old_value = saved[field.name]
+            # descendants are in tree order, so parents come before children.
+            inheriting = set([self.pk])
+            for row in descendants:
+                if row[1] in inheriting and row[i+2] == old_value:
+                    inheriting.add(row[0])
+            inheriting.discard(self.pk)
+            ids = list(inheriting)
+            for j in range(0, len(ids), CASCADE_BATCH_SIZE):
+                manager.filter(pk__in=ids[j:j+CASCADE_BATCH_SIZE]).update(
+                    **{field.name: new_value, 'modified': now})
+            updated.update(ids)
+
+        occurrence_cache.invalidate(type(self), updated)
+        return len(updated)
 
     def occurrences_in_listing(self):
         """
@@ -317,16 +844,24 @@ class EventModel(MPTTModel):
         occurrences_in_listing() for these events will return the entire
         Occurrence set, with no repetitions or overlaps. ie, this is probably
         what you want to show in listings.
+
+        With a MATERIALISATION_WINDOW, the virtual occurrences after it are
+        included (see OccurrenceQuerySet.with_virtual()).
         """
-        return self.get_descendants(include_self=True).occurrences()
+        return self.get_descendants(include_self=True).occurrences()\
+            .with_virtual_in_window()
 
     def opening_occurrence(self):
+        if hasattr(self, '_opening_occurrence'):
+            return self._opening_occurrence
         try:
             return self.occurrences_in_listing().all()[0]
         except IndexError:
             return None
         
     def closing_occurrence(self):
+        if hasattr(self, '_closing_occurrence'):
+            return self._closing_occurrence
         try:
             return self.occurrences_in_listing().all().reverse()[0]
         except IndexError:
@@ -336,8 +871,11 @@ class EventModel(MPTTModel):
         return reverse('events:event', kwargs={'event_slug': self.slug })
         
     def is_finished(self):
-        """ the event has finished if the closing occurrence has finished. """
-        return self.closing_occurrence().is_finished()
+        """ the event has finished if its last occurrence has finished. """
+        last_end = self.status_summary().last_end
+        if last_end is None:
+            return False
+        return last_end < datetime.datetime.now()
 
     def listed_under(self):
         """
@@ -351,6 +889,8 @@ class EventModel(MPTTModel):
         return None
 
     def is_listed(self):
+        if hasattr(self, '_is_listed'): # see EventQuerySet.with_listed()
+            return bool(self._is_listed)
         return self.listed_under() == self
     is_listed.boolean = True
 
@@ -361,12 +901,9 @@ class EventModel(MPTTModel):
         if self.season_description:
             return self.season_description
         
-        o = self.opening_occurrence()
-        c = self.closing_occurrence()
-        
-        if o and c:
-            first = o.start.date()
-            last = c.start.date()
+        if self.first_occurrence_start and self.last_occurrence_start:
+            first = self.first_occurrence_start.date()
+            last = self.last_occurrence_start.date()
             return pprint_date_span(first, last)
             
         return None
@@ -374,9 +911,26 @@ class EventModel(MPTTModel):
     def sessions(self):
         return self.sessions_description
 
+    def status_summary(self):
+        """
+        Returns a StatusSummary of this event's listing occurrences, from one
+        query. It's kept until the event is saved; refetch the event (or use
+        EventQuerySet.with_status_summary()) for an up-to-date one.
+        """
+        if not hasattr(self, '_status_summary'):
+            self._status_summary = \
+                status_summaries(type(self), [self.pk])[self.pk]
+        return self._status_summary
+
     def occurrence_statuses(self):
         #returns a set of statuses of my occurrences
-        return set(self.occurrences_in_listing().values_list('status', flat=True).distinct())
+        occurrences = self.occurrences_in_listing()
+        statuses = set(occurrences.values_list('status', flat=True).distinct())
+        if occurrences._with_virtual: # virtual occurrences have no status
+            for o in occurrences._virtual_occurrences():
+                statuses.add(o.status)
+                break
+        return statuses
 
     def status(self):
         #returns a status if all occurrences have the same status.
@@ -388,32 +942,37 @@ class EventModel(MPTTModel):
 
     def is_cancelled(self):
         """Return True if all occurrences are cancelled"""
-        cancelled = self.cancelled_occurrences().count()
-        return cancelled > 0 and self.occurrences_in_listing().count() == cancelled
+        summary = self.status_summary()
+        return summary.cancelled > 0 and summary.count == summary.cancelled
 
     def forthcoming_is_cancelled(self):
         """Return True if all forthcoming occurrences are cancelled"""
-        forthcoming = self.occurrences_in_listing().forthcoming().count()
-        cancelled_forthcoming = self.cancelled_occurrences().forthcoming().count()
-        return cancelled_forthcoming > 0 and forthcoming == cancelled_forthcoming
+        summary = self.status_summary()
+        return summary.forthcoming_cancelled > 0 and \
+            summary.forthcoming == summary.forthcoming_cancelled
 
     def is_fully_booked(self):
         """
         Return True if no occurrences are available and at least one is fully booked. (a mix of cancelled and fully booked is allowed)
         """
-        return self.available_occurrences().count() == 0 and self.fully_booked_occurrences().count() > 0
+        summary = self.status_summary()
+        return summary.available == 0 and summary.fully_booked > 0
 
     def forthcoming_is_fully_booked(self):
         """
         Return True if no forthcoming occurrences are available and at least one is fully booked. (a mix of cancelled and fully booked is allowed)
         """
-        return self.available_occurrences().forthcoming().count() == 0 and self.fully_booked_occurrences().forthcoming().count() > 0
+        summary = self.status_summary()
+        return summary.forthcoming_available == 0 and \
+            summary.forthcoming_fully_booked > 0
 
     def is_available(self):
         """
         Return True if any sessions are available (ie not cancelled or fully booked)
         """
-        return self.available_occurrences().count() > 0
+        if settings.MATERIALISATION_WINDOW: # virtual ones aren't counted
+            return self.status_summary().available > 0
+        return self.available_occurrence_count > 0
 
     def unavailable_status_message(self):
         if self.is_finished():
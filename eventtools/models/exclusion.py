@@ -2,6 +2,61 @@
 
 from django.db import models
 
+from eventtools.caching import occurrence_cache
+
+# exclusions created per INSERT (sqlite allows 999 parameters per query)
+EXCLUSION_BATCH_SIZE = 100
+
+def bulk_exclude(event, starts, delete=False):
+    """
+    Excludes event's occurrences at each of starts (eg from a data import),
+    in a few queries. See ExclusionManager.bulk_exclude().
+    """
+    return event.ExclusionModel()._default_manager.bulk_exclude(
+        event, starts, delete=delete)
+
+
+class ExclusionManager(models.Manager):
+
+    def bulk_exclude(self, event, starts, delete=False):
+        """
+        Adds exclusions for event at each of starts that isn't already
+        excluded, with an INSERT per batch. The generated occurrences that
+        clash are unhooked (made one-off) with one UPDATE, as save() does, or,
+        if delete is True, deleted (unless something protects them, in which
+        case they're unhooked).
+
+        Returns the exclusions that were added.
+        """
+        starts = sorted(set(starts))
+        if not starts:
+            return []
+        existing = set(self.filter(event=event,
+            start__gte=starts[0], start__lte=starts[-1],
+        ).values_list('start', flat=True))
+        exclusions = [self.model(event=event, start=start)
+            for start in starts if start not in existing]
+        for i in range(0, len(exclusions), EXCLUSION_BATCH_SIZE):
+            self.bulk_create(exclusions[i:i+EXCLUSION_BATCH_SIZE])
+
+        wanted = set(starts)
+        clashing_ids = [pk for pk, start in event.occurrences.filter(
+            generated_by__isnull=False,
+            start__gte=starts[0], start__lte=starts[-1],
+        ).values_list('pk', 'start') if start in wanted]
+        if clashing_ids:
+            clashing = event.occurrences.filter(pk__in=clashing_ids)
+            if delete:
+                clashing.delete_or_unhook()
+            else:
+                clashing.update(generated_by=None)
+            # also invalidates the cached occurrences
+            type(event).occurrences_changed([event.pk])
+        elif exclusions:
+            occurrence_cache.invalidate(type(event), [event.pk])
+        return exclusions
+
+
 class ExclusionModel(models.Model):
     """
     Represents the time of an occurrence which is not to be generated for a given event.
@@ -12,6 +67,9 @@ class ExclusionModel(models.Model):
     event = models.ForeignKey(SomeEvent, related_name="exclusions")
     """
     start = models.DateTimeField(db_index=True)
+    modified = models.DateTimeField(auto_now=True, editable=False, db_index=True)
+
+    objects = ExclusionManager()
 
     class Meta:
         abstract = True
@@ -30,9 +88,16 @@ class ExclusionModel(models.Model):
         """
         r = super(ExclusionModel, self).save(*args, **kwargs)
         
-        clashing = self.event.occurrences.filter(start = self.start, generated_by__isnull=False)
-        for c in clashing:
-            c.generated_by = None
-            c.save()
-        
-        return r
\ No newline at end of file
+        self.event.occurrences.filter(start = self.start, generated_by__isnull=False)\
+            .update(generated_by=None)
+
+        occurrence_cache.invalidate(self.EventModel(), [self.event_id])
+        return r
+
+    def delete(self, *args, **kwargs):
+        occurrence_cache.invalidate(self.EventModel(), [self.event_id])
+        return super(ExclusionModel, self).delete(*args, **kwargs)
+
+    @classmethod
+    def EventModel(cls):
+        return cls._meta.get_field('event').rel.to
\ No newline at end of file
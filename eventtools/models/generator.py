@@ -1,5 +1,6 @@
 # −*− coding: UTF−8 −*−
 from django.db import models, transaction
+from django.db.models import F
 from django.db.models.base import ModelBase
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.core import exceptions
@@ -7,7 +8,11 @@ from django.core import exceptions
 from dateutil import rrule
 from eventtools.models.xtimespan import XTimespanModel
 
+from eventtools import signals
+from eventtools.caching import occurrence_cache
 from eventtools.conf import settings
+from eventtools.sync import coordinator
+from eventtools.utils.expansion import expand
 from eventtools.utils.pprint_timespan import (
     pprint_datetime_span, pprint_date_span)
 
@@ -32,6 +37,9 @@ class GeneratorModel(XTimespanModel):
     robot_description() attempts to provide an English description of this
     generator. It's not great at the moment and might be replaced or deprecated
     in favour of a hand-written description in the Event.
+
+    roll_forward() generates the occurrences after the last ones generated (for
+    endless generators, whose horizon moves on every day).
     
     EventModel() returns the Model of the Event that this Generator links to.
     """
@@ -44,6 +52,10 @@ class GeneratorModel(XTimespanModel):
         )
     )
 
+    # the high-water mark: occurrences have been generated up to here (see
+    # roll_forward()).
+    generated_until = models.DateTimeField(null=True, editable=False)
+
     class Meta:
         abstract = True
         ordering = ('start',)
@@ -84,6 +96,9 @@ class GeneratorModel(XTimespanModel):
 
         Finally, we also update other generators, because they might have had
         clashing occurrences which no longer clash.
+
+        If syncs are being deferred (see eventtools.sync), the syncing is left
+        until later, when all of the event's generators are synced once.
         """
         
         cascade = kwargs.pop('cascade', True)
@@ -97,27 +112,122 @@ class GeneratorModel(XTimespanModel):
         if self.pk:
             self._update_existing_occurrences() # need to do this before save, so we can detect changes
         r = super(GeneratorModel, self).save(*args, **kwargs)
+        occurrence_cache.invalidate(self.EventModel(), [self.event_id])
+
+        if coordinator.is_deferred():
+            coordinator.mark_dirty(self.event)
+            return r
+
         self._sync_occurrences() #need to do this after save, so we have a pk to hang new occurrences from.
     
         # finally, we should also update other generators, because they might 
         # have had clashing occurrences
         if cascade:
             for generator in self.event.generators.exclude(pk=self.pk):
-                generator.save(cascade=False)
+                generator._sync_occurrences()
         
         return r
         
-    def _generate_dates(self):
-        rule = self.rule.get_rrule(dtstart=self.start)
-        date_iter = iter(rule)
-        drop_dead_date = datetime.combine(self.repeat_until or date.today() \
+    def _horizon(self):
+        return datetime.combine(self.repeat_until or date.today() \
             + settings.DEFAULT_GENERATOR_LIMIT, time.max)
-                
-        while True:
-            d = date_iter.next()
-            if d > drop_dead_date:
-                break
-            yield d
+
+    def _materialisation_horizon(self):
+        """
+        My occurrences are saved up to here. Any after it (up to _horizon())
+        are virtual (see settings.MATERIALISATION_WINDOW).
+        """
+        horizon = self._horizon()
+        window = settings.MATERIALISATION_WINDOW
+        if window:
+            horizon = min(horizon,
+                datetime.combine(date.today() + window, time.max))
+        return horizon
+
+    def virtual_occurrences(self, after=None, until=None):
+        """
+        Yields (unsaved) occurrences for my dates after my high-water mark
+        (or after, if it's later) up to my horizon (or until, if it's
+        earlier). Usually you want OccurrenceQuerySet.with_virtual(), which
+        also leaves out the dates that are taken or excluded.
+        """
+        for start in self._virtual_starts(after, until):
+            yield self._virtual_occurrence(start)
+
+    def _virtual_starts(self, after=None, until=None):
+        if self.generated_until is None: # never synced
+            return []
+        after = max(self.generated_until, after or self.generated_until)
+        until = min(self._horizon(), until or self._horizon())
+        if until <= after:
+            return []
+        return self._generate_dates(after=after, until=until)
+
+    def _virtual_occurrence(self, start):
+        o = self.occurrences.model(event=self.event, generated_by=self,
+            start=start, _duration=self._duration)
+        o._end = o.end()
+        o._virtual = True
+        return o
+
+    def _generate_dates(self, after=None, until=None):
+        return expand(self.rule.compile(), self.start,
+            until or self._horizon(), after)
+
+    def _set_generated_until(self, until):
+        type(self)._default_manager.filter(pk=self.pk)\
+            .update(generated_until=until)
+        self.generated_until = until
+
+    @transaction.commit_on_success()
+    def roll_forward(self, until=None):
+        """
+        Generates my occurrences from my high-water mark (generated_until) up
+        to until (by default, my horizon: repeat_until, or today plus
+        DEFAULT_GENERATOR_LIMIT, or MATERIALISATION_WINDOW if it's set), with
+        a bulk insert, and moves the mark up.
+        Only the occurrences and exclusions after the mark are looked at, so
+        this stays cheap as the history grows (which is what
+        ./manage.py roll_generators does for endless generators).
+
+        If I don't have a mark yet, I'm fully synced instead.
+
+        Returns the number of occurrences created.
+        """
+        if self.generated_until is None:
+            self._sync_occurrences()
+            return None
+        until = until or self._materialisation_horizon()
+        if until <= self.generated_until:
+            return 0
+
+        starts = self._generate_dates(after=self.generated_until, until=until)
+        new_occurrences = []
+        if starts:
+            OccurrenceModel = self.occurrences.model
+            ExclusionModel = self.event.exclusions.model
+            occupied_starts = set(self.event.occurrences_in_listing()\
+                .with_virtual(False)\
+                .filter(start__gte=starts[0], start__lte=starts[-1])\
+                .values_list('start', flat=True))
+            excluded_starts = set(ExclusionModel._default_manager\
+                .filter(event=self.event_id,
+                    start__gte=starts[0], start__lte=starts[-1])\
+                .values_list('start', flat=True))
+            for start in starts:
+                if start in occupied_starts or start in excluded_starts:
+                    continue
+                new_occurrences.append(OccurrenceModel(
+                    event_id=self.event_id, generated_by=self, start=start,
+                    _duration=self._duration
+                ))
+            if new_occurrences:
+                OccurrenceModel._default_manager.bulk_create(new_occurrences)
+                self.EventModel().occurrences_changed([self.event_id])
+                occurrence_cache.invalidate(self.EventModel(), [self.event_id])
+
+        self._set_generated_until(until)
+        return len(new_occurrences)
     
     @transaction.commit_on_success()
     def _update_existing_occurrences(self):
@@ -170,10 +280,66 @@ class GeneratorModel(XTimespanModel):
         duration_changed = self._duration != saved_self._duration
 
         if start_shift or duration_changed:
-            for o in self.occurrences.all():
+            self._timeshift_occurrences(start_shift)
+
+    def _timeshift_occurrences(self, start_shift):
+        """
+        Moves all my occurrences by start_shift, and gives them my duration.
+
+        This is done with one UPDATE, unless a moved occurrence would land on
+        the start of another occurrence of the same event, which would break
+        unique_together ('start', 'event') - if only while the UPDATE is
+        running. In that case we fall back to saving the occurrences one at a
+        time, furthest-moving-edge first, so that they stay out of each
+        other's way. (A clash with an occurrence that isn't mine still raises
+        an IntegrityError, as it would have if saved by hand.)
+
+        Either way, a single occurrences_timeshifted signal is sent.
+        """
+        OccurrenceModel = self.occurrences.model
+        mine = list(self.occurrences.values_list('pk', 'event_id', 'start'))
+        if not mine:
+            return
+
+        clashes = False
+        if start_shift:
+            shifted = set(
+                (event_id, start + start_shift) for pk, event_id, start in mine
+            )
+            shifted_starts = [start for event_id, start in shifted]
+            occupied = set(OccurrenceModel._default_manager.filter(
+                event__in=set(event_id for event_id, start in shifted),
+                start__gte=min(shifted_starts),
+                start__lte=max(shifted_starts),
+            ).values_list('event_id', 'start'))
+            clashes = bool(shifted & occupied)
+
+        if clashes:
+            # moving later: move the latest first, and vice versa.
+            ordering = '-start' if start_shift > timedelta(0) else 'start'
+            for o in self.occurrences.order_by(ordering):
                 o.start += start_shift
                 o._duration = self._duration
-                o.save()
+                o.save(update_summaries=False)
+        else:
+            # _end is set in a second statement, as some databases (MySQL)
+            # would see the new start in the first, and some the old one.
+            changes = {'_duration': self._duration, '_end': None}
+            if start_shift:
+                changes['start'] = F('start') + start_shift
+            self.occurrences.update(**changes)
+            self.occurrences.update(_end=F('start') + self.duration)
+
+        self.EventModel().occurrences_changed(
+            [event_id for pk, event_id, start in mine])
+
+        signals.occurrences_timeshifted.send(
+            sender=OccurrenceModel,
+            generator=self,
+            start_shift=start_shift,
+            duration=self._duration,
+            occurrence_ids=[pk for pk, event_id, start in mine],
+        )
 
     
     @transaction.commit_on_success()
@@ -189,67 +355,100 @@ class GeneratorModel(XTimespanModel):
           generator if they are protected by a Foreign Key.
             
         In detail:
-        Get a list, A, of already-generated occurrences.
-        
-        Generate candidate Occurrences.
-        For each candidate Occurrence:
-            if it exists for the event:
-                if I created it, unhook, and remove from the list A.
+        Fetch, once each, the starts of all the occurrences in the event's
+        listing, the starts of the occurrences I generated, and the starts of
+        the exclusions in the event's listing. Then, in memory:
+
+        For each candidate start:
+            if an occurrence exists for the event:
+                if I created it, and it isn't an exclusion, keep it.
                 else do nothing
             if it is an exclusion, do nothing
-            otherwise create it.
-            
-        The items remaining in list A are 'orphan' occurrences, that were
-        previously generated, but would no longer be. These are unhooked from
-        the generator.
+            otherwise queue it for creation.
+
+        The queued occurrences are created with a bulk insert. The occurrences
+        I generated that weren't kept are 'orphan' occurrences, that were
+        previously generated, but would no longer be. These are deleted, or
+        unhooked from the generator if they are protected, with set-based
+        queries. The number of queries doesn't depend on the number of
+        occurrences.
         """
-        
-        all_occurrences = self.event.occurrences_in_listing().all() #regardless of generator
-        existing_but_not_regenerated = set(self.occurrences.all()) #generated by me only
+        OccurrenceModel = self.occurrences.model
+        ExclusionModel = self.event.exclusions.model
+        listing_events = self.event.get_descendants(include_self=True)
+
+        #regardless of generator
+        occupied_starts = set(self.event.occurrences_in_listing()\
+            .with_virtual(False).values_list('start', flat=True))
+        excluded = set(ExclusionModel._default_manager\
+            .filter(event__in=listing_events)\
+            .values_list('event_id', 'start'))
+
+        #generated by me only
+        mine_by_start = {}
+        for pk, event_id, start in \
+                self.occurrences.values_list('pk', 'event_id', 'start'):
+            mine_by_start.setdefault(start, []).append((pk, event_id))
 
+        # later starts are virtual (but the occurrences I've already saved
+        # for them are kept).
+        materialise_until = self._materialisation_horizon()
+
+        keep_ids = set()
+        new_occurrences = []
         for start in self._generate_dates():
             # if the proposed occurrence exists, then don't make a new one.
             # However, if it belongs to me: 
             #       and if it is marked as an exclusion:
             #           do nothing (it will later get deleted/unhooked)
             #       else:
-            #           remove it from the set of existing_but_not_regenerated
-            #           occurrences so it stays hooked up
-
-            try:
-                o = all_occurrences.filter(start=start)[0]
-                if o.generated_by == self:
-                    if not o.is_exclusion():
-                        existing_but_not_regenerated.discard(o)
+            #           keep it, so it stays hooked up
+            if start in occupied_starts:
+                for pk, event_id in mine_by_start.get(start, []):
+                    if (event_id, start) not in excluded:
+                        keep_ids.add(pk)
                 continue
-            except IndexError:
-                # no occurrence exists yet.
-                pass
 
             # if the proposed occurrence is an exclusion, don't save it.
-            if self.event.exclusions.filter(
-                event=self.event, start=start
-            ).count():
-                continue            
+            if (self.event_id, start) in excluded:
+                continue
+
+            if start > materialise_until:
+                continue
 
             #OK, we're good to create the occurrence.
-            o = self.occurrences.create(event=self.event, start=start, _duration=self._duration)
-#            print "created %s" % o
-            #implied generated_by = self
-    
+            occupied_starts.add(start)
+            new_occurrences.append(OccurrenceModel(
+                event=self.event, generated_by=self, start=start,
+                _duration=self._duration
+            ))
+
+        if new_occurrences:
+            OccurrenceModel._default_manager.bulk_create(new_occurrences)
+
         # Finally, delete any unaccounted_for occurrences. If we can't delete, due to protection set by FKs to it, then
         # unhook it instead.
-        for o in existing_but_not_regenerated:
-#            print "deleting %s" % o
-            o.delete()
+        orphan_ids = set(
+            pk for mine in mine_by_start.values() for pk, event_id in mine
+        ) - keep_ids
+        if orphan_ids:
+            self.occurrences.filter(pk__in=orphan_ids).delete_or_unhook()
+
+        if new_occurrences or orphan_ids:
+            listing_events.with_ancestors().update_occurrence_summaries()
+
+        self._set_generated_until(materialise_until)
 
     def delete(self, *args, **kwargs):
         """
         If I am deleted, then cascade to my Occurrences, UNLESS there is is something FKed to them that is protecting them,
         in which case the FK is set to NULL.
         """
-        for o in self.occurrences.all():
-            o.delete()
+        occurrences = self.occurrences.all()
+        event_ids = set(occurrences.values_list('event_id', flat=True))
+        occurrences.delete_or_unhook()
+        self.EventModel().occurrences_changed(event_ids)
+        occurrence_cache.invalidate(self.EventModel(), [self.event_id])
 
         super(GeneratorModel,self).delete(*args, **kwargs)
 
@@ -1,12 +1,13 @@
 from vobject.icalendar import utc
 
-from django.db import models
+from django.db import models, connection
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils.safestring import mark_safe
 from django.core.urlresolvers import reverse
 from django.db.models import signals
 from django.db.models.base import ModelBase
+from django.db.models.sql.constants import LOOKUP_SEP
 from django.template.defaultfilters import urlencode
 from django.utils.dateformat import format
 from django.utils.translation import ugettext as _
@@ -17,6 +18,9 @@ from eventtools.utils import datetimeify, dayify
 from eventtools.utils.managertype import ManagerType
 
 import datetime
+import heapq
+import operator
+from itertools import islice
 
 
 """
@@ -29,6 +33,83 @@ dateranges.dates_in_week_of(day) # a generator
 
 """
 
+# An occurrence is excluded if its event has an exclusion at its start.
+EXCLUDED_SQL = """EXISTS (
+    SELECT 1 FROM %(exclusion)s
+    WHERE %(exclusion)s.%(exclusion_event)s = %(occurrence)s.%(occurrence_event)s
+        AND %(exclusion)s.%(exclusion_start)s = %(occurrence)s.%(occurrence_start)s
+)"""
+
+# The comparisons that filter() and exclude() can make on virtual occurrences
+# (as well as 'in' and 'isnull'), and the fields they can make them on, by
+# the attribute that's compared.
+VIRTUAL_COMPARISONS = {
+    'exact': operator.eq,
+    'gt': operator.gt,
+    'gte': operator.ge,
+    'lt': operator.lt,
+    'lte': operator.le,
+}
+VIRTUAL_FIELDS = {
+    ('pk',): 'pk',
+    ('id',): 'pk',
+    ('start',): 'start',
+    ('_end',): '_end',
+    ('status',): 'status',
+    ('event',): 'event_id',
+    ('event', 'id'): 'event_id',
+    ('event', 'pk'): 'event_id',
+    ('generated_by',): 'generated_by_id',
+    ('generated_by', 'id'): 'generated_by_id',
+    ('generated_by', 'pk'): 'generated_by_id',
+}
+
+def _pk(value):
+    return getattr(value, 'pk', value)
+
+def _virtual_test(kwargs):
+    """
+    Returns a function which makes a test for virtual occurrences that's
+    equivalent to filter(**kwargs), or None if there isn't one. (The test is
+    made each time the virtual occurrences are computed, since 'in' lookups
+    may be given a queryset.)
+    """
+    makers = []
+    for lookup, value in kwargs.items():
+        parts = tuple(lookup.split(LOOKUP_SEP))
+        comparison = 'exact'
+        if parts[-1] in VIRTUAL_COMPARISONS or parts[-1] in ('in', 'isnull'):
+            comparison, parts = parts[-1], parts[:-1]
+        attr = VIRTUAL_FIELDS.get(parts)
+        if attr is None:
+            return None
+        if comparison == 'exact' and value is None:
+            comparison, value = 'isnull', True
+        makers.append(_lookup_test(attr, comparison, value))
+    def make():
+        tests = [maker() for maker in makers]
+        return lambda o: all(test(o) for test in tests)
+    return make
+
+def _lookup_test(attr, comparison, value):
+    if comparison == 'isnull':
+        return lambda: lambda o: (getattr(o, attr) is None) == bool(value)
+    if comparison == 'in':
+        def make():
+            # (iterator(), so that a queryset's results aren't cached)
+            values = set(_pk(v) for v in getattr(value, 'iterator', lambda: value)())
+            return lambda o: getattr(o, attr) in values
+        return make
+    compare = VIRTUAL_COMPARISONS[comparison]
+    return lambda: lambda o: getattr(o, attr) is not None and \
+        compare(getattr(o, attr), _pk(value))
+
+def _negated(make):
+    def make_negated():
+        test = make()
+        return lambda o: not test(o)
+    return make_negated
+
 class OccurrenceQSFN(XTimespanQSFN):
     """
     All the query functions are defined here, so they can be easily introspected
@@ -41,28 +122,408 @@ class OccurrenceQSFN(XTimespanQSFN):
         occurrences.
         """
         event_ids = self.values_list('event_id', flat=True).distinct()
+        if self._with_virtual:
+            event_ids = set(event_ids)
+            event_ids.update(o.event_id for o in self._virtual_occurrences())
         return self.model.EventModel()._event_manager.filter(id__in=event_ids)
 
+    def with_virtual(self, virtual=True):
+        """
+        Includes the virtual occurrences - those after their generators'
+        high-water marks (see settings.MATERIALISATION_WINDOW), which are
+        computed from the generators' rules as this is iterated, rather than
+        saved. The generators are those of the event (or generator) this came
+        from, eg event.occurrences or events.occurrences(), or else all of
+        them. with_virtual(False) leaves them out again.
+
+        The results are in start order, or reverse start order (eg with
+        reverse() or order_by('-start')); at the same start, the saved
+        occurrences come first. Virtual occurrences have no pk until they're
+        materialised (see OccurrenceModel.materialise()), so get() ignores
+        them.
+
+        The start, end and status filters here apply to virtual occurrences,
+        as do filter() and exclude() with keyword lookups on pk, start, _end,
+        status, event and generated_by. Other orderings and filters (eg Q
+        objects, or extra(where=...)) can't, so iterating raises
+        NotImplementedError.
+        """
+        return self._clone(_with_virtual=virtual)
+
+    def with_virtual_in_window(self):
+        """
+        with_virtual(), if settings.MATERIALISATION_WINDOW is set. The event
+        listings, views, feeds and calendars use this, so that they show the
+        occurrences after the window.
+        """
+        if settings.MATERIALISATION_WINDOW:
+            return self.with_virtual()
+        return self._clone()
+
+    def start_dates(self):
+        dates = super(OccurrenceQSFN, self).start_dates()
+        if self._with_virtual:
+            for o in self._virtual_occurrences():
+                dates.add(o.start)
+        return dates
+
+    # The filters below are kept as tests for virtual occurrences too.
+
+    def starts_before(self, date):
+        end = datetimeify(date, clamp="max")
+        return super(OccurrenceQSFN, self._virtual_aware()).starts_before(date)\
+            ._filter_virtual(start_until=end)
+    def starts_after(self, date):
+        start = datetimeify(date, clamp="min")
+        return super(OccurrenceQSFN, self._virtual_aware()).starts_after(date)\
+            ._filter_virtual(start_from=start)
+    before = starts_before
+    after = starts_after
+
+    def ends_before(self, date):
+        end = datetimeify(date, clamp="max")
+        return super(OccurrenceQSFN, self._virtual_aware()).ends_before(date)\
+            ._filter_virtual(lambda o: o._end <= end)
+    def ends_after(self, date):
+        start = datetimeify(date, clamp="min")
+        return super(OccurrenceQSFN, self._virtual_aware()).ends_after(date)\
+            ._filter_virtual(lambda o: o._end >= start)
+
+    def now_on(self):
+        now = datetime.datetime.now()
+        return super(OccurrenceQSFN, self._virtual_aware()).now_on()\
+            ._filter_virtual(lambda o: o.start < now <= o._end)
+
+    def finished(self):
+        now = datetime.datetime.now()
+        return super(OccurrenceQSFN, self._virtual_aware()).finished()\
+            ._filter_virtual(lambda o: o._end < now)
+
+    # virtual occurrences have no status
     def available(self):
-        return self.filter(status__in=("", None))
+        return self._virtual_aware().filter(status__in=("", None))\
+            ._filter_virtual()
 
     def unavailable(self):
-        return self.exclude(status="").exclude(status=None)
+        return self._virtual_aware().exclude(status="").exclude(status=None)\
+            ._filter_virtual(lambda o: False)
 
     def fully_booked(self):
-        return self.filter(status=settings.OCCURRENCE_STATUS_FULLY_BOOKED[0])
+        return self._virtual_aware()\
+            .filter(status=settings.OCCURRENCE_STATUS_FULLY_BOOKED[0])\
+            ._filter_virtual(lambda o: False)
 
     def cancelled(self):
-        return self.filter(status=settings.OCCURRENCE_STATUS_CANCELLED[0])
+        return self._virtual_aware()\
+            .filter(status=settings.OCCURRENCE_STATUS_CANCELLED[0])\
+            ._filter_virtual(lambda o: False)
+
+    def annotate_exclusions(self):
+        """
+        Selects whether each occurrence is excluded (see is_exclusion()), as
+        is_excluded, in the same query.
+        """
+        qn = connection.ops.quote_name
+        OccurrenceModel = self.model
+        ExclusionModel = OccurrenceModel.EventModel().ExclusionModel()
+        def column(model, field_name):
+            return qn(model._meta.get_field(field_name).column)
+        return self.extra(select={'is_excluded': EXCLUDED_SQL % {
+            'exclusion': qn(ExclusionModel._meta.db_table),
+            'exclusion_event': column(ExclusionModel, 'event'),
+            'exclusion_start': column(ExclusionModel, 'start'),
+            'occurrence': qn(OccurrenceModel._meta.db_table),
+            'occurrence_event': column(OccurrenceModel, 'event'),
+            'occurrence_start': column(OccurrenceModel, 'start'),
+        }})
+
+    def delete_or_unhook(self):
+        """
+        The set-based equivalent of calling delete() on each occurrence:
+        occurrences that are protected by a foreign key (eg a ticket) are
+        unhooked from their generator (made one-off) instead of being deleted.
+
+        Returns a tuple of (number deleted, number unhooked).
+        """
+        protected_ids = self._protected_ids()
+        unhooked = 0
+        if protected_ids:
+            unhooked = self.filter(pk__in=protected_ids)\
+                .update(generated_by=None)
+        doomed = self
+        if protected_ids:
+            doomed = self.exclude(pk__in=protected_ids)
+        deleted = doomed.count()
+        if deleted:
+            try:
+                doomed.delete()
+            except models.ProtectedError:
+                # protected in a way _protected_ids() can't see, so fall back
+                # to deleting (or unhooking) them one at a time.
+                deleted = 0
+                for o in doomed:
+                    o.delete()
+                    if o.pk is None:
+                        deleted += 1
+                    else:
+                        unhooked += 1
+        return deleted, unhooked
+
+    def _protected_ids(self):
+        """
+        Returns the set of ids in this queryset that can't be deleted because
+        something points at them with on_delete=PROTECT - either directly,
+        or at something that would be deleted with them (eg a ticket line
+        protecting the ticket for an occurrence).
+        """
+        ids = set()
+        pks = self.values('pk')
+        def find(model, path, seen):
+            # path leads from model to the occurrence
+            for related in model._meta.get_all_related_objects():
+                lookup = related.field.name
+                if path:
+                    lookup = '%s__%s' % (lookup, path)
+                on_delete = related.field.rel.on_delete
+                if on_delete is models.PROTECT:
+                    ids.update(related.model._default_manager.filter(**{
+                        '%s__in' % lookup: pks
+                    }).values_list(lookup, flat=True))
+                elif on_delete is models.CASCADE and related.model not in seen:
+                    find(related.model, lookup, seen | set([related.model]))
+        find(self.model, '', set([self.model]))
+        return ids
 
 class OccurrenceQuerySet(XTimespanQuerySet, OccurrenceQSFN):
-    pass #all the goodness is inherited from OccurrenceQuerySetFN
+    #all the goodness is inherited from OccurrenceQuerySetFN, apart from the
+    #virtual occurrences (see with_virtual()).
+
+    _with_virtual = False
+    _virtual_generators = {} # filter() kwargs for the generators
+    _virtual_range = (None, None) # the first and last starts
+    _virtual_tests = ()
+    _virtual_lookups = () # the (negate, kwargs) of filter() and exclude()
+    _virtual_filtering = False # see _virtual_aware()
+    _virtual_unsupported = None # a filter the virtual occurrences can't have
+
+    def _clone(self, *args, **kwargs):
+        for attr in ('_with_virtual', '_virtual_generators',
+                '_virtual_range', '_virtual_tests', '_virtual_lookups',
+                '_virtual_filtering', '_virtual_unsupported'):
+            kwargs.setdefault(attr, getattr(self, attr))
+        return super(OccurrenceQuerySet, self)._clone(*args, **kwargs)
+
+    def _virtual_aware(self):
+        """
+        Returns a clone whose filters aren't tested on virtual occurrences,
+        until _filter_virtual() adds the equivalent test.
+        """
+        return self._clone(_virtual_filtering=True)
+
+    def _filter_virtual(self, test=None, start_from=None, start_until=None):
+        """
+        Adds a test (and/or limits on the start) for virtual occurrences.
+        Only call this on a new clone.
+        """
+        first, last = self._virtual_range
+        if start_from is not None:
+            first = max(first, start_from) if first else start_from
+        if start_until is not None:
+            last = min(last, start_until) if last else start_until
+        self._virtual_range = (first, last)
+        if test is not None:
+            self._virtual_tests += (test,)
+        self._virtual_filtering = False
+        return self
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        clone = super(OccurrenceQuerySet, self)._filter_or_exclude(
+            negate, *args, **kwargs)
+        if not self._virtual_filtering:
+            if args or _virtual_test(kwargs) is None:
+                clone._virtual_unsupported = "%s(%s)" % (
+                    'exclude' if negate else 'filter',
+                    ", ".join([type(arg).__name__ for arg in args] +
+                        sorted(kwargs)))
+            else:
+                clone._virtual_lookups += ((bool(negate), kwargs),)
+        return clone
+
+    def complex_filter(self, filter_obj):
+        clone = super(OccurrenceQuerySet, self).complex_filter(filter_obj)
+        if not isinstance(filter_obj, dict) and not self._virtual_filtering:
+            clone._virtual_unsupported = "complex_filter(%s)" % \
+                type(filter_obj).__name__
+        return clone
+
+    def extra(self, select=None, where=None, params=None, tables=None,
+            order_by=None, select_params=None):
+        clone = super(OccurrenceQuerySet, self).extra(select, where, params,
+            tables, order_by, select_params)
+        if (where or tables) and not self._virtual_filtering:
+            clone._virtual_unsupported = "extra(where=%r, tables=%r)" % (
+                where, tables)
+        return clone
+
+    def iterator(self):
+        if not self._with_virtual:
+            return super(OccurrenceQuerySet, self).iterator()
+        query = self.query
+        ordering = query.extra_order_by or query.order_by or \
+            (query.default_ordering and self.model._meta.ordering) or ()
+        saved = self
+        if not ordering:
+            saved = self.order_by('start', 'event')
+            descending = not query.standard_ordering
+        elif ordering[0] in ('start', '-start'):
+            descending = (ordering[0] == '-start') == query.standard_ordering
+        else:
+            raise NotImplementedError("Virtual occurrences can only be "
+                "ordered by start, not %s" % (ordering,))
+        virtual = self._virtual_occurrences()
+        if descending:
+            virtual = reversed(list(virtual))
+        return self._merge_virtual(
+            super(OccurrenceQuerySet, saved).iterator(), virtual, descending)
+
+    def _merge_virtual(self, saved, virtual, descending=False):
+        # saved occurrences come first when the starts are the same (and
+        # last, in reverse).
+        def key(o):
+            return o.start, o.pk is None
+        s, v = next(saved, None), next(virtual, None)
+        while s is not None and v is not None:
+            if (key(v) < key(s)) != descending:
+                yield v
+                v = next(virtual, None)
+            else:
+                yield s
+                s = next(saved, None)
+        while s is not None:
+            yield s
+            s = next(saved, None)
+        while v is not None:
+            yield v
+            v = next(virtual, None)
+
+    def _virtual_occurrences(self):
+        """
+        Yields the virtual occurrences, in start order, apart from those that
+        clash with a saved occurrence in their event's listing, an exclusion,
+        or each other.
+        """
+        if self._virtual_unsupported:
+            raise NotImplementedError("Virtual occurrences can't be "
+                "filtered with %s (see OccurrenceQSFN.with_virtual())" %
+                self._virtual_unsupported)
+        OccurrenceModel = self.model
+        EventModel = OccurrenceModel.EventModel()
+        first, last = self._virtual_range
+        generators = EventModel.GeneratorModel()._default_manager\
+            .filter(generated_until__isnull=False, **self._virtual_generators)\
+            .select_related('event', 'rule')
+        after = None
+        if first is not None:
+            after = first - datetime.timedelta(microseconds=1)
+            generators = generators.filter(models.Q(repeat_until=None) |
+                models.Q(repeat_until__gte=first.date()))
+        if last is not None:
+            generators = generators.filter(generated_until__lt=last)
+
+        streams = []
+        for generator in generators:
+            starts = generator._virtual_starts(after, last)
+            if starts:
+                streams.append((generator, starts))
+        if not streams:
+            return
+        first_start = min(starts[0] for generator, starts in streams)
+        last_start = max(starts[-1] for generator, starts in streams)
+
+        # fetch, once each, the taken starts in the events' trees, and the
+        # excluded starts, in the range.
+        mptt_meta = EventModel._mptt_meta
+        tree_id, left, right = mptt_meta.tree_id_attr, mptt_meta.left_attr, \
+            mptt_meta.right_attr
+        events = dict((g.event_id, g.event) for g, starts in streams)
+        taken = {}
+        for tree, lft, start in OccurrenceModel._default_manager.filter(**{
+                    'event__%s__in' % tree_id: set(getattr(e, tree_id)
+                        for e in events.values()),
+                    'start__gte': first_start, 'start__lte': last_start,
+                }).values_list('event__%s' % tree_id, 'event__%s' % left,
+                    'start'):
+            taken.setdefault((tree, start), []).append(lft)
+        excluded = set(EventModel.ExclusionModel()._default_manager.filter(
+            event__in=events.keys(), start__gte=first_start,
+            start__lte=last_start,
+        ).values_list('event_id', 'start'))
+
+        def is_taken(event, start):
+            lfts = taken.get((getattr(event, tree_id), start), ())
+            return any(getattr(event, left) <= lft <= getattr(event, right)
+                for lft in lfts)
+
+        seen = set()
+        tests = list(self._virtual_tests)
+        for negate, kwargs in self._virtual_lookups:
+            make = _virtual_test(kwargs)
+            tests.append((_negated(make) if negate else make)())
+        for start, event_id, i in heapq.merge(*[
+            ((start, generator.event_id, i) for start in starts)
+            for i, (generator, starts) in enumerate(streams)
+        ]):
+            if (event_id, start) in seen or (event_id, start) in excluded or \
+                    is_taken(events[event_id], start):
+                continue
+            seen.add((event_id, start))
+            o = streams[i][0]._virtual_occurrence(start)
+            if all(test(o) for test in tests):
+                yield o
+
+    def count(self):
+        count = super(OccurrenceQuerySet, self).count()
+        if self._with_virtual and self._result_cache is None:
+            count += sum(1 for o in self._virtual_occurrences())
+        return count
+
+    def exists(self):
+        if self._with_virtual and self._result_cache is None:
+            if super(OccurrenceQuerySet, self).exists():
+                return True
+            for o in self._virtual_occurrences():
+                return True
+            return False
+        return super(OccurrenceQuerySet, self).exists()
+
+    def __getitem__(self, k):
+        if not self._with_virtual or self._result_cache is not None:
+            return super(OccurrenceQuerySet, self).__getitem__(k)
+        # the saved occurrences can't be sliced in the database.
+        if isinstance(k, slice):
+            return list(islice(self.iterator(), k.start, k.stop, k.step))
+        for o in islice(self.iterator(), k, None):
+            return o
+        raise IndexError
+
+    def get(self, *args, **kwargs):
+        return super(OccurrenceQuerySet, self._clone(_with_virtual=False))\
+            .get(*args, **kwargs)
 
 class OccurrenceManager(XTimespanManager):
     __metaclass__ = ManagerType(OccurrenceQSFN, supertype=XTimespanManager.__metaclass__,)
 
     def get_query_set(self): 
-        return OccurrenceQuerySet(self.model)
+        qs = OccurrenceQuerySet(self.model)
+        # the related managers of events and generators (eg event.occurrences)
+        # only have their own virtual occurrences.
+        instance = getattr(self, 'instance', None)
+        EventModel = self.model.EventModel()
+        if isinstance(instance, EventModel):
+            qs._virtual_generators = {'event': instance.pk}
+        elif isinstance(instance, EventModel.GeneratorModel()):
+            qs._virtual_generators = {'pk': instance.pk}
+        return qs
 
 class OccurrenceModel(XTimespanModel):
     """
@@ -83,12 +544,20 @@ class OccurrenceModel(XTimespanModel):
     status = models.CharField(max_length=20, blank=True, choices=settings.OCCURRENCE_STATUS_CHOICES)
 
     objects = OccurrenceManager()
+
+    # True for occurrences computed by OccurrenceQuerySet.with_virtual()
+    _virtual = False
     
     class Meta:
         abstract = True
         ordering = ('start', 'event',)
         unique_together = ('start', 'event',)
 
+    def __init__(self, *args, **kwargs):
+        super(OccurrenceModel, self).__init__(*args, **kwargs)
+        # so that if we move to another event, its summary is updated too.
+        self._saved_event_id = self.event_id
+
     def __unicode__(self):
         return u"%s: %s" % (self.event, self.timespan_description())
         
@@ -96,18 +565,75 @@ class OccurrenceModel(XTimespanModel):
     def EventModel(cls):
         return cls._meta.get_field('event').rel.to
 
+    def is_virtual(self):
+        """
+        True if I was computed from a generator's rule, and haven't been saved
+        (see OccurrenceQuerySet.with_virtual()).
+        """
+        return self._virtual and self.pk is None
+
+    def materialise(self):
+        """
+        Returns the saved occurrence for a virtual occurrence, saving it if
+        it hasn't been (eg by another request) - do this before anything
+        that needs a pk, such as attaching a ticket. Saved occurrences return
+        themselves.
+        """
+        if self.pk is not None:
+            return self
+        occurrence, created = type(self)._default_manager.get_or_create(
+            event=self.event, start=self.start, defaults={
+                'generated_by': self.generated_by,
+                '_duration': self._duration,
+                'status': self.status,
+            })
+        return occurrence
+
     def is_exclusion(self):
-        qs = self.event.exclusions.filter(start=self.start)
-        if qs.count():
-            return True
-        return False
+        """
+        True if my event has an exclusion at my start. Occurrences fetched
+        with annotate_exclusions() know already; otherwise it takes a query,
+        the result of which is kept until I'm saved.
+        """
+        if hasattr(self, 'is_excluded'):
+            return bool(self.is_excluded)
+        if not hasattr(self, '_is_exclusion'):
+            ExclusionModel = self.EventModel().ExclusionModel()
+            self._is_exclusion = ExclusionModel._default_manager.filter(
+                event=self.event_id, start=self.start).exists()
+        return self._is_exclusion
         
+    def save(self, *args, **kwargs):
+        """
+        Saving updates the occurrence summaries of my event (and the event I
+        was moved from), unless update_summaries=False is passed - in which
+        case, call EventModel.occurrences_changed() when you're done.
+        """
+        update_summaries = kwargs.pop('update_summaries', True)
+        if self.is_virtual():
+            # (eg a status change) I may have been materialised since I was
+            # computed.
+            self.pk = (type(self)._default_manager.filter(event=self.event_id,
+                start=self.start).values_list('pk', flat=True)[:1] or [None])[0]
+            self._virtual = False
+        # my start or event may have changed
+        self.__dict__.pop('_is_exclusion', None)
+        self.__dict__.pop('is_excluded', None)
+        r = super(OccurrenceModel, self).save(*args, **kwargs)
+        if update_summaries:
+            self.EventModel().occurrences_changed(
+                [self._saved_event_id, self.event_id])
+        self._saved_event_id = self.event_id
+        return r
+
     def delete(self, *args, **kwargs):
         try:
             r = super(OccurrenceModel, self).delete(*args, **kwargs)
         except models.ProtectedError: #can't delete as there is an FK to me. Make one-off..
             self.generated_by = None
             self.save()
+        else:
+            self.EventModel().occurrences_changed([self.event_id])
 
     def is_cancelled(self):
         return self.status == settings.OCCURRENCE_STATUS_CANCELLED[0]
@@ -132,6 +658,8 @@ class OccurrenceModel(XTimespanModel):
         return None
 
     def get_absolute_url(self):
+        if self.is_virtual(): # no pk for the url
+            return self.event.get_absolute_url()
         return reverse('events:occurrence', kwargs={'event_slug': self.event.slug, 'occurrence_pk': self.pk })
 
 
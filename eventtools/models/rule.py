@@ -1,5 +1,7 @@
 import calendar
+import re
 from django.db import models
+from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext, ugettext_lazy as _
 from dateutil import rrule
 from dateutil.relativedelta import weekdays
@@ -11,6 +13,114 @@ freqs = (
     ("DAILY", _("Daily")),
 )
 
+FREQUENCIES = dict((f, getattr(rrule, f)) for f, label in freqs)
+
+# The placeholders that can be used in complex rules. They are substituted
+# with values derived from each generator's start.
+PLACEHOLDER_RE = re.compile(
+    r'(%(?:datetime|date|day|month|year|time|nthday|-nthday)%)'
+)
+
+def parse_params(params):
+    """
+    >>> parse_params("count:1;bysecond:1;byminute:1,2,4,5")
+    {'count': 1, 'byminute': [1, 2, 4, 5], 'bysecond': 1}
+    """
+    if params is None:
+        return {}
+    params = params.split(';')
+    param_dict = []
+    for param in params:
+        param = param.split(':')
+        if len(param) == 2:
+            param = (str(param[0]), [int(p) for p in param[1].split(',')])
+            if len(param[1]) == 1:
+                param = (param[0], param[1][0])
+            param_dict.append(param)
+    return dict(param_dict)
+
+
+class CompiledRule(object):
+    """
+    A Rule definition that has been parsed and validated once, so that rrules
+    can be made cheaply for any number of dtstarts:
+
+    * frequency is the dateutil frequency constant (or None if it isn't valid)
+    * params is the dict of rrule kwargs
+    * template is the complex rule split into literal text and placeholders
+      (or None if there is no complex rule).
+
+    Complex rules depend on dtstart, so their rrules are cached per dtstart.
+    """
+
+    # complex rrules cached per CompiledRule, before the cache is emptied.
+    max_cached_rrules = 1000
+
+    def __init__(self, frequency, params, complex_rule):
+        self.frequency_name = frequency
+        self.frequency = FREQUENCIES.get(frequency)
+        self.params = parse_params(params)
+        if complex_rule:
+            self.template = PLACEHOLDER_RE.split(complex_rule)
+        else:
+            self.template = None
+        self._complex_rrules = {}
+
+    def get_rrule(self, dtstart):
+        if self.template is not None:
+            try:
+                rule = self._complex_rrules[dtstart]
+            except KeyError:
+                try:
+                    rule = rrule.rrulestr(
+                        str(self.render(dtstart)), dtstart=dtstart
+                    )
+                except ValueError: # eg. unsupported property
+                    rule = None
+                if len(self._complex_rrules) >= self.max_cached_rrules:
+                    self._complex_rrules.clear()
+                self._complex_rrules[dtstart] = rule
+            if rule is not None:
+                return rule
+        return self.get_simple_rrule(dtstart)
+
+    def get_simple_rrule(self, dtstart):
+        if self.frequency is None:
+            raise ValueError(
+                "'%s' is not a valid frequency" % self.frequency_name)
+        simple_rule = rrule.rrule(self.frequency, dtstart=dtstart, **self.params)
+        rs = rrule.rruleset()
+        rs.rrule(simple_rule)
+        return rs
+
+    def render(self, dtstart):
+        """
+        Returns the complex rule, with placeholders substituted for dtstart.
+        """
+        d = dtstart.date()
+        weekday = weekdays[d.weekday()]
+        n = 1 + (d.day / 7)
+
+        start_day, days_in_month = calendar.monthrange(d.year, d.month)
+        days_from_end = days_in_month - d.day
+
+        minus_n = -1 - (days_from_end / 7)
+        values = {
+            "%date%": dtstart.strftime("%Y%m%d"),
+            "%day%": dtstart.strftime("%d"),
+            "%month%": dtstart.strftime("%m"),
+            "%year%": dtstart.strftime("%Y"),
+            "%time%": dtstart.strftime("%H%M%S"),
+            "%datetime%": dtstart.strftime("%Y%m%dT%H%M%S"),
+            "%nthday%": "%s%s" % (n, weekday),
+            "%-nthday%": "%s%s" % (minus_n, weekday),
+        }
+        return "".join(values.get(token, token) for token in self.template)
+
+# CompiledRules of saved Rules, by Rule pk. Many generators share a handful of
+# Rules, so this saves reparsing the same definitions over and over.
+_compiled_rules = {}
+
 class Rule(models.Model):
     """
     This defines a rule by which an occurrence will repeat. Parameters
@@ -71,50 +181,48 @@ class Rule(models.Model):
         >>> rule.get_params()
         {'count': 1, 'byminute': [1, 2, 4, 5], 'bysecond': 1}
         """
-        params = self.params
-        if params is None:
-            return {}
-        params = params.split(';')
-        param_dict = []
-        for param in params:
-            param = param.split(':')
-            if len(param) == 2:
-                param = (str(param[0]), [int(p) for p in param[1].split(',')])
-                if len(param[1]) == 1:
-                    param = (param[0], param[1][0])
-                param_dict.append(param)
-        return dict(param_dict)
+        return parse_params(self.params)
         
     def __unicode__(self):
         """Human readable string for Rule"""
         return self.name or unicode(self.frequency).lower()
-    
+
+    def clean(self):
+        try:
+            compiled = CompiledRule(
+                self.frequency, self.params, self.complex_rule)
+        except ValueError:
+            raise ValidationError(
+                'Parameters must be of the form "rruleparam:value[,value];"')
+        if compiled.frequency is None and not self.complex_rule:
+            raise ValidationError('A frequency or a complex rule must be given')
+
+    def save(self, *args, **kwargs):
+        _compiled_rules.pop(self.pk, None)
+        return super(Rule, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        _compiled_rules.pop(self.pk, None)
+        return super(Rule, self).delete(*args, **kwargs)
+
+    def compile(self):
+        """
+        Returns the CompiledRule for this rule. For saved rules, this is
+        cached until the rule is saved again (or its definition is changed).
+        """
+        definition = (self.frequency, self.params, self.complex_rule)
+        if self.pk is None:
+            return CompiledRule(*definition)
+        try:
+            cached_definition, compiled = _compiled_rules[self.pk]
+        except KeyError:
+            pass
+        else:
+            if cached_definition == definition:
+                return compiled
+        compiled = CompiledRule(*definition)
+        _compiled_rules[self.pk] = (definition, compiled)
+        return compiled
+
     def get_rrule(self, dtstart):
-        if self.complex_rule:
-            d = dtstart.date()
-            weekday = weekdays[d.weekday()]
-            n = 1 + (d.day / 7)
-
-            start_day, days_in_month = calendar.monthrange(d.year, d.month)
-            days_from_end = days_in_month - d.day
-
-            minus_n = -1 - (days_from_end / 7)
-            cr = self.complex_rule \
-                .replace("%date%", dtstart.strftime("%Y%m%d")) \
-                .replace("%day%", dtstart.strftime("%d")) \
-                .replace("%month%", dtstart.strftime("%m")) \
-                .replace("%year%", dtstart.strftime("%Y")) \
-                .replace("%time%", dtstart.strftime("%H%M%S")) \
-                .replace("%datetime%", dtstart.strftime("%Y%m%dT%H%M%S")) \
-                .replace("%nthday%", "%s%s" % (n, weekday)) \
-                .replace("%-nthday%", "%s%s" % (minus_n, weekday))
-            try:
-                return rrule.rrulestr(str(cr), dtstart=dtstart)
-            except ValueError: # eg. unsupported property 
-                pass
-        params = self.get_params()
-        frequency = 'rrule.%s' % self.frequency
-        simple_rule = rrule.rrule(eval(frequency), dtstart=dtstart, **params)
-        rs = rrule.rruleset()
-        rs.rrule(simple_rule)
-        return rs
+        return self.compile().get_rrule(dtstart)
@@ -1,9 +1,11 @@
 import datetime
 
 from django.db import models
+from django.db.models import F
 from django.utils.translation import ugettext as _
 from eventtools.utils import datetimeify
 from eventtools.utils.datetimeify import dayify
+from eventtools.utils.dateset import DateSet
 from eventtools.utils.managertype import ManagerType
 from eventtools.utils.pprint_timespan import pprint_datetime_span, pprint_time_span
 from django.utils.safestring import mark_safe
@@ -43,8 +45,80 @@ class XTimespanQSFN(object):
     def recent(self):
         return self.starts_before(datetime.datetime.now())
 
+    def start_dates(self):
+        """
+        Returns a DateSet of the days that these start on, from one query.
+        """
+        return DateSet.from_occurrences(self)
+
+    #queries on the stored end
+    def ends_before(self, date):
+        end = datetimeify(date, clamp="max")
+        return self.filter(_end__lte=end)
+    def ends_after(self, date):
+        start = datetimeify(date, clamp="min")
+        return self.filter(_end__gte=start)
+
+    def overlapping(self, d1, d2):
+        """
+        returns the timespans that are on at some time in a given
+        date/datetime range, ie that start before it ends, and end after it
+        starts.
+        """
+        return self.starts_before(d2).ends_after(d1)
+
+    def now_on(self):
+        now = datetime.datetime.now()
+        return self.filter(start__lt=now, _end__gte=now)
+
+    def finished(self):
+        return self.filter(_end__lt=datetime.datetime.now())
+
+    def sync_end(self):
+        """
+        Recalculates the stored end of the timespans in this queryset, with
+        one UPDATE per distinct duration.
+        """
+        durations = self.order_by().values_list('_duration', flat=True)\
+            .distinct()
+        for duration in list(durations):
+            self.filter(_duration=duration).update(
+                _end=F('start') + datetime.timedelta(minutes=duration or 0)
+            )
+
 class XTimespanQuerySet(models.query.QuerySet, XTimespanQSFN):
-    pass #all the goodness is inherited from XTimespanQSFN
+    # some backends (eg sqlite) limit the number of parameters in a query, so
+    # bulk inserts are split into batches of this many rows.
+    bulk_create_batch_size = 100
+
+    def bulk_create(self, objs):
+        objs = list(objs)
+        for o in objs:
+            o._end = o.end() if o.start is not None else None
+        size = self.bulk_create_batch_size
+        for i in range(0, len(objs), size):
+            super(XTimespanQuerySet, self).bulk_create(objs[i:i+size])
+        return objs
+
+    def update(self, **kwargs):
+        """
+        Updated rows are marked as modified now (unless `modified` is given).
+
+        If start or _duration are updated (and _end isn't), the stored end
+        of the updated rows is recalculated afterwards.
+        """
+        kwargs.setdefault('modified', datetime.datetime.now())
+        if '_end' in kwargs or \
+                ('start' not in kwargs and '_duration' not in kwargs):
+            return super(XTimespanQuerySet, self).update(**kwargs)
+
+        pks = list(self.values_list('pk', flat=True))
+        rows = super(XTimespanQuerySet, self).update(**kwargs)
+        manager = self.model._default_manager
+        size = self.bulk_create_batch_size
+        for i in range(0, len(pks), size):
+            manager.filter(pk__in=pks[i:i+size]).sync_end()
+        return rows
 
 class XTimespanManager(models.Manager):
     __metaclass__ = ManagerType(XTimespanQSFN)
@@ -56,6 +130,11 @@ class XTimespanManager(models.Manager):
 class XTimespanModel(models.Model):
     start = models.DateTimeField(db_index=True)
     _duration = models.PositiveIntegerField(_("duration (mins)"), blank=True, null=True, help_text=_("to create 'all day' events, set start time to 00:00 and leave duration blank"))
+    # start + duration, stored so that it can be queried. It is kept up to
+    # date by save(), and by XTimespanQuerySet's update() and bulk_create().
+    _end = models.DateTimeField(null=True, editable=False, db_index=True)
+    # when the row was last changed, for conditional GETs.
+    modified = models.DateTimeField(auto_now=True, editable=False, db_index=True)
 
     objects = XTimespanManager()
 
@@ -63,6 +142,11 @@ class XTimespanModel(models.Model):
         abstract = True
         ordering = ('start', )
 
+    def save(self, *args, **kwargs):
+        # leave a missing start to the database's NOT NULL constraint.
+        self._end = self.end() if self.start is not None else None
+        return super(XTimespanModel, self).save(*args, **kwargs)
+
     def get_duration(self):
         """
         _duration is a value in minutes. The duration property returns a 
@@ -21,6 +21,24 @@ ICAL_CALDESC = "Events listing" #e.g. "Events listing from mysite.com"
 from dateutil.relativedelta import relativedelta
 DEFAULT_GENERATOR_LIMIT = relativedelta(years=1) #months=6, etc
 
+# If set (eg relativedelta(months=2)), generators only save occurrences up to
+# this far ahead. Later ones, up to DEFAULT_GENERATOR_LIMIT, are 'virtual' -
+# they're computed when asked for (see OccurrenceQuerySet.with_virtual(), which
+# event listings, views, feeds and calendars use), and saved when needed (see
+# OccurrenceModel.materialise()).
+MATERIALISATION_WINDOW = None
+
+# If True, generator syncs deferred by eventtools.sync (eg with
+# DeferredSyncMiddleware) are run by a background worker thread, rather than
+# at the end of the request.
+GENERATOR_SYNC_QUEUE = False
+
+# The cache used by EventViews for the occurrences they render (see
+# eventtools.caching). None means a local-memory cache; otherwise, give an
+# alias from CACHES, or a backend path. Set the timeout to 0 to turn it off.
+OCCURRENCE_CACHE_BACKEND = None
+OCCURRENCE_CACHE_TIMEOUT = 60 * 5
+
 OCCURRENCE_STATUS_CANCELLED =  ('cancelled', 'Cancelled')
 OCCURRENCE_STATUS_FULLY_BOOKED = ('fully booked', 'Fully Booked')
 
@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent once (with the Occurrence model as sender) when a generator moves all
+# of its occurrences to a new time or duration. The occurrences are updated
+# with set-based queries, so no per-occurrence save signals are sent;
+# listen to this to invalidate anything derived from occurrence times.
+occurrences_timeshifted = Signal(
+    providing_args=["generator", "start_shift", "duration", "occurrence_ids"]
+)
@@ -0,0 +1,164 @@
+"""
+Saving an event or a generator re-syncs the occurrences of (some of) the
+event's generators. Saving several of them in one request would sync the same
+generators over and over, so the coordinator here can defer the syncs: while
+deferred, saves just mark their event as dirty, and when the outermost
+deferred block ends each dirty event has all of its generators synced once.
+
+Use DeferredSyncMiddleware to defer for the whole of a request, or:
+
+from eventtools.sync import coordinator
+with coordinator.deferred():
+    ...
+
+If settings.GENERATOR_SYNC_QUEUE is True, the deferred syncs are handed to a
+background worker thread instead of being run when the block ends.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from Queue import Queue
+
+from django.db import connection
+
+from eventtools.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def resync_events(EventModel, event_ids):
+    """
+    Syncs every generator of the given events, once each.
+    """
+    GeneratorModel = EventModel.GeneratorModel()
+    generators = GeneratorModel._default_manager\
+        .filter(event__in=event_ids)\
+        .select_related('event', 'rule')\
+        .order_by('event', 'start', 'pk')
+    for generator in generators:
+        generator._sync_occurrences()
+
+
+class SyncWorker(object):
+    """
+    An in-process stand-in for a job queue: a daemon thread that runs
+    resync_events for each job put on the queue.
+    """
+    def __init__(self):
+        self.queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, EventModel, event_ids):
+        self._start()
+        self.queue.put((EventModel, event_ids))
+
+    def join(self):
+        """
+        Blocks until all the queued syncs are done.
+        """
+        self.queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            EventModel, event_ids = self.queue.get()
+            try:
+                resync_events(EventModel, event_ids)
+            except Exception:
+                logger.exception("Couldn't sync generators for %s %s" % (
+                    EventModel.__name__, event_ids))
+            finally:
+                # the thread has its own connection; don't leave it open.
+                connection.close()
+                self.queue.task_done()
+
+
+class SyncCoordinator(object):
+
+    def __init__(self):
+        self._local = threading.local()
+        self.worker = SyncWorker()
+
+    def _state(self):
+        state = self._local
+        if not hasattr(state, 'depth'):
+            state.depth = 0
+            state.dirty = {}
+        return state
+
+    def is_deferred(self):
+        return self._state().depth > 0
+
+    def mark_dirty(self, event):
+        """
+        Records that all of event's generators need syncing. If we're not
+        deferring, they are synced straight away.
+        """
+        if self.is_deferred():
+            self._state().dirty.setdefault(type(event), set()).add(event.pk)
+        else:
+            resync_events(type(event), [event.pk])
+
+    def begin(self):
+        self._state().depth += 1
+
+    def reset(self):
+        """
+        Forgets any deferred blocks left open on this thread, and their dirty
+        events, eg by a request whose response middleware never ran.
+        """
+        state = self._state()
+        if state.depth:
+            logger.warning("Discarding %s unfinished deferred sync block(s)"
+                % state.depth)
+        state.depth = 0
+        state.dirty = {}
+
+    def end(self):
+        """
+        Ends a deferred block. If it's the outermost one, the dirty events are
+        synced (or queued).
+        """
+        state = self._state()
+        state.depth = max(state.depth - 1, 0)
+        if state.depth == 0:
+            self.flush()
+
+    def discard(self):
+        """
+        Ends a deferred block without syncing, eg if the transaction was
+        rolled back.
+        """
+        state = self._state()
+        state.depth = max(state.depth - 1, 0)
+        if state.depth == 0:
+            state.dirty = {}
+
+    def flush(self):
+        state = self._state()
+        dirty, state.dirty = state.dirty, {}
+        for EventModel, event_ids in dirty.items():
+            if settings.GENERATOR_SYNC_QUEUE:
+                self.worker.put(EventModel, event_ids)
+            else:
+                resync_events(EventModel, event_ids)
+
+    @contextmanager
+    def deferred(self):
+        self.begin()
+        try:
+            yield
+        except:
+            self.discard()
+            raise
+        else:
+            self.end()
+
+coordinator = SyncCoordinator()
@@ -9,13 +9,85 @@ from dateutil.relativedelta import *
 from django import template
 from django.template.context import RequestContext
 from django.template import TemplateSyntaxError
-from django.core.urlresolvers import reverse
+from django.core.urlresolvers import reverse, get_urlconf, get_script_prefix
 
 from eventtools.conf import settings as eventtools_settings
 from eventtools.models import EventModel, OccurrenceModel
+from eventtools.utils.dateset import DateSet
 
 register = template.Library()
 
+# month grids and on_date urls cached (per process) before the caches are
+# emptied.
+MAX_CACHED_MONTHS = 1000
+MAX_CACHED_URLS = 10000
+
+_month_grids = {}
+_on_date_urls = {}
+
+def _url_key():
+    # reverse() depends on the urlconf (which can be set per request) and on
+    # the script prefix.
+    return (get_urlconf(), get_script_prefix())
+
+def on_date_url(day):
+    """
+    reverse('events:on_date') for day, memoised per urlconf.
+    """
+    key = _url_key() + (day.year, day.month, day.day)
+    try:
+        return _on_date_urls[key]
+    except KeyError:
+        url = reverse('events:on_date', args=(
+            day.year,
+            day.month,
+            day.day,
+        ))
+        if len(_on_date_urls) >= MAX_CACHED_URLS:
+            _on_date_urls.clear()
+        _on_date_urls[key] = url
+        return url
+
+def month_grid(year, month, firstweekday=None):
+    """
+    Returns the weeks of a month (as full weeks), each a list of seven
+    (date, classes, data) tuples, where classes are the ones that don't depend
+    on occurrences or on today - the day of the week, and 'last_month' or
+    'next_month' for leading and trailing days - and data is the ISO date.
+
+    Grids are cached, so don't change them.
+    """
+    if firstweekday is None:
+        firstweekday = eventtools_settings.FIRST_DAY_OF_WEEK
+    key = (year, month, firstweekday)
+    try:
+        return _month_grids[key]
+    except KeyError:
+        pass
+
+    cal = pycal.Calendar(firstweekday)
+    # cal is a list of the weeks in the month of the year as full weeks.
+    # Weeks are lists of seven dates
+    weeks = []
+    for week in cal.monthdatescalendar(year, month):
+        grid_week = []
+        for wday in week:
+            #day of the week class
+            classes = set([wday.strftime('%A').lower()])
+            if wday.month != month:
+                if (wday.year, wday.month) < (year, month):
+                    classes.add('last_month')
+                else:
+                    classes.add('next_month')
+            #ISO class
+            grid_week.append((wday, frozenset(classes), wday.isoformat()))
+        weeks.append(grid_week)
+
+    if len(_month_grids) >= MAX_CACHED_MONTHS:
+        _month_grids.clear()
+    _month_grids[key] = weeks
+    return weeks
+
 def DATE_HREF_FACTORY(test_dates=True, dates=[]):
     """
     If test_dates is True, then URLs will only be returned if the day is in the
@@ -28,11 +100,7 @@ def DATE_HREF_FACTORY(test_dates=True, dates=[]):
         Given a day, return a URL to navigate to.
         """
         if (test_dates and day in dates) or (not test_dates):
-            return reverse('events:on_date', args=(
-                day.year, 
-                day.month,
-                day.day,
-            ))
+            return on_date_url(day)
         return None
     return f
 
@@ -121,28 +189,19 @@ def calendar(
     if isinstance(day, OccurrenceModel):
         day = day.start.date()
 
-    cal = pycal.Calendar(eventtools_settings.FIRST_DAY_OF_WEEK)
-    # cal is a list of the weeks in the month of the year as full weeks. 
-    # Weeks are lists of seven dates
-    weeks = cal.monthdatescalendar(day.year, day.month)
+    # the static part of the month is cached; only the classes that depend on
+    # occurrences (and today) are added here.
+    weeks = month_grid(day.year, day.month)
     
     # Transform into decorated dates
     decorated_weeks = []
     for week in weeks:
         decorated_week = []
-        for wday in week:
+        for wday, static_classes, data in week:
             classes = set(date_class_fn(wday))
+            classes.update(static_classes)
             if wday == today:
                 classes.add('today')
-            if wday.month != day.month:
-                if wday < day:
-                    classes.add('last_month')
-                if wday > day:
-                    classes.add('next_month')
-            #day of the week class
-            classes.add(wday.strftime('%A').lower())
-            #ISO class
-            data = wday.isoformat()
             
             decorated_week.append(
                 DecoratedDate(
@@ -173,6 +232,15 @@ def calendar(
     return context
 
 
+def _occurrence_days(occurrence_qs):
+    """
+    The DateSet of days that occurrence_qs start on - with the virtual
+    occurrences, if it's a queryset and there's a MATERIALISATION_WINDOW.
+    """
+    if hasattr(occurrence_qs, 'with_virtual_in_window'):
+        return occurrence_qs.with_virtual_in_window().start_dates()
+    return DateSet.from_occurrences(occurrence_qs)
+
 def nav_calendar(
         context, date=None, occurrence_qs=[],
         date_href_fn=None,
@@ -185,10 +253,7 @@ def nav_calendar(
     """
     
     #TODO: allow dates, not just occurrence_qs
-    if occurrence_qs:
-        occurrence_days = [o.start.date() for o in occurrence_qs]
-    else:
-        occurrence_days = []
+    occurrence_days = _occurrence_days(occurrence_qs)
     
     if date_href_fn is None:
         date_href_fn = DATE_HREF_FACTORY(dates=occurrence_days)
@@ -217,8 +282,10 @@ def nav_calendars(
     """
     
     #TODO: allow dates, not just occurrence_qs
-    if date_class_fn is None and occurrence_qs:
-        occurrence_days = [o.start.date() for o in occurrence_qs]
+    # one query gets all the days, which also give the range of months.
+    occurrence_days = _occurrence_days(occurrence_qs)
+
+    if date_class_fn is None and occurrence_days:
         if selected_occurrence:
             date_class_fn = DATE_CLASS_HIGHLIGHT_FACTORY(occurrence_days, selected_occurrence.start.date())
         else:
@@ -226,9 +293,9 @@ def nav_calendars(
 
 
     calendars = []
-    if occurrence_qs.count() > 0:
-        first_date = occurrence_qs[0].start.date()
-        last_date = occurrence_qs.reverse()[0].start.date()
+    if occurrence_days:
+        first_date = occurrence_days.first()
+        last_date = occurrence_days.last()
     else:
         first_date = last_date = datetime.date.today()
     first_month = datetime.date(first_date.year, first_date.month, 1)
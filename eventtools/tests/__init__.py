@@ -1,3 +1,7 @@
 from models import *
 from utils import *
-from views import *
\ No newline at end of file
+from views import *
+from caching import *
+from ical import *
+from sync import *
+from benchmarks import *
\ No newline at end of file
@@ -0,0 +1,158 @@
+# -*- coding: utf-8“ -*-
+"""
+Benchmarks. These are slow, so they're skipped unless the
+EVENTTOOLS_BENCHMARKS environment variable is set, eg:
+
+EVENTTOOLS_BENCHMARKS=1 ./manage.py test eventtools
+"""
+import os
+import time as timer
+from datetime import datetime, timedelta
+
+import inspect
+
+from django.db import models
+from django.utils.unittest import skipUnless
+
+from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
+from eventtools.tests.eventtools_testapp.models import *
+
+RUN_BENCHMARKS = bool(os.environ.get('EVENTTOOLS_BENCHMARKS'))
+
+def _time(f, repeat=3):
+    """
+    Returns the result of f(), and the best time of `repeat` runs.
+    """
+    best = None
+    for i in range(repeat):
+        t = timer.time()
+        result = f()
+        t = timer.time() - t
+        if best is None or t < best:
+            best = t
+    return result, best
+
+def _report(name, timings):
+    print "\n%s:" % name
+    for label, t in timings:
+        print "    %-30s %8.4fs" % (label, t)
+
+def build_event_forest(num_trees=2000, depth=5):
+    """
+    Creates num_trees chains of depth events (so 10,000 events by default),
+    bypassing MPTT's per-insert tree updates. Each tree has occurrences
+    attached at a different level (or none), plus one more level down, so
+    that some listed events have occurrences in their descendants too.
+    """
+    events = []
+    occurrences = []
+    start = datetime(2011, 1, 1, 10, 0)
+    for tree in range(num_trees):
+        listed_level = tree % (depth + 1) # depth means 'not listed'
+        for level in range(depth):
+            pk = tree * depth + level + 1
+            events.append(ExampleEvent(
+                pk=pk,
+                parent_id=pk - 1 if level else None,
+                title="Event %s.%s" % (tree, level),
+                slug="event-%s-%s" % (tree, level),
+                tree_id=tree + 1,
+                level=level,
+                lft=level + 1,
+                rght=2 * depth - level,
+            ))
+            if level in (listed_level, listed_level + 1):
+                occurrences.append(ExampleOccurrence(
+                    event_id=pk,
+                    start=start + timedelta(days=tree, hours=level),
+                    _duration=60,
+                ))
+    for i in range(0, len(events), 100):
+        ExampleEvent.objects.bulk_create(events[i:i+100])
+    ExampleOccurrence.objects.bulk_create(occurrences)
+
+
+def in_listings_by_level(qs):
+    """
+    The previous EventQuerySet.in_listings(), which goes through the tree
+    breadth-first, with a query (or two) per level.
+    """
+    max_level = qs.aggregate(models.Max('level'))['level__max']
+
+    result = qs.filter(level=0).having_occurrences()
+    remaining = qs.filter(level=0).having_no_occurrences()
+
+    for level in range(1, max_level+1):
+        if remaining:
+            result |= qs.filter(parent__in=remaining).having_occurrences()
+            remaining = qs.filter(parent__in=remaining).having_no_occurrences()
+
+    return result
+
+
+@skipUnless(RUN_BENCHMARKS, "set EVENTTOOLS_BENCHMARKS to run benchmarks")
+class BenchmarkInListings(AppTestCase):
+
+    def setUp(self):
+        super(BenchmarkInListings, self).setUp()
+        build_event_forest()
+
+    def test_in_listings(self):
+        qs = ExampleEvent.eventobjects.all()
+        old, old_time = _time(lambda: set(in_listings_by_level(qs).values_list('pk', flat=True)))
+        new, new_time = _time(lambda: set(qs.in_listings().values_list('pk', flat=True)))
+        _report("in_listings() on a 10,000 event tree", [
+            ("by level", old_time),
+            ("single query", new_time),
+        ])
+        self.ae(old, new)
+        self.ae(len(new), len([t for t in range(2000) if t % 6 != 5]))
+
+
+class FrameWalkingDefault(object):
+    """
+    The previous way inherited fields got their parent's values: a default
+    that walks up the call stack looking for a 'parent' kwarg.
+    """
+    def __init__(self, old_default):
+        self.old_default = old_default
+
+    def __call__(self):
+        frame = inspect.currentframe().f_back
+        field = frame.f_locals.get('self', None)
+        frame = frame.f_back
+        while frame is not None:
+            kwargs = frame.f_locals.get('kwargs')
+            if isinstance(kwargs, dict) and 'parent' in kwargs:
+                return getattr(kwargs['parent'], field.attname)
+            frame = frame.f_back
+        return self.old_default
+
+
+@skipUnless(RUN_BENCHMARKS, "set EVENTTOOLS_BENCHMARKS to run benchmarks")
+class BenchmarkInheritedFields(AppTestCase):
+
+    def test_child_instantiation(self):
+        parent = ExampleEvent.eventobjects.create(title="Parent", slug="parent")
+        def instantiate():
+            return [ExampleEvent(parent=parent, slug="child-%s" % i)
+                for i in range(10000)]
+
+        field = ExampleEvent._meta.get_field('title')
+        inherited_fields = ExampleEvent._event_meta.inherited_fields
+        old_default = field.default
+        field.default = FrameWalkingDefault(old_default)
+        ExampleEvent._event_meta.inherited_fields = ()
+        try:
+            old, old_time = _time(instantiate)
+        finally:
+            field.default = old_default
+            ExampleEvent._event_meta.inherited_fields = inherited_fields
+        new, new_time = _time(instantiate)
+
+        _report("instantiating 10,000 child events", [
+            ("frame-walking default", old_time),
+            ("explicit inheritance", new_time),
+        ])
+        self.ae([e.title for e in old], [e.title for e in new])
+        self.ae(new[0].title, "Parent")
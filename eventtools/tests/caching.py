@@ -0,0 +1,76 @@
+# -*- coding: utf-8“ -*-
+from datetime import date, datetime
+from random import randint
+
+from eventtools.caching import occurrence_cache
+from eventtools.models import Rule
+from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
+from eventtools.tests.eventtools_testapp.models import *
+# after the test app's models, which bring in django.conf's settings
+from eventtools.conf import settings
+
+class TestOccurrenceCache(AppTestCase):
+
+    def setUp(self):
+        super(TestOccurrenceCache, self).setUp()
+        self.calls = 0
+        # pks are reused between tests, but the cache isn't emptied
+        self.token = randint(0, 1000000000)
+        self.talk = ExampleEvent.eventobjects.create(title="Talk", slug="talk")
+        self.tour = ExampleEvent.eventobjects.create(title="Tour", slug="tour")
+        self.talk_occurrence = self.talk.occurrences.create(start=datetime(2011,1,1,10,0))
+
+    def _get(self, event=None, parts=()):
+        def f():
+            self.calls += 1
+            return self.calls
+        return occurrence_cache.get_or_set('test', parts + (self.token,), f, ExampleEvent,
+            event_id=event and event.pk)
+
+    def test_read_through(self):
+        self.ae(self._get(), 1)
+        self.ae(self._get(), 1)
+        self.ae(self._get(parts=(date(2011,1,1),)), 2)
+        self.ae(self._get(self.talk), 3)
+        self.ae(self._get(self.talk), 3)
+
+    def test_generations(self):
+        """
+        Changing an event's occurrences, generators or exclusions invalidates
+        what's cached for it, and for the listings, but not for other events.
+        """
+        self.ae(self._get(), 1)
+        self.ae(self._get(self.talk), 2)
+        self.ae(self._get(self.tour), 3)
+
+        self.talk_occurrence.start = datetime(2011,1,1,11,0)
+        self.talk_occurrence.save()
+        self.ae(self._get(), 4)
+        self.ae(self._get(self.talk), 5)
+        self.ae(self._get(self.tour), 3)
+
+        self.tour.exclusions.create(start=datetime(2011,1,2,10,0))
+        self.ae(self._get(self.tour), 6)
+        self.ae(self._get(self.talk), 5)
+
+        weekly = Rule.objects.create(frequency="WEEKLY")
+        self.tour.generators.create(start=datetime(2011,1,2,10,0), _duration=60,
+            rule=weekly, repeat_until=date(2011,1,30))
+        self.ae(self._get(self.tour), 7)
+        self.ae(self._get(), 8)
+
+        # queryset updates go through occurrences_changed()
+        self.talk.occurrences.update(status='cancelled')
+        self.ae(self._get(self.talk), 5)
+        ExampleEvent.occurrences_changed([self.talk.pk])
+        self.ae(self._get(self.talk), 9)
+
+    def test_disabled(self):
+        old_timeout = settings.OCCURRENCE_CACHE_TIMEOUT
+        from django.conf import settings as django_settings
+        django_settings.OCCURRENCE_CACHE_TIMEOUT = 0
+        try:
+            self.ae(self._get(), 1)
+            self.ae(self._get(), 2)
+        finally:
+            django_settings.OCCURRENCE_CACHE_TIMEOUT = old_timeout
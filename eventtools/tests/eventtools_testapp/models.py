@@ -25,4 +25,12 @@ class ExampleExclusion(ExclusionModel):
 
 class ExampleTicket(models.Model):
     # used to test that an occurrence is unhooked rather than deleted.
-    occurrence = models.ForeignKey(ExampleOccurrence, on_delete=models.PROTECT)
\ No newline at end of file
+    occurrence = models.ForeignKey(ExampleOccurrence, on_delete=models.PROTECT)
+
+class ExampleBooking(models.Model):
+    # deleted with its occurrence...
+    occurrence = models.ForeignKey(ExampleOccurrence)
+
+class ExampleBookingPayment(models.Model):
+    # ...unless it has been paid for.
+    booking = models.ForeignKey(ExampleBooking, on_delete=models.PROTECT)
@@ -2,10 +2,8 @@ from models import ExampleEvent, ExampleOccurrence
 from eventtools.views import EventViews
 from django.conf.urls.defaults import *
 
-class TestEventViews(EventViews):
-    occurrence_qs = ExampleOccurrence.objects.all()
-    event_qs = ExampleEvent.eventobjects.all()
-    
-views = TestEventViews()
-    
-urlpatterns = views.get_urls()
\ No newline at end of file
+views = EventViews(ExampleEvent.eventobjects.all(), ExampleOccurrence.objects.all())
+
+urlpatterns = patterns('',
+    url(r'^events/', include(views.urls)),
+)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8“ -*-
+from datetime import datetime
+
+from django.test.client import RequestFactory
+
+from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
+from eventtools.tests.eventtools_testapp.models import *
+from eventtools.views import EventViews
+from eventtools.utils.ical import ICalWriter, fold, escape_text
+from eventtools.utils.viewutils import response_as_ical
+
+class TestICal(AppTestCase):
+
+    def setUp(self):
+        super(TestICal, self).setUp()
+        self.request = RequestFactory().get('/events/ical.ics')
+        self.tour = ExampleEvent.eventobjects.create(title="Daily Tour", slug="daily-tour")
+        for day in range(1, 8):
+            self.tour.occurrences.create(start=datetime(2010, 1, day))
+        self.talk = ExampleEvent.eventobjects.create(title="Talk; with questions", slug="talk")
+        self.talk_occurrence = self.talk.occurrences.create(
+            start=datetime(2010, 1, 1, 10, 0), _duration=90, status='cancelled')
+
+    def test_lines(self):
+        self.ae(fold(u"SUMMARY:short"), "SUMMARY:short\r\n")
+        long_line = u"DESCRIPTION:" + u"é" * 100
+        folded = fold(long_line)
+        for line in folded.split("\r\n")[:-1]:
+            self.assertTrue(len(line) <= 75)
+        self.ae(folded.replace("\r\n ", "").decode('utf-8'), long_line + u"\r\n")
+        self.ae(escape_text(u"a,b;c\\d\ne"), u"a\\,b\;c\\\\d\\ne")
+
+    def test_stream(self):
+        """
+        The calendar is written in chunks of occurrences.
+        """
+        chunks = list(ICalWriter(self.request).stream(
+            ExampleOccurrence.objects.all(), chunk_size=3))
+        # header, 2 full chunks of 3 and the last 2 with the footer
+        self.ae(len(chunks), 4)
+        ical = "".join(chunks)
+        self.assertTrue(ical.startswith("BEGIN:VCALENDAR\r\nVERSION:2.0\r\n"))
+        self.assertTrue(ical.endswith("END:VCALENDAR\r\n"))
+        self.ae(ical.count("BEGIN:VEVENT"), 8)
+        self.ae(ical.count("SUMMARY:Daily Tour"), 7)
+        self.assertTrue("DTSTART;VALUE=DATE:20100101\r\nDTEND;VALUE=DATE:20100102\r\n" in ical)
+        self.assertTrue("SUMMARY:Talk\; with questions" in ical)
+        self.ae(ical.count("STATUS:CANCELLED"), 1)
+        self.ae(ical.count("UID:occurrence-%s@testserver" % self.talk_occurrence.pk), 1)
+
+    def test_response(self):
+        response = response_as_ical(self.request, self.talk_occurrence)
+        self.ae(response['Content-Disposition'], 'attachment; filename=events.ics')
+        content = "".join(response)
+        self.ae(content.count("BEGIN:VEVENT"), 1)
+
+    def test_conditional_get(self):
+        """
+        Feeds (and pages) that haven't changed get a 304 Not Modified.
+        """
+        views = EventViews(ExampleEvent.eventobjects.all(), ExampleOccurrence.objects.all())
+        feed = views._conditional(views.occurrence_list_ical, views.occurrence_list_validators)
+        factory = RequestFactory()
+        GET = {'startdate': '2010-01-01'}
+
+        response = feed(factory.get('/events/ical.ics', GET))
+        self.ae(response.status_code, 200)
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        response = feed(factory.get('/events/ical.ics', GET, HTTP_IF_NONE_MATCH=etag))
+        self.ae(response.status_code, 304)
+
+        # other windows are validated separately
+        response = feed(factory.get('/events/ical.ics', {'startdate': '2010-01-02'}, HTTP_IF_NONE_MATCH=etag))
+        self.ae(response.status_code, 200)
+
+        # changing (even with a queryset update) or adding occurrences changes the ETag
+        ExampleOccurrence.objects.filter(pk=self.talk_occurrence.pk).update(status='')
+        response = feed(factory.get('/events/ical.ics', GET, HTTP_IF_NONE_MATCH=etag))
+        self.ae(response.status_code, 200)
+        etag = response['ETag']
+        occurrence = self.talk.occurrences.create(start=datetime(2010, 1, 2, 10, 0))
+        response = feed(factory.get('/events/ical.ics', GET, HTTP_IF_NONE_MATCH=etag))
+        self.ae(response.status_code, 200)
+        etag = response['ETag']
+
+        # ...and so does deleting them, though the latest modification of the
+        # rest doesn't change, so If-Modified-Since isn't enough to go on.
+        occurrence.delete()
+        response = feed(factory.get('/events/ical.ics', GET, HTTP_IF_NONE_MATCH=etag))
+        self.ae(response.status_code, 200)
+        response = feed(factory.get('/events/ical.ics', GET,
+            HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT'))
+        self.ae(response.status_code, 200)
+
+        # ...as does changing the exclusions (or generators), which may
+        # change occurrences that aren't saved yet.
+        etag = response['ETag']
+        exclusion = self.tour.exclusions.create(start=datetime(2011, 1, 1))
+        response = feed(factory.get('/events/ical.ics', GET, HTTP_IF_NONE_MATCH=etag))
+        self.ae(response.status_code, 200)
+        etag = response['ETag']
+        exclusion.delete()
+        response = feed(factory.get('/events/ical.ics', GET, HTTP_IF_NONE_MATCH=etag))
+        self.ae(response.status_code, 200)
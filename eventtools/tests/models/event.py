@@ -1,4 +1,7 @@
 from django.test import TestCase
+from django.core.management import call_command
+from eventtools.models import Rule
+from eventtools.utils.pprint_timespan import pprint_date_span
 from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
 from eventtools.tests.eventtools_testapp.models import *
 from eventtools.tests._fixture import fixture
@@ -154,6 +157,34 @@ class TestEvents(AppTestCase):
         o2 = [a.closing_occurrence() for a in ExampleEvent.eventobjects.all()]
         self.ae(set(o), set(o2))
 
+        # the ids can be selected with the events, and the occurrences fetched
+        # in bulk
+        self.assertNumQueries(1, lambda: list(ExampleEvent.eventobjects.opening_occurrences()))
+        events = ExampleEvent.eventobjects.with_opening_occurrence().with_closing_occurrence()
+        with self.assertNumQueries(3):
+            events = list(events)
+        for e in events:
+            self.ae(e.opening_occurrence_id, getattr(e.reload().opening_occurrence(), 'pk', None))
+            self.ae(e.closing_occurrence(), e.reload().closing_occurrence())
+        film = [e for e in events if e == self.film][0]
+        self.ae(film.opening_occurrence(), self.film_occ)
+        self.ae(film.closing_occurrence(), self.film_with_talk_and_popcorn_occ)
+
+        # occurrences at the same time are in tree order, even where that
+        # isn't the order of the events' ids.
+        child = ExampleEvent.eventobjects.create(title="Late talk", slug="late-talk")
+        parent = ExampleEvent.eventobjects.create(title="Late night", slug="late-night")
+        child.occurrences.create(start=datetime(2011,6,1,22,0))
+        parent.occurrences.create(start=datetime(2011,6,1,22,0))
+        child.parent = parent
+        child.save()
+        parent = parent.reload()
+        self.ae(parent.opening_occurrence().event, parent)
+        self.ae(parent.closing_occurrence().event, child)
+        parent = ExampleEvent.eventobjects.with_opening_occurrence().with_closing_occurrence().get(pk=parent.pk)
+        self.ae(parent.opening_occurrence().event, parent)
+        self.ae(parent.closing_occurrence().event, child)
+
     def test_change_cascade(self):       
         """
         TestEvents are in an mptt tree, which indicates parents (more general) and children (more specific).
@@ -165,6 +196,7 @@ class TestEvents(AppTestCase):
 
         self.film.title = "Irish fillum night"
         self.film.save()
+        self.ae(self.film.cascaded_count, 3)
 
         # reload everything
         reload_films(self)
@@ -175,6 +207,7 @@ class TestEvents(AppTestCase):
         
         self.film_with_talk.title = "Ireland's best films (with free talk)"
         self.film_with_talk.save()
+        self.ae(self.film_with_talk.cascaded_count, 1)
         # reload everything
         reload_films(self)
         
@@ -184,11 +217,26 @@ class TestEvents(AppTestCase):
         #put it all back
         self.film.title = self.film_with_talk.title = "Film Night"
         self.film.save()
+        # film_with_talk (and so its child) has a different title, so only
+        # film_with_popcorn changes.
+        self.ae(self.film.cascaded_count, 1)
         self.film_with_talk.save()
         
         # reload everything
         reload_films(self)
 
+    def test_inherited_fields(self):
+        """
+        A new child event takes its parent's values for fields_to_inherit that
+        aren't given.
+        """
+        child = ExampleEvent(parent=self.film, slug="film-night-3")
+        self.ae(child.title, "Film Night")
+        child = ExampleEvent(parent=self.film, title="Film Night 3")
+        self.ae(child.title, "Film Night 3")
+        self.ae(ExampleEvent().title, "")
+        self.ae(ExampleEvent.inherited_values(self.film), {'title': "Film Night"})
+
     def test_diffs(self):
         self.ae(unicode(self.film), u'Film Night')
         self.ae(unicode(self.film_with_talk), u'Film Night (director\'s talk)')
@@ -226,3 +274,127 @@ class TestEvents(AppTestCase):
         self.ae(e.times_description(), "Times vary")
 
 
+
+    def test_occurrence_summaries(self):
+        """
+        Events keep a summary of their occurrences (counts, first and last),
+        which is updated as occurrences are added, changed and deleted.
+        """
+        talk = self.talk.reload()
+        self.ae(talk.direct_occurrence_count, 3)
+        self.ae(talk.listing_occurrence_count, 3)
+        self.ae(talk.available_occurrence_count, 2) # one is cancelled
+        self.ae(talk.first_occurrence_start, datetime(2010,10,10,10,00))
+        self.ae(talk.last_occurrence_start, datetime(2010,10,11,10,00))
+        self.ae(talk.last_occurrence_end, datetime(2010,10,11,10,00))
+
+        # the listing of a parent includes its children's occurrences
+        film = self.film.reload()
+        self.ae(film.direct_occurrence_count, 1)
+        self.ae(film.listing_occurrence_count, 4)
+        self.ae(film.last_occurrence_start, datetime(2010,10,13,18,30))
+        self.ae(self.film_with_talk.reload().listing_occurrence_count, 2)
+
+        # deleting a child's occurrence updates its ancestors
+        self.film_with_talk_and_popcorn_occ.delete()
+        self.ae(self.film.reload().listing_occurrence_count, 3)
+        self.ae(self.film.reload().last_occurrence_start, datetime(2010,10,12,18,30))
+        self.ae(self.film_with_talk.reload().listing_occurrence_count, 1)
+
+        # moving an occurrence updates both events
+        self.talk_afternoon.event = self.performance
+        self.talk_afternoon.save()
+        self.ae(self.talk.reload().direct_occurrence_count, 2)
+        self.ae(self.performance.reload().direct_occurrence_count, 4)
+
+        # saving an event doesn't write back the summaries it was loaded with
+        talk.save()
+        self.ae(self.talk.reload().direct_occurrence_count, 2)
+
+        # queryset updates bypass save(), so call occurrences_changed()
+        self.talk.occurrences.update(status='')
+        self.ae(self.talk.reload().available_occurrence_count, 1)
+        ExampleEvent.occurrences_changed([self.talk.pk])
+        self.ae(self.talk.reload().available_occurrence_count, 2)
+
+        # generators update the summary in bulk
+        e = ExampleEvent.eventobjects.create(title="Generated")
+        weekly = Rule.objects.create(frequency="WEEKLY")
+        g = e.generators.create(start=datetime(2010,1,1,10,00), _duration=60,
+            rule=weekly, repeat_until=date(2010,1,29))
+        e = e.reload()
+        self.ae(e.direct_occurrence_count, 5)
+        self.ae(e.last_occurrence_end, datetime(2010,1,29,11,00))
+        self.ae(e.is_finished(), True)
+        self.ae(e.season(), pprint_date_span(date(2010,1,1), date(2010,1,29)))
+        g.delete()
+        e = e.reload()
+        self.ae(e.direct_occurrence_count, 0)
+        self.ae(e.last_occurrence_end, None)
+        self.ae(e.opening_occurrence(), None)
+
+        # and the whole lot can be rebuilt
+        ExampleEvent.eventobjects.update(listing_occurrence_count=0)
+        call_command('rebuild_event_summaries', 'eventtools_testapp.ExampleEvent', verbosity=0)
+        self.ae(self.film.reload().listing_occurrence_count, 3)
+        self.ae(self.daily_tour.reload().listing_occurrence_count, 49)
+
+    def test_tree_move_summaries(self):
+        """
+        Moving an event in the tree (by changing its parent, or move_to()),
+        or deleting it, updates its old and new ancestors' summaries.
+        """
+        film_count = self.film.reload().listing_occurrence_count
+        performance_count = self.performance.reload().listing_occurrence_count
+        film_with_talk = self.film_with_talk.reload()
+        moved = film_with_talk.listing_occurrence_count
+        self.ae(moved, 2)
+
+        film_with_talk.parent = self.performance.reload()
+        film_with_talk.save()
+        self.ae(self.film.reload().listing_occurrence_count, film_count - moved)
+        self.ae(self.performance.reload().listing_occurrence_count, performance_count + moved)
+
+        film_with_talk.move_to(self.film.reload())
+        self.ae(self.film.reload().listing_occurrence_count, film_count)
+        self.ae(self.performance.reload().listing_occurrence_count, performance_count)
+
+        self.film_with_talk.reload().delete()
+        film = self.film.reload()
+        self.ae(film.listing_occurrence_count, film_count - moved)
+        self.ae(film.last_occurrence_start,
+            max(film.occurrences_in_listing().values_list('start', flat=True)))
+
+    def test_status_summary(self):
+        """
+        The status methods of an event read from one summary query, which can
+        be made for a whole queryset of events at once.
+        """
+        now = datetime.now()
+        e = ExampleEvent.eventobjects.create(title="Status", slug="status")
+        child = ExampleEvent.eventobjects.create(parent=e, title="Status", slug="status-child")
+        e.occurrences.create(start=now - timedelta(10), _duration=60)
+        child.occurrences.create(start=now + timedelta(10), _duration=60, status='cancelled')
+        last = child.occurrences.create(start=now + timedelta(11), _duration=60, status='fully booked')
+
+        e = e.reload()
+        with self.assertNumQueries(1):
+            summary = e.status_summary()
+            message = e.unavailable_status_message()
+        self.ae((summary.count, summary.cancelled, summary.fully_booked, summary.available), (3, 1, 1, 1))
+        self.ae((summary.forthcoming, summary.forthcoming_cancelled, summary.forthcoming_fully_booked, summary.forthcoming_available), (2, 1, 1, 0))
+        self.ae(summary.last_end, last._end)
+        self.ae(message, "This event is fully booked.")
+
+        # is_finished reads the summary too, not the (possibly stale) column
+        ExampleEvent.eventobjects.filter(pk=e.pk).update(last_occurrence_end=now - timedelta(1))
+        e = e.reload()
+        with self.assertNumQueries(1):
+            self.ae(e.is_finished(), False)
+            self.ae(e.unavailable_status_message(), "This event is fully booked.")
+
+        with self.assertNumQueries(2):
+            events = list(ExampleEvent.eventobjects.filter(pk__in=[e.pk, child.pk]).with_status_summary())
+            self.ae([event.is_fully_booked() for event in events], [False, True])
+            self.ae([event.is_cancelled() for event in events], [False, False])
+
@@ -9,6 +9,15 @@ from django.core.urlresolvers import reverse
 from eventtools.models import Rule
 from django.core.exceptions import ValidationError
 from django.db import IntegrityError
+from eventtools.admin import _remove_occurrences, _convert_to_oneoff
+from eventtools.models import bulk_exclude
+
+class MessageRecorder(object):
+    def __init__(self):
+        self.messages = []
+
+    def message_user(self, request, message):
+        self.messages.append(message)
 
 class TestExclusions(AppTestCase):
 
@@ -138,4 +147,81 @@ class TestExclusions(AppTestCase):
         self.ae(event.occurrences.filter(start = clashingtime2).count(), 0)
 
         # overall, there is one less occurrence
-        self.ae(event.occurrences.count(), 52)
\ No newline at end of file
+        self.ae(event.occurrences.count(), 52)
+
+    def test_admin_actions(self):
+        """
+        The admin actions that remove occurrences, or make them one-off, add
+        exclusions for the generated ones (in bulk) so they aren't generated
+        again. Occurrences that can't be deleted are made one-off.
+        """
+        event = ExampleEvent.objects.create(title="Curator's Talk", slug="curators-talk-1")
+        weekly = Rule.objects.create(frequency = "WEEKLY")
+        generator = event.generators.create(start=datetime(2010,1,1, 9,00), _duration=60, rule=weekly, repeat_until=date(2010,12,31))
+        occurrences = list(event.occurrences.all()[:6])
+        ExampleTicket.objects.create(occurrence=occurrences[0])
+        # already excluded (and so one-off)
+        event.exclusions.create(start=occurrences[2].start)
+
+        admin = MessageRecorder()
+        _remove_occurrences(admin, None, ExampleOccurrence.objects.filter(pk__in=[o.pk for o in occurrences[:4]]))
+        self.ae(admin.messages, [u"3 occurrences deleted, 1 made one-off (they can't be deleted), and 3 exclusions added."])
+        self.ae(event.exclusions.count(), 4)
+        self.ae(event.occurrences.get(pk=occurrences[0].pk).generated_by, None)
+
+        _convert_to_oneoff(admin, None, ExampleOccurrence.objects.filter(pk__in=[o.pk for o in occurrences[3:]]))
+        self.ae(admin.messages[-1], u"2 occurrences made one-off, and 2 exclusions added.")
+        self.ae(event.exclusions.count(), 6)
+
+        # none of them come back
+        generator.save()
+        self.ae(event.occurrences.count(), 50)
+        self.ae(event.occurrences.filter(generated_by__isnull=True).count(), 3)
+
+    def test_bulk_exclude(self):
+        """
+        Many exclusions can be added at once, eg from an import of holidays.
+        Clashing generated occurrences are unhooked (or deleted, if asked).
+        """
+        event = ExampleEvent.objects.create(title="Curator's Talk", slug="curators-talk-1")
+        weekly = Rule.objects.create(frequency = "WEEKLY")
+        generator = event.generators.create(start=datetime(2010,1,1, 9,00), _duration=60, rule=weekly, repeat_until=date(2010,12,31))
+        event.exclusions.create(start=datetime(2010,1,8,9,00))
+        ExampleTicket.objects.create(occurrence=event.occurrences.get(start=datetime(2010,1,22,9,00)))
+
+        starts = [datetime(2010,1,1,9,00), datetime(2010,1,8,9,00), datetime(2010,1,9,9,00)]
+        exclusions = ExampleExclusion.objects.bulk_exclude(event, starts)
+        self.ae([e.start for e in exclusions], [datetime(2010,1,1,9,00), datetime(2010,1,9,9,00)])
+        self.ae(event.exclusions.count(), 3)
+        self.ae(event.occurrences.count(), 53)
+        self.ae(event.occurrences.get(start=datetime(2010,1,1,9,00)).generated_by, None)
+
+        exclusions = bulk_exclude(event, [datetime(2010,1,15,9,00), datetime(2010,1,22,9,00)], delete=True)
+        self.ae(len(exclusions), 2)
+        self.ae(event.occurrences.count(), 52)
+        # the ticketed one is kept, but made one-off
+        self.ae(event.occurrences.get(start=datetime(2010,1,22,9,00)).generated_by, None)
+
+        # none of them come back
+        generator.save()
+        self.ae(event.occurrences.count(), 52)
+        self.ae(event.occurrences.filter(generated_by__isnull=True).count(), 3)
+
+    def test_is_exclusion(self):
+        """
+        Occurrences know if they are excluded, from one query for a whole
+        queryset.
+        """
+        event = ExampleEvent.objects.create(title="Curator's Talk", slug="curators-talk-1")
+        o1 = event.occurrences.create(start=datetime(2010,1,1,9,00), _duration=60)
+        o2 = event.occurrences.create(start=datetime(2010,1,8,9,00), _duration=60)
+        event.exclusions.create(start=o2.start)
+
+        with self.assertNumQueries(1):
+            self.ae([o.is_exclusion() for o in event.occurrences.annotate_exclusions()], [False, True])
+
+        o1 = ExampleOccurrence.objects.get(pk=o1.pk)
+        with self.assertNumQueries(1):
+            self.ae(o1.is_exclusion(), False)
+            self.ae(o1.is_exclusion(), False)
+
@@ -8,7 +8,11 @@ from eventtools.utils import datetimeify
 from dateutil.relativedelta import relativedelta
 from django.core.urlresolvers import reverse
 from eventtools.models import Rule
+from eventtools.signals import occurrences_timeshifted
+from eventtools.sync import coordinator
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.conf import settings as django_settings
 
 class TestGenerators(AppTestCase):
     
@@ -555,3 +559,232 @@ class TestGenerators(AppTestCase):
         self.ae(event.occurrences.filter(generated_by__isnull=True).count(), 1)
         self.ae(event.occurrences.count(), 1)
 
+    def test_delete_with_indirectly_related_items(self):
+        """
+        Occurrences protected through a cascade (a paid booking) are unhooked,
+        and the rest are still deleted in bulk.
+        """
+        event = ExampleEvent.objects.create(title="Curator's Talk", slug="curators-talk-3")
+        generator = event.generators.create(start=datetime(2010,1,1, 9,00), _duration=60, rule=self.weekly_generator.rule, repeat_until=date(2010,12,31))
+        paid, unpaid = event.occurrences.all()[:2]
+        ExampleBookingPayment.objects.create(booking=ExampleBooking.objects.create(occurrence=paid))
+        ExampleBooking.objects.create(occurrence=unpaid)
+
+        self.ae(generator.occurrences.all().delete_or_unhook(), (52, 1))
+        self.ae(list(event.occurrences.values_list('id', 'generated_by')), [(paid.id, None)])
+        self.ae(ExampleBooking.objects.count(), 1)
+
+    def _count_queries(self, f, *args, **kwargs):
+        old_use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        start = len(connection.queries)
+        try:
+            f(*args, **kwargs)
+            return len(connection.queries) - start
+        finally:
+            connection.use_debug_cursor = old_use_debug_cursor
+
+    def test_sync_query_count(self):
+        """
+        Syncing is set-based, so the number of queries used to save a
+        generator doesn't grow with the number of occurrences it generates.
+        """
+        event = ExampleEvent.eventobjects.create(title="Daily Tour", slug="daily-tour-sync")
+        short = ExampleGenerator(event=event, start=datetime(2010,1,1, 9,00), _duration=60, rule=self.daily, repeat_until=date(2010,1,10))
+        yearly = ExampleGenerator(event=event, start=datetime(2010,1,1, 10,00), _duration=60, rule=self.daily, repeat_until=date(2010,12,31))
+
+        short_queries = self._count_queries(short.save, cascade=False)
+        yearly_queries = self._count_queries(yearly.save, cascade=False)
+
+        self.ae(short.occurrences.count(), 10)
+        self.ae(yearly.occurrences.count(), 365)
+        # only the batches of the bulk insert differ
+        self.assertTrue(yearly_queries - short_queries <= 3)
+
+        # resaving an unchanged generator creates and deletes nothing
+        ids = set(yearly.occurrences.values_list('id', flat=True))
+        yearly.save(cascade=False)
+        self.ae(set(yearly.occurrences.values_list('id', flat=True)), ids)
+
+    def test_timeshift(self):
+        """
+        Changing a generator's time or duration moves its occurrences in bulk,
+        and sends one occurrences_timeshifted signal. If the occurrences would
+        land on each other (eg a daily generator moved a day later), they are
+        moved one at a time, keeping their ids.
+        """
+        sent = []
+        def receiver(sender, **kwargs):
+            sent.append(kwargs)
+        occurrences_timeshifted.connect(receiver)
+
+        try:
+            event = ExampleEvent.eventobjects.create(title="Daily Tour", slug="daily-tour-shift")
+            generator = event.generators.create(start=datetime(2010,1,1, 9,00), _duration=60, rule=self.daily, repeat_until=date(2010,1,10))
+            ids = set(generator.occurrences.values_list('id', flat=True))
+            self.ae(len(ids), 10)
+
+            # shift by 15 minutes
+            generator.start = datetime(2010,1,1, 9,15)
+            generator.save()
+            self.ae(len(sent), 1)
+            self.ae(sent[0]['start_shift'], timedelta(minutes=15))
+            self.ae(set(sent[0]['occurrence_ids']), ids)
+            self.ae(set(generator.occurrences.values_list('id', flat=True)), ids)
+            [self.ae(o.start.time(), time(9,15)) for o in generator.occurrences.all()]
+
+            # shift by a day, onto the next occurrence
+            generator.start = datetime(2010,1,2, 9,15)
+            generator.repeat_until = date(2010,1,11)
+            generator._duration = 30
+            generator.save()
+            self.ae(len(sent), 2)
+            self.ae(set(generator.occurrences.values_list('id', flat=True)), ids)
+            self.ae(generator.occurrences.all()[0].start, datetime(2010,1,2, 9,15))
+            [self.ae(o._duration, 30) for o in generator.occurrences.all()]
+        finally:
+            occurrences_timeshifted.disconnect(receiver)
+
+    def test_deferred_sync(self):
+        """
+        While syncs are deferred, saving generators doesn't generate
+        occurrences. When the deferred block ends, every generator of each
+        touched event is synced once.
+        """
+        event = ExampleEvent.eventobjects.create(title="Daily Tour", slug="daily-tour-deferred")
+        with coordinator.deferred():
+            morning = event.generators.create(start=datetime(2010,1,1, 9,00), _duration=60, rule=self.daily, repeat_until=date(2010,1,10))
+            afternoon = event.generators.create(start=datetime(2010,1,1, 14,00), _duration=60, rule=self.daily, repeat_until=date(2010,1,10))
+            morning.repeat_until = date(2010,1,5)
+            morning.save()
+            event.save()
+            self.ae(event.occurrences.count(), 0)
+
+        self.ae(morning.occurrences.count(), 5)
+        self.ae(afternoon.occurrences.count(), 10)
+
+        # nothing is synced if the block is abandoned
+        try:
+            with coordinator.deferred():
+                morning.repeat_until = date(2010,1,10)
+                morning.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.ae(morning.occurrences.count(), 5)
+        self.assertFalse(coordinator.is_deferred())
+
+    def test_roll_forward(self):
+        """
+        Endless generators record how far they've generated (generated_until),
+        and roll_forward() generates from there, without regenerating the
+        history. ./manage.py roll_generators rolls every endless generator.
+        """
+        event = ExampleEvent.eventobjects.create(title="Daily Tour", slug="daily-tour-roll")
+        start = datetime.combine(date.today(), time(9,00))
+        generator = event.generators.create(start=start, _duration=60, rule=self.daily)
+        horizon = generator._horizon()
+        self.ae(generator.generated_until, horizon)
+        self.ae(ExampleGenerator.objects.get(pk=generator.pk).generated_until, horizon)
+        count = generator.occurrences.count()
+
+        # roll on 10 days, one of which is an exclusion
+        until = horizon + timedelta(10)
+        ExampleExclusion.objects.create(event=event, start=datetime.combine(until.date(), time(9,00)) - timedelta(2))
+        ids = set(generator.occurrences.values_list('id', flat=True))
+        self.ae(generator.roll_forward(until), 9)
+        self.ae(generator.generated_until, until)
+        self.ae(generator.occurrences.count(), count + 9)
+        self.assertTrue(ids < set(generator.occurrences.values_list('id', flat=True)))
+        self.ae(ExampleEvent.eventobjects.get(pk=event.pk).direct_occurrence_count, count + 9)
+
+        # rolling to where we've already got to does nothing
+        self.ae(generator.roll_forward(until), 0)
+
+        # the command rolls on from the mark (run inline, so that it sees
+        # this test's transaction).
+        mark = horizon - timedelta(5)
+        ExampleGenerator.objects.filter(pk=generator.pk).update(generated_until=mark)
+        generator.occurrences.filter(start__gt=mark).delete()
+        count = generator.occurrences.count()
+        from django.core.management import call_command
+        call_command('roll_generators', 'eventtools_testapp.ExampleGenerator',
+            verbosity=0, threads=1)
+        self.ae(generator.occurrences.count(), count + 5)
+        self.ae(ExampleGenerator.objects.get(pk=generator.pk).generated_until, horizon)
+
+        # a chunk that can't be fetched is recorded as failed
+        from eventtools.management.commands.roll_generators import Command
+        results, errors = [], []
+        Command()._roll_chunk(ExampleGenerator, ['not a pk'], results, errors)
+        self.ae(results, [])
+        self.ae([pk for pk, tb in errors], ['not a pk'])
+
+    def test_virtual_occurrences(self):
+        """
+        With a MATERIALISATION_WINDOW, occurrences after it are virtual: they
+        aren't saved, but with_virtual() querysets compute them (leaving out
+        exclusions and taken starts). They're saved when they need a pk.
+        """
+        old_window = getattr(django_settings, 'MATERIALISATION_WINDOW', None)
+        django_settings.MATERIALISATION_WINDOW = relativedelta(days=10)
+        try:
+            today = date.today()
+            def day(n):
+                return datetime.combine(today + timedelta(n), time(9,00))
+            event = ExampleEvent.eventobjects.create(title="Daily Tour", slug="daily-tour-virtual")
+            generator = event.generators.create(start=day(0), _duration=60, rule=self.daily)
+            self.ae(generator.occurrences.count(), 11)
+            self.ae(generator.generated_until, datetime.combine(today + timedelta(10), time.max))
+
+            ExampleExclusion.objects.create(event=event, start=day(15))
+            child = ExampleEvent.eventobjects.create(parent=event, title="Daily Tour (with talk)", slug="daily-tour-talk")
+            child.occurrences.create(start=day(16), _duration=60)
+
+            qs = event.occurrences.with_virtual().starts_between(today, today + timedelta(20))
+            starts = [o.start for o in qs]
+            self.ae(starts, [day(n) for n in range(21) if n not in (15, 16)])
+            self.ae(qs.count(), 19)
+            self.ae(event.occurrences.starts_between(today, today + timedelta(20)).count(), 11)
+            self.ae(qs.cancelled().count(), 0)
+
+            # they're merged in reverse too
+            self.ae(qs.reverse()[0].start, day(20))
+            self.ae([o.start for o in qs.order_by('-start')], starts[::-1])
+            self.assertRaises(NotImplementedError, list, qs.order_by('event'))
+
+            # keyword filters are tested on them; others can't be
+            self.ae(qs.exclude(start=day(13)).count(), 18)
+            self.ae(list(qs.filter(generated_by__isnull=True)), [])
+            self.ae(qs.filter(event=child).count(), 0)
+            self.assertRaises(NotImplementedError, qs.filter(event__title="Daily Tour").count)
+            self.assertRaises(NotImplementedError, list, qs.extra(where=["1 = 1"]))
+
+            virtual = qs[11]
+            self.ae(virtual.start, day(11))
+            self.assertTrue(virtual.is_virtual())
+            self.ae(virtual.pk, None)
+
+            # materialising saves it (once)
+            saved = virtual.materialise()
+            self.assertFalse(saved.is_virtual())
+            self.ae(saved.generated_by, generator)
+            self.ae(virtual.materialise().pk, saved.pk)
+            self.ae(qs.count(), 19)
+            self.ae(generator.occurrences.count(), 12)
+
+            # as does a status change
+            virtual = qs[12]
+            virtual.status = 'cancelled'
+            virtual.save()
+            self.ae(qs.cancelled().count(), 1)
+            self.ae(generator.occurrences.count(), 13)
+
+            # events() includes the events of virtual occurrences
+            far = ExampleEvent.eventobjects.filter(pk=event.pk).occurrences()\
+                .starts_between(today + timedelta(30), today + timedelta(31))
+            self.ae(list(far.events()), [])
+            self.ae(list(far.with_virtual().events()), [event])
+            self.ae(len(far.with_virtual().start_dates()), 2)
+        finally:
+            django_settings.MATERIALISATION_WINDOW = old_window
@@ -6,6 +6,9 @@ from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
 from eventtools.tests.eventtools_testapp.models import *
 from datetime import date, time, datetime, timedelta
 from eventtools.utils import datetimeify
+from eventtools.admin import OccurrenceAdmin, EventTreeChoices
+from eventtools.models import Rule
+from django.contrib.admin.sites import AdminSite
 
 class TestOccurrences(AppTestCase):
     """
@@ -131,6 +134,76 @@ class TestOccurrences(AppTestCase):
         self.assertTrue(o.time_to_go() < timedelta(0))
         self.ae(o2.time_to_go(), timedelta(0))
 
+        # the same questions can be asked of the database, which stores the end
+        self.ae(o._end, o.end())
+        occs = e.occurrences.all()
+        self.ae(list(occs.finished()), [o])
+        self.ae(list(occs.now_on()), [o2])
+        self.ae(list(occs.overlapping(datetime(2010,1,2,9,30), datetime(2010,1,2,11,00))), [o])
+        self.ae(list(occs.overlapping(datetime(2010,1,2,10,30), datetime(2010,1,2,11,00))), [])
+        self.ae(list(occs.ends_after(now)), [o2])
+
+        # the stored end follows bulk updates
+        occs.filter(pk=o.pk).update(_duration=60)
+        o = e.occurrences.get(pk=o.pk)
+        self.ae(o._end, datetime(2010,1,1,10,00))
+        self.ae(list(occs.overlapping(datetime(2010,1,2,9,30), datetime(2010,1,2,11,00))), [])
+
+    def test_start_dates(self):
+        """
+        The days that occurrences start on can be found in one query, as a set
+        with fast membership tests (used by the calendar tags).
+        """
+        e = ExampleEvent.eventobjects.create(title="event with occurrences")
+        e.occurrences.create(start=datetime(2010,1,31,9,00), _duration=60)
+        e.occurrences.create(start=datetime(2010,1,31,18,00), _duration=60)
+        e.occurrences.create(start=datetime(2011,3,1,9,00), _duration=60)
+
+        with self.assertNumQueries(1):
+            days = e.occurrences.start_dates()
+        self.ae(len(days), 2)
+        self.assertTrue(date(2010,1,31) in days)
+        self.assertFalse(date(2010,1,30) in days)
+        self.ae(days.first(), date(2010,1,31))
+        self.ae(days.last(), date(2011,3,1))
+        self.ae(days.months(), [(2010, 1), (2011, 3)])
+        self.assertFalse(e.occurrences.starts_after(datetime(2012,1,1)).start_dates())
+
+    def test_admin_changelist_queries(self):
+        """
+        The occurrence changelist fetches the page's occurrences (with their
+        events and generators) in one query, and the events they can be moved
+        to in one more, rather than a few queries per row.
+        """
+        tour = ExampleEvent.eventobjects.create(title="Tour", slug="tour")
+        tour_child = ExampleEvent.eventobjects.create(parent=tour, title="Tour", slug="tour-child", difference_from_parent="child")
+        other = ExampleEvent.eventobjects.create(title="Other", slug="other")
+        weekly = Rule.objects.create(frequency="WEEKLY")
+        tour.generators.create(start=datetime(2010,1,1,9,00), _duration=60, rule=weekly, repeat_until=date(2010,3,1))
+        tour_child.occurrences.create(start=datetime(2010,1,2,9,00), _duration=60)
+        other.occurrences.create(start=datetime(2010,1,3,9,00), _duration=60)
+
+        model_admin = OccurrenceAdmin(ExampleOccurrence)(ExampleOccurrence, AdminSite())
+        FormSet = model_admin.get_changelist_formset(None)
+        qs = model_admin.queryset(None)
+        with self.assertNumQueries(2):
+            formset = FormSet(queryset=qs)
+            html = unicode(formset)
+            [o.generated_by.event for o in formset.get_queryset() if o.generated_by_id]
+
+        choices = dict((form.instance.event_id, [pk for pk, label in form.fields['event'].choices])
+            for form in formset.forms if not form.instance.generated_by_id)
+        # the event, its descendants, ancestors and siblings
+        self.ae(choices[tour_child.pk], [u"", tour.pk, tour_child.pk])
+        self.ae(choices[other.pk], [u""] + [e.pk for e in other.get_siblings(include_self=True)])
+        for form in formset.forms:
+            if form.instance.generated_by_id:
+                self.ae([pk for pk, label in form.fields['event'].choices], [u"", tour.pk, tour_child.pk])
+
+        # the other roots are only fetched for one-off occurrences of a root
+        event_choices = EventTreeChoices(ExampleEvent, qs.filter(generated_by__isnull=False))
+        self.ae(set(e.pk for e in event_choices.events), set([tour.pk, tour_child.pk]))
+
 """
 TODO
 
@@ -0,0 +1,155 @@
+# -*- coding: utf-8“ -*-
+from datetime import date, time, datetime, timedelta
+from django.core.exceptions import ValidationError
+from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
+from itertools import takewhile
+from dateutil import tz
+from django.utils.unittest import skipIf
+from eventtools.models import Rule
+from eventtools.utils import expansion
+
+class TestRules(AppTestCase):
+
+    def test_compiled_rules_are_cached(self):
+        """
+        A saved Rule's definition is only parsed once, and the parsed version
+        is thrown away when the rule is saved with a different definition.
+        """
+        weekly = Rule.objects.create(name="Weekly", frequency="WEEKLY")
+        dtstart = datetime(2011, 1, 3, 10, 0)
+
+        compiled = weekly.compile()
+        self.assertTrue(Rule.objects.get(pk=weekly.pk).compile() is compiled)
+        self.ae(list(weekly.get_rrule(dtstart)[:2]), [dtstart, dtstart + timedelta(7)])
+
+        weekly.params = "interval:2"
+        weekly.save()
+        self.assertTrue(weekly.compile() is not compiled)
+        self.ae(list(weekly.get_rrule(dtstart)[:2]), [dtstart, dtstart + timedelta(14)])
+
+    def test_complex_rules(self):
+        """
+        Placeholders in complex rules are substituted for each dtstart.
+        """
+        rule = Rule.objects.create(
+            name="Monthly on the same weekday",
+            frequency="MONTHLY",
+            complex_rule="RRULE:FREQ=MONTHLY;BYDAY=%nthday%",
+        )
+        # the 2nd Wednesday
+        dtstart = datetime(2011, 2, 9, 10, 0)
+        self.ae(rule.compile().render(dtstart), "RRULE:FREQ=MONTHLY;BYDAY=2WE")
+        self.ae(list(rule.get_rrule(dtstart)[:3]), [
+            dtstart,
+            datetime(2011, 3, 9, 10, 0),
+            datetime(2011, 4, 13, 10, 0),
+        ])
+        self.assertTrue(rule.get_rrule(dtstart) is rule.get_rrule(dtstart))
+
+        # unparseable complex rules fall back to the simple rule
+        rule.complex_rule = "RRULE:FREQ=MONTHLY;BYSOMETHING=%day%"
+        rule.save()
+        self.ae(list(rule.get_rrule(dtstart)[:2]), [
+            dtstart,
+            datetime(2011, 3, 9, 10, 0),
+        ])
+
+    def test_validation(self):
+        self.assertRaises(ValidationError, Rule(name="No frequency").clean)
+        self.assertRaises(ValidationError, Rule(name="Bad params", frequency="DAILY", params="byweekday:monday").clean)
+        Rule(name="Weekdays", frequency="DAILY", params="byweekday:0,1,2,3,4").clean()
+
+
+@skipIf(expansion.numpy is None, "NumPy isn't installed")
+class TestExpansion(AppTestCase):
+    """
+    The vectorised expansion gives the same datetimes as iterating the rrule.
+    """
+
+    def assertSameExpansion(self, frequency, params, dtstart, until, vectorised=True):
+        rule = Rule(frequency=frequency, params=params)
+        compiled = rule.compile()
+        self.ae(expansion.can_vectorise(compiled, dtstart), vectorised)
+        expected = list(takewhile(lambda d: d <= until, rule.get_rrule(dtstart)))
+        self.ae(expansion.expand(compiled, dtstart, until), expected)
+        return expected
+
+    def test_simple_rules(self):
+        dtstart = datetime(2011, 1, 5, 10, 30)
+        until = datetime(2013, 6, 30, 23, 59)
+        for frequency in ("DAILY", "WEEKLY", "MONTHLY"):
+            for params in (
+                "",
+                "interval:3",
+                "count:10",
+                "byweekday:0,2,4",
+                "interval:2;byweekday:1,5",
+                "bymonth:2,3;byweekday:6",
+                "byhour:9,13,17;byminute:0,30",
+                "bymonthday:1,15",
+                "bymonthday:13;byweekday:4", # Friday the 13th
+            ):
+                self.assertSameExpansion(frequency, params, dtstart, until)
+
+    def test_month_ends(self):
+        """
+        Months without the day are skipped, and negative days count back
+        from the end of the month.
+        """
+        until = datetime(2013, 12, 31, 23, 59)
+        dates = self.assertSameExpansion("MONTHLY", "", datetime(2011, 1, 31, 9, 0), until)
+        self.ae(dates[:3], [datetime(2011, 1, 31, 9, 0), datetime(2011, 3, 31, 9, 0), datetime(2011, 5, 31, 9, 0)])
+        dates = self.assertSameExpansion("MONTHLY", "bymonthday:-1", datetime(2011, 1, 15, 9, 0), until)
+        self.ae(dates[:2], [datetime(2011, 1, 31, 9, 0), datetime(2011, 2, 28, 9, 0)])
+        self.assertSameExpansion("MONTHLY", "bymonthday:29,30,31", datetime(2011, 1, 1), until)
+        self.assertSameExpansion("MONTHLY", "interval:5;bymonthday:-3,-1", datetime(2011, 1, 30), until)
+        # leap years
+        self.assertSameExpansion("DAILY", "bymonth:2;bymonthday:29", datetime(2010, 2, 1), until)
+        self.assertSameExpansion("WEEKLY", "bymonthday:-1", datetime(2011, 1, 1), until)
+
+    def test_dst(self):
+        """
+        Naive datetimes keep their wall-clock time across daylight saving
+        changes (here, Sydney's), as they do with dateutil. Timezone-aware
+        starts use dateutil.
+        """
+        until = datetime(2012, 12, 31, 23, 59)
+        # 2am doesn't exist on the first Sunday in October in Sydney
+        dates = self.assertSameExpansion("WEEKLY", "byweekday:6;byhour:1,2,3", datetime(2011, 9, 25, 1, 0), until)
+        self.assertTrue(datetime(2011, 10, 2, 2, 0) in dates)
+        self.assertSameExpansion("DAILY", "byhour:0,1,2,3,4,5;byminute:0,30", datetime(2011, 3, 30, 0, 0), until)
+
+        sydney = tz.gettz('Australia/Sydney')
+        dtstart = datetime(2011, 9, 25, 2, 30, tzinfo=sydney)
+        self.assertSameExpansion("DAILY", "", dtstart, datetime(2011, 10, 10, tzinfo=sydney), vectorised=False)
+
+    def test_after(self):
+        """
+        Only the datetimes later than `after` are returned (the periods and
+        counts are still reckoned from dtstart).
+        """
+        dtstart = datetime(2011, 1, 5, 10, 30)
+        until = datetime(2013, 6, 30, 23, 59)
+        after = datetime(2012, 3, 7, 10, 30)
+        for frequency, params in (
+            ("DAILY", "interval:3"),
+            ("WEEKLY", "interval:2;byweekday:1,5"),
+            ("MONTHLY", "interval:5;bymonthday:-3,-1"),
+            ("DAILY", "count:500"),
+            ("YEARLY", ""),
+        ):
+            compiled = Rule(frequency=frequency, params=params).compile()
+            expected = [d for d in expansion.expand(compiled, dtstart, until) if d > after]
+            self.ae(expansion.expand(compiled, dtstart, until, after), expected)
+
+    def test_fallback(self):
+        """
+        Other rules are expanded by dateutil.
+        """
+        until = datetime(2012, 12, 31)
+        dtstart = datetime(2011, 1, 5, 10, 30)
+        self.assertSameExpansion("YEARLY", "", dtstart, until, vectorised=False)
+        self.assertSameExpansion("MONTHLY", "bysetpos:-1;byweekday:0,1,2,3,4", dtstart, until, vectorised=False)
+        self.assertSameExpansion("DAILY", "byyearday:1,100", dtstart, until, vectorised=False)
+        rule = Rule(frequency="MONTHLY", complex_rule="RRULE:FREQ=MONTHLY;BYDAY=%nthday%")
+        self.ae(expansion.can_vectorise(rule.compile(), dtstart), False)
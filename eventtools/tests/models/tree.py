@@ -1,6 +1,9 @@
 __author__ = 'gturner'
 from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
 from eventtools.tests.eventtools_testapp.models import *
+from django.contrib import admin
+from django.test.client import RequestFactory
+from eventtools.admin import EventAdmin
 from eventtools.models import Rule
 import datetime
 
@@ -55,6 +58,21 @@ class TestEventTree(AppTestCase):
         self.ae(qs.count(), 3)
         self.ae(set(list(qs.filter())), set([self.talk1, self.talk2, self.tour]))
 
+        #filtering before asking for listed events gives the listed events in the filtered set.
+        qs = ExampleEvent.eventobjects.filter(level=1).in_listings()
+        self.ae(set(qs), set([self.talk1, self.talk2]))
+        self.ae(ExampleEvent.eventobjects.filter(pk=self.talk2a.pk).in_listings().count(), 0)
+
+        #whether each event is listed can be fetched with it, for admin listings.
+        with self.assertNumQueries(1):
+            listed = [e for e in ExampleEvent.eventobjects.with_listed() if e.is_listed()]
+        self.ae(set(listed), set([self.talk1, self.talk2, self.tour]))
+        changelist = EventAdmin(ExampleEvent)(ExampleEvent, admin.site)\
+            .queryset(RequestFactory().get('/'))
+        with self.assertNumQueries(1):
+            listed = [e for e in changelist if e.is_listed()]
+        self.ae(set(listed), set([self.talk1, self.talk2, self.tour]))
+
         #the 'direct' occurrences of an event are default and direct
         self.ae(self.tour.occurrences.count(), 26)
         self.ae(self.glen_tour.occurrences.count(), 4)
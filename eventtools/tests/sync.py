@@ -0,0 +1,66 @@
+# -*- coding: utf-8“ -*-
+from django.conf import settings as django_settings
+from django.http import HttpRequest, HttpResponse
+
+from eventtools import sync
+from eventtools.middleware import DeferredSyncMiddleware
+from eventtools.sync import coordinator
+from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
+from eventtools.tests.eventtools_testapp.models import *
+
+class TestSyncCoordinator(AppTestCase):
+
+    def setUp(self):
+        super(TestSyncCoordinator, self).setUp()
+        self.synced = []
+        self._old_resync_events = sync.resync_events
+        def resync_events(EventModel, event_ids):
+            self.synced.append((EventModel, sorted(event_ids)))
+            if -1 in event_ids:
+                raise ValueError
+        sync.resync_events = resync_events
+
+    def tearDown(self):
+        sync.resync_events = self._old_resync_events
+        coordinator.reset()
+        super(TestSyncCoordinator, self).tearDown()
+
+    def test_middleware_recovers(self):
+        """
+        If a request's response middleware doesn't run, its deferred block is
+        discarded when the thread's next request starts, rather than
+        deferring syncs forever.
+        """
+        middleware = DeferredSyncMiddleware()
+        middleware.process_request(HttpRequest())
+        coordinator.mark_dirty(ExampleEvent(pk=1))
+        # ...and process_exception and process_response are skipped.
+
+        request = HttpRequest()
+        middleware.process_request(request)
+        self.assertTrue(coordinator.is_deferred())
+        coordinator.mark_dirty(ExampleEvent(pk=2))
+        middleware.process_response(request, HttpResponse())
+        self.assertFalse(coordinator.is_deferred())
+        self.ae(self.synced, [(ExampleEvent, [2])])
+
+        coordinator.mark_dirty(ExampleEvent(pk=3))
+        self.ae(self.synced[-1], (ExampleEvent, [3]))
+
+    def test_queue(self):
+        """
+        With GENERATOR_SYNC_QUEUE, deferred syncs are run by the worker
+        thread, which carries on after a failed sync.
+        """
+        old_queue = getattr(django_settings, 'GENERATOR_SYNC_QUEUE', False)
+        django_settings.GENERATOR_SYNC_QUEUE = True
+        try:
+            with coordinator.deferred():
+                coordinator.mark_dirty(ExampleEvent(pk=-1))
+            with coordinator.deferred():
+                coordinator.mark_dirty(ExampleEvent(pk=4))
+                coordinator.mark_dirty(ExampleEvent(pk=5))
+            coordinator.worker.join()
+        finally:
+            django_settings.GENERATOR_SYNC_QUEUE = old_queue
+        self.ae(self.synced, [(ExampleEvent, [-1]), (ExampleEvent, [4, 5])])
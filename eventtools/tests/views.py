@@ -215,4 +215,224 @@
 # 
 #         API (TODO)
 # 
-#         """
\ No newline at end of file
+#         """
+
+from datetime import date, datetime, time, timedelta
+
+from django.conf import settings as django_settings
+from django.test.client import RequestFactory
+
+from eventtools.models import Rule
+from eventtools.tests._inject_app import TestCaseWithApp as AppTestCase
+from eventtools.tests.eventtools_testapp.models import *
+# after the test app's models, which bring in django.conf's settings
+from eventtools.conf import settings
+from eventtools.templatetags import calendar as calendar_tags
+from eventtools.utils.viewutils import keyset_paginate, parse_cursor, KEYSET_ORDERING
+from eventtools.views import EventViews
+
+class TestKeysetPagination(AppTestCase):
+
+    def setUp(self):
+        super(TestKeysetPagination, self).setUp()
+        self.factory = RequestFactory()
+        self.tour = ExampleEvent.eventobjects.create(title="Tour", slug="tour")
+        self.talk = ExampleEvent.eventobjects.create(title="Talk", slug="talk")
+        # two events at the same times, so the cursor has to break ties
+        for day in range(25):
+            start = datetime(2010, 1, 1, 10, 0) + timedelta(day)
+            self.tour.occurrences.create(start=start)
+            self.talk.occurrences.create(start=start)
+        self.pool = ExampleOccurrence.objects.all()
+        self.ordered = list(self.pool.order_by(*KEYSET_ORDERING))
+
+    def _page(self, **GET):
+        return keyset_paginate(self.factory.get('/', GET), self.pool, per_page=20)
+
+    def test_pages(self):
+        page = self._page()
+        self.ae(page.object_list, self.ordered[:20])
+        self.ae((page.has_previous(), page.has_next()), (False, True))
+
+        page = self._page(after=page.next_cursor())
+        self.ae(page.object_list, self.ordered[20:40])
+        self.ae((page.has_previous(), page.has_next()), (True, True))
+
+        page3 = self._page(after=page.next_cursor(), foo='bar')
+        self.ae(page3.object_list, self.ordered[40:])
+        self.ae((page3.has_previous(), page3.has_next()), (True, False))
+        self.assertTrue('foo=bar' in page3.previous_query())
+
+        # and back again
+        page = self._page(before=page3.previous_cursor())
+        self.ae(page.object_list, self.ordered[20:40])
+        page = self._page(before=page.previous_cursor())
+        self.ae(page.object_list, self.ordered[:20])
+        self.ae((page.has_previous(), page.has_next()), (False, True))
+
+    def test_tree_order(self):
+        """
+        Ties are broken by event id, even where that isn't the tree order (a
+        child event created after a later root).
+        """
+        child = ExampleEvent.eventobjects.create(parent=self.tour, title="Tour (for kids)", slug="tour-kids")
+        for day in range(25):
+            child.occurrences.create(start=datetime(2010, 1, 1, 10, 0) + timedelta(day))
+        ordered = list(self.pool.order_by(*KEYSET_ORDERING))
+        self.ae([o.event_id for o in ordered[:3]], [self.tour.pk, self.talk.pk, child.pk])
+
+        seen = []
+        page = self._page()
+        seen.extend(page.object_list)
+        while page.has_next():
+            page = self._page(after=page.next_cursor())
+            seen.extend(page.object_list)
+        self.ae(seen, ordered)
+
+        seen = list(page.object_list)
+        while page.has_previous():
+            page = self._page(before=page.previous_cursor())
+            seen[:0] = page.object_list
+        self.ae(seen, ordered)
+
+    def test_cursors(self):
+        page = self._page()
+        self.ae(parse_cursor(page.next_cursor()), (self.ordered[19].start, self.ordered[19].event_id, self.ordered[19].pk))
+        self.ae(parse_cursor('rubbish'), None)
+        # a bad cursor gives the first page; one past the end gives the last.
+        self.ae(self._page(after='rubbish').object_list, self.ordered[:20])
+        last = self.ordered[-1]
+        page = self._page(after="20200101T000000-%s-%s" % (last.event_id, last.pk))
+        self.ae(page.object_list, self.ordered[-20:])
+        self.ae((page.has_previous(), page.has_next()), (True, False))
+
+
+class TestVirtualOccurrences(AppTestCase):
+    """
+    With a MATERIALISATION_WINDOW, the views, feeds and event methods include
+    the virtual occurrences after it.
+    """
+
+    def setUp(self):
+        super(TestVirtualOccurrences, self).setUp()
+        self._old_settings = (
+            getattr(django_settings, 'MATERIALISATION_WINDOW', None),
+            getattr(django_settings, 'OCCURRENCES_PER_PAGE', 20),
+        )
+        django_settings.MATERIALISATION_WINDOW = timedelta(10)
+        django_settings.OCCURRENCES_PER_PAGE = 5
+        self.factory = RequestFactory()
+        self.today = date.today()
+        self.tour = ExampleEvent.eventobjects.create(title="Tour", slug="tour")
+        self.tour.generators.create(start=self._day(0), _duration=60,
+            rule=Rule.objects.create(frequency="DAILY"))
+        self.views = EventViews(ExampleEvent.eventobjects.all())
+
+    def tearDown(self):
+        django_settings.MATERIALISATION_WINDOW, \
+            django_settings.OCCURRENCES_PER_PAGE = self._old_settings
+        super(TestVirtualOccurrences, self).tearDown()
+
+    def _day(self, n):
+        return datetime.combine(self.today + timedelta(n), time(9, 0))
+
+    def _page(self, **GET):
+        request = self.factory.get('/', GET)
+        return self.views._occurrence_list_context(request,
+            self.views.occurrence_qs)['pageinfo']
+
+    def test_occurrence_list(self):
+        self.ae(self.tour.occurrences.count(), 11)
+
+        page = self._page()
+        self.ae([o.start for o in page], [self._day(n) for n in range(5)])
+        pages = [page]
+        while len(pages) < 4:
+            pages.append(self._page(after=pages[-1].next_cursor()))
+        self.ae([o.start for o in pages[2]], [self._day(n) for n in range(10, 15)])
+        self.ae([o.is_virtual() for o in pages[2]], [False] + [True] * 4)
+        self.ae([o.start for o in pages[3]], [self._day(n) for n in range(15, 20)])
+        self.ae(pages[3].object_list[0].get_absolute_url(), self.tour.get_absolute_url())
+
+        # and back again, from a virtual cursor
+        page = self._page(before=pages[3].previous_cursor())
+        self.ae([o.start for o in page], [o.start for o in pages[2]])
+        page = self._page(before=page.previous_cursor())
+        self.ae([o.start for o in page], [o.start for o in pages[1]])
+
+        # far-future occurrences are listed too
+        far = self.today + timedelta(100)
+        page = self._page(startdate=far.isoformat())
+        self.ae(page.object_list[0].start, self._day(100))
+
+        feed = self.views.occurrence_list_ical(
+            self.factory.get('/events/ical.ics', {'startdate': far.isoformat()}))
+        self.assertTrue("UID:occurrence-%s-%s@testserver" % (self.tour.pk,
+            self._day(100).strftime("%Y%m%dT%H%M%S")) in "".join(feed))
+
+    def test_event(self):
+        last = datetime.combine(self.today + settings.DEFAULT_GENERATOR_LIMIT, time(9, 0))
+        tour = ExampleEvent.eventobjects.get(pk=self.tour.pk)
+
+        occurrences = self.views._event_occurrences(tour)
+        self.ae(occurrences[-1].start, last)
+        self.assertTrue(self.today + timedelta(100) in
+            calendar_tags._occurrence_days(tour.occurrences_in_listing()))
+
+        self.ae(tour.opening_occurrence().start, self._day(0))
+        self.ae(tour.closing_occurrence().start, last)
+        self.assertTrue(tour.closing_occurrence().is_virtual())
+        tour = ExampleEvent.eventobjects.filter(pk=tour.pk)\
+            .with_opening_occurrence().with_closing_occurrence()[0]
+        self.ae(tour.opening_occurrence().start, self._day(0))
+        self.ae(tour.closing_occurrence().start, last)
+
+        summary = tour.status_summary()
+        self.ae(summary.count, len(occurrences))
+        self.ae(summary.last_end, last + timedelta(hours=1))
+        self.assertFalse(tour.is_finished())
+        self.assertTrue(tour.is_available())
+
+
+class TestCalendarTag(AppTestCase):
+
+    def setUp(self):
+        super(TestCalendarTag, self).setUp()
+        self.reversed = []
+        def fake_reverse(name, args):
+            self.reversed.append(args)
+            return "/%s/%s/%s/" % args
+        self._reverse = calendar_tags.reverse
+        calendar_tags.reverse = fake_reverse
+        calendar_tags._on_date_urls.clear()
+
+    def tearDown(self):
+        calendar_tags.reverse = self._reverse
+        calendar_tags._on_date_urls.clear()
+        super(TestCalendarTag, self).tearDown()
+
+    def test_month_grid(self):
+        """
+        Month grids are cached, and on_date urls are reversed once per day,
+        however many times the calendar is rendered.
+        """
+        grid = calendar_tags.month_grid(2011, 3, 0)
+        self.assertTrue(calendar_tags.month_grid(2011, 3, 0) is grid)
+        self.ae(grid[0][0], (date(2011, 2, 28), frozenset(['monday', 'last_month']), '2011-02-28'))
+        self.ae(grid[-1][-1], (date(2011, 4, 3), frozenset(['sunday', 'next_month']), '2011-04-03'))
+
+        dates = set([date(2011, 3, 2), date(2011, 3, 9)])
+        for i in range(2):
+            context = calendar_tags.nav_calendar({}, date=date(2011, 3, 9), occurrence_qs=[])
+            context = calendar_tags.calendar({}, day=date(2011, 3, 9),
+                date_href_fn=calendar_tags.DATE_HREF_FACTORY(dates=dates),
+                date_class_fn=calendar_tags.DATE_CLASS_HIGHLIGHT_FACTORY(dates, date(2011, 3, 9)),
+            )
+        # the two neighbouring months and two days, once each
+        self.ae(len(self.reversed), 4)
+
+        days = dict((d.date, d) for week in context['weeks'] for d in week)
+        self.ae(days[date(2011, 3, 9)].href, "/2011/3/9/")
+        self.ae(days[date(2011, 3, 10)].href, None)
+        self.assertTrue(set(['highlight', 'selected', 'wednesday']) <= days[date(2011, 3, 9)].classes)
+        self.assertFalse('highlight' in days[date(2011, 3, 10)].classes)
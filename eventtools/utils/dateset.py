@@ -0,0 +1,90 @@
+"""
+A compact set of dates, stored as a bitmap of days per month, for asking
+"is anything on on this day?" many times over (eg in calendars).
+"""
+import datetime
+
+
+class DateSet(object):
+    """
+    A set of dates. Each month with any dates in it is an int, with bit n-1
+    set if day n is in the set, so membership is a dict lookup and a bit test.
+
+    >>> ds = DateSet([datetime.date(2011, 1, 31), datetime.date(2011, 1, 1)])
+    >>> datetime.date(2011, 1, 31) in ds
+    True
+    >>> datetime.date(2011, 1, 30) in ds
+    False
+    >>> list(ds)
+    [datetime.date(2011, 1, 1), datetime.date(2011, 1, 31)]
+    """
+
+    def __init__(self, dates=()):
+        self._months = {}
+        for d in dates:
+            self.add(d)
+
+    @classmethod
+    def from_occurrences(cls, occurrences):
+        """
+        The set of days that occurrences start on. If occurrences is a
+        queryset, this takes one query (for the distinct days), rather than
+        fetching every occurrence.
+        """
+        if hasattr(occurrences, 'dates'):
+            occurrences = occurrences.order_by()
+            return cls(occurrences.dates('start', 'day'))
+        return cls(o.start for o in occurrences or ())
+
+    def add(self, d):
+        key = (d.year, d.month)
+        self._months[key] = self._months.get(key, 0) | (1 << (d.day - 1))
+
+    def __contains__(self, d):
+        try:
+            return bool(self._months.get((d.year, d.month), 0) & (1 << (d.day - 1)))
+        except AttributeError: # not a date
+            return False
+
+    def month(self, year, month):
+        """
+        Returns the bitmap for a month (0 if there are no dates in it).
+        """
+        return self._months.get((year, month), 0)
+
+    def months(self):
+        """
+        Returns the sorted (year, month)s that have dates in them.
+        """
+        return sorted(self._months)
+
+    def __iter__(self):
+        for year, month in self.months():
+            bits = self._months[(year, month)]
+            day = 1
+            while bits:
+                if bits & 1:
+                    yield datetime.date(year, month, day)
+                bits >>= 1
+                day += 1
+
+    def __len__(self):
+        return sum(bin(bits).count('1') for bits in self._months.values())
+
+    def __nonzero__(self):
+        return bool(self._months)
+
+    def first(self):
+        """
+        The earliest date in the set, or None if it's empty.
+        """
+        for d in self:
+            return d
+        return None
+
+    def last(self):
+        if not self._months:
+            return None
+        year, month = max(self._months)
+        bits = self._months[(year, month)]
+        return datetime.date(year, month, bits.bit_length())
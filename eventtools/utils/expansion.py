@@ -0,0 +1,157 @@
+"""
+Expands a repetition rule into all of its datetimes up to a given datetime.
+
+Generators with long horizons (eg hourly slots over a couple of years) spend
+most of their time stepping through dateutil rrules one datetime at a time.
+If NumPy is installed, the common rules - DAILY, WEEKLY and MONTHLY, with
+interval, count, bymonth, bymonthday, byweekday, byhour, byminute and
+bysecond - are expanded in one go as a datetime64 array. Everything else
+(complex rules, other params, timezone-aware starts) uses dateutil.
+
+The results are the same as iterating rule.get_rrule(dtstart) up to `until`.
+"""
+import calendar
+from itertools import dropwhile, takewhile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from dateutil import rrule
+
+VECTORISED_FREQUENCIES = (rrule.DAILY, rrule.WEEKLY, rrule.MONTHLY)
+
+# the params we can expand, and the range of values they can take.
+VECTORISED_PARAMS = {
+    'interval': (1, None),
+    'count': (1, None),
+    'bymonth': (1, 12),
+    'bymonthday': (-31, 31),
+    'byweekday': (0, 6),
+    'byhour': (0, 23),
+    'byminute': (0, 59),
+    'bysecond': (0, 59),
+}
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+def can_vectorise(compiled_rule, dtstart):
+    """
+    True if compiled_rule can be expanded from dtstart with NumPy.
+    """
+    if numpy is None:
+        return False
+    if compiled_rule.template is not None:
+        return False
+    if compiled_rule.frequency not in VECTORISED_FREQUENCIES:
+        return False
+    if dtstart.tzinfo is not None:
+        return False
+    for param, value in compiled_rule.params.items():
+        try:
+            low, high = VECTORISED_PARAMS[param]
+        except KeyError:
+            return False
+        values = _as_list(value)
+        if param in ('interval', 'count') and len(values) != 1:
+            return False
+        for v in values:
+            if v < low or (high is not None and v > high) or \
+                (param == 'bymonthday' and v == 0):
+                return False
+    return True
+
+def expand_array(compiled_rule, dtstart, until, after=None):
+    """
+    Returns a datetime64 array of the datetimes of compiled_rule from dtstart
+    up to until (and, if given, later than after, without expanding the days
+    before it). Only call this if can_vectorise() is True.
+    """
+    params = compiled_rule.params
+    frequency = compiled_rule.frequency
+    # like dateutil, ignore microseconds.
+    dtstart = dtstart.replace(microsecond=0)
+
+    interval = params.get('interval', 1)
+    bymonth = _as_list(params.get('bymonth'))
+    bymonthday = _as_list(params.get('bymonthday'))
+    byweekday = _as_list(params.get('byweekday'))
+    # the defaults dateutil uses when no days are given.
+    if not (bymonthday or byweekday):
+        if frequency == rrule.MONTHLY:
+            bymonthday = [dtstart.day]
+        elif frequency == rrule.WEEKLY:
+            byweekday = [dtstart.weekday()]
+
+    first_day = numpy.datetime64(dtstart.date(), 'D')
+    last_day = numpy.datetime64(until.date(), 'D')
+    from_day = first_day
+    # with a count, the datetimes before after have to be counted too.
+    if after is not None and 'count' not in params:
+        from_day = max(first_day, numpy.datetime64(after.date(), 'D'))
+    if last_day < from_day:
+        return numpy.array([], dtype='M8[s]')
+    days = numpy.arange(from_day, last_day + 1)
+
+    # which days are in the periods that the interval picks
+    if frequency == rrule.DAILY:
+        periods = (days - first_day).astype('int64')
+    elif frequency == rrule.WEEKLY:
+        first_week = first_day - \
+            (dtstart.weekday() - calendar.firstweekday()) % 7
+        periods = (days - first_week).astype('int64') // 7
+    else:
+        months = days.astype('M8[M]')
+        periods = (months - first_day.astype('M8[M]')).astype('int64')
+    keep = periods % interval == 0
+
+    if bymonth or bymonthday:
+        months = days.astype('M8[M]')
+    if bymonth:
+        keep &= numpy.isin(months.astype('int64') % 12 + 1, bymonth)
+    if bymonthday:
+        month_starts = months.astype('M8[D]')
+        day_of_month = (days - month_starts).astype('int64') + 1
+        days_in_month = ((months + 1).astype('M8[D]') - month_starts)\
+            .astype('int64')
+        keep &= numpy.isin(day_of_month, bymonthday) | \
+            numpy.isin(day_of_month - days_in_month - 1, bymonthday)
+    if byweekday:
+        # 1 Jan 1970 was a Thursday
+        keep &= numpy.isin((days.astype('int64') + 3) % 7, byweekday)
+
+    hours = sorted(set(_as_list(params.get('byhour')) or [dtstart.hour]))
+    minutes = sorted(set(_as_list(params.get('byminute')) or [dtstart.minute]))
+    seconds = sorted(set(_as_list(params.get('bysecond')) or [dtstart.second]))
+    times = numpy.array([h * 3600 + m * 60 + s
+        for h in hours for m in minutes for s in seconds], dtype='m8[s]')
+
+    result = (days[keep].astype('M8[s]')[:, None] + times[None, :]).ravel()
+    result = result[
+        (result >= numpy.datetime64(dtstart, 's')) &
+        (result <= numpy.datetime64(until, 's'))
+    ]
+    if 'count' in params:
+        result = result[:params['count']]
+    if after is not None:
+        result = result[result > numpy.datetime64(after, 'us')]
+    return result
+
+def expand(compiled_rule, dtstart, until, after=None):
+    """
+    Returns a list of the datetimes of compiled_rule from dtstart up to (and
+    including) until - and, if after is given, later than it.
+    """
+    if can_vectorise(compiled_rule, dtstart):
+        return expand_array(compiled_rule, dtstart, until, after)\
+            .astype('M8[us]').tolist()
+    dates = takewhile(lambda d: d <= until, compiled_rule.get_rrule(dtstart))
+    if after is not None:
+        dates = dropwhile(lambda d: d <= after, dates)
+    return list(dates)
@@ -0,0 +1,180 @@
+"""
+Writes occurrences as an RFC 5545 iCalendar stream, a chunk at a time, so
+that large feeds don't have to be built in memory first.
+
+Each occurrence becomes a VEVENT. These (optional) attributes of the
+occurrence are used, if present (they may be methods):
+
+    * ical_summary - defaults to unicode(occurrence.event)
+    * ical_description
+    * venue_description - the LOCATION
+    * latitude and longitude - the GEO
+"""
+from datetime import datetime, timedelta
+
+from dateutil.tz import gettz, tzutc
+
+from django.conf import settings as django_settings
+
+from eventtools.conf import settings
+
+# occurrences written per chunk of the stream
+ICAL_CHUNK_SIZE = 500
+
+# lines longer than this many octets are folded
+MAX_LINE_OCTETS = 75
+
+UTC = tzutc()
+
+
+def escape_text(value):
+    """
+    Escapes a TEXT property value.
+
+    >>> print escape_text(u"Talks; tours, and\\nfilms")
+    Talks\\; tours\\, and\\nfilms
+    """
+    return unicode(value)\
+        .replace(u"\\", u"\\\\")\
+        .replace(u";", u"\\;")\
+        .replace(u",", u"\\,")\
+        .replace(u"\r\n", u"\\n")\
+        .replace(u"\n", u"\\n")
+
+def fold(line):
+    """
+    Returns line as UTF-8, with a CRLF, folded so that no line is more than
+    75 octets long (without splitting a multi-byte character).
+    """
+    encoded = line.encode('utf-8')
+    parts = []
+    limit = MAX_LINE_OCTETS
+    while len(encoded) > limit:
+        cut = limit
+        # UTF-8 continuation bytes look like 10xxxxxx
+        while cut > 0 and ord(encoded[cut]) & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut])
+        encoded = encoded[cut:]
+        limit = MAX_LINE_OCTETS - 1 # folded lines start with a space
+    parts.append(encoded)
+    return "\r\n ".join(parts) + "\r\n"
+
+def format_datetime(dt, tz=None):
+    """
+    Formats dt in UTC. Naive datetimes are taken to be in tz (if given).
+    """
+    if dt.tzinfo is None:
+        if tz is None:
+            return dt.strftime("%Y%m%dT%H%M%S")
+        dt = dt.replace(tzinfo=tz)
+    return dt.astimezone(UTC).strftime("%Y%m%dT%H%M%SZ")
+
+def _resolve_attr(obj, attr):
+    v = getattr(obj, attr, None)
+    if callable(v):
+        v = v()
+    return v
+
+
+class ICalWriter(object):
+    """
+    Writes occurrences as VEVENTs. Subclass and override vevent_lines() to
+    change what is written for each occurrence.
+    """
+
+    def __init__(self, request, calname=None, caldesc=None):
+        self.request = request
+        self.calname = calname or settings.ICAL_CALNAME
+        self.caldesc = caldesc or settings.ICAL_CALDESC
+        self.host = request.get_host()
+        self.domain = "http%s://%s" % (
+            's' if request.is_secure() else '', self.host)
+        time_zone = getattr(django_settings, 'TIME_ZONE', None)
+        self.tz = gettz(time_zone) if time_zone else None
+        self.dtstamp = format_datetime(datetime.utcnow().replace(tzinfo=UTC))
+
+    def calendar_header(self):
+        return [
+            u"BEGIN:VCALENDAR",
+            u"VERSION:2.0",
+            u"PRODID:-//glamkit//eventtools//EN",
+            u"CALSCALE:GREGORIAN",
+            u"METHOD:PUBLISH", # IE/Outlook needs this
+            u"X-WR-CALNAME:%s" % escape_text(self.calname),
+            u"X-WR-CALDESC:%s" % escape_text(self.caldesc),
+        ]
+
+    def calendar_footer(self):
+        return [u"END:VCALENDAR"]
+
+    def uid(self, occurrence):
+        if occurrence.pk is None: # virtual
+            return u"occurrence-%s-%s" % (occurrence.event_id,
+                occurrence.start.strftime("%Y%m%dT%H%M%S"))
+        return u"occurrence-%s" % occurrence.pk
+
+    def vevent_lines(self, occurrence):
+        lines = [
+            u"BEGIN:VEVENT",
+            u"UID:%s@%s" % (self.uid(occurrence), self.host),
+            u"DTSTAMP:%s" % self.dtstamp,
+        ]
+
+        if occurrence.all_day():
+            start = occurrence.start.date()
+            # DTEND is exclusive
+            end = max(occurrence.end().date(), start + timedelta(1))
+            lines += [
+                u"DTSTART;VALUE=DATE:%s" % start.strftime("%Y%m%d"),
+                u"DTEND;VALUE=DATE:%s" % end.strftime("%Y%m%d"),
+            ]
+        else:
+            lines += [
+                u"DTSTART:%s" % format_datetime(occurrence.start, self.tz),
+                u"DTEND:%s" % format_datetime(occurrence.end(), self.tz),
+            ]
+
+        summary = _resolve_attr(occurrence, 'ical_summary') or occurrence.event
+        lines.append(u"SUMMARY:%s" % escape_text(summary))
+
+        description = _resolve_attr(occurrence, 'ical_description')
+        if description:
+            lines.append(u"DESCRIPTION:%s" % escape_text(description))
+
+        url = _resolve_attr(occurrence, 'get_absolute_url')
+        if url:
+            lines.append(u"URL:%s%s" % (self.domain, url))
+
+        location = _resolve_attr(occurrence, 'venue_description')
+        if location:
+            lines.append(u"LOCATION:%s" % escape_text(location))
+
+        lat = _resolve_attr(occurrence, 'latitude')
+        lon = _resolve_attr(occurrence, 'longitude')
+        if lat and lon:
+            lines.append(u"GEO:%s;%s" % (lat, lon))
+
+        if occurrence.is_cancelled():
+            lines.append(u"STATUS:CANCELLED")
+
+        lines.append(u"END:VEVENT")
+        return lines
+
+    def stream(self, occurrences, chunk_size=ICAL_CHUNK_SIZE):
+        """
+        Yields the calendar as UTF-8 strings, one per chunk_size occurrences.
+        occurrences can be a queryset (which is iterated without caching its
+        results) or any other iterable.
+        """
+        if hasattr(occurrences, 'iterator'):
+            occurrences = occurrences.select_related('event').iterator()
+        yield "".join(fold(line) for line in self.calendar_header())
+        chunk = []
+        for i, occurrence in enumerate(occurrences):
+            chunk.extend(fold(line) for line in self.vevent_lines(occurrence))
+            if (i + 1) % chunk_size == 0:
+                yield "".join(chunk)
+                chunk = []
+        chunk.extend(fold(line) for line in self.calendar_footer())
+        yield "".join(chunk)
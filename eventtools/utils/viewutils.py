@@ -1,9 +1,17 @@
-from django.core.paginator import Paginator, EmptyPage, InvalidPage
-from django.http import HttpResponse
+from django.core.paginator import Paginator, Page, EmptyPage, InvalidPage
+try:
+    from django.http import StreamingHttpResponse
+except ImportError: # Django < 1.5 streams iterators given to HttpResponse
+    from django.http import HttpResponse as StreamingHttpResponse
+from django.db.backends.util import typecast_timestamp
+from django.db.models import Count, Max, Q
+from django.http import QueryDict
 from eventtools.conf import settings
-from datetime import date
+from datetime import date, datetime, time
 from dateutil import parser as dateparser
-from vobject import iCalendar
+from hashlib import md5
+
+from eventtools.utils.ical import ICalWriter
 
 
 def paginate(request, pool):
@@ -23,6 +31,221 @@ def paginate(request, pool):
 
     return pageinfo
 
+# Keyset pagination, for occurrence lists too long to count or OFFSET
+# through. Pages follow (or precede) a cursor, which is the
+# (start, event_id, pk) of the occurrence they're next to. Virtual
+# occurrences (see OccurrenceQuerySet.with_virtual()) have no pk, and come
+# after the saved ones with the same start, in event id order.
+
+# (by the event's id, which the cursor has, rather than the event ordering,
+# which is the tree's)
+KEYSET_ORDERING = ('start', 'event__id', 'pk')
+CURSOR_FORMAT = "%Y%m%dT%H%M%S"
+
+def make_cursor(occurrence):
+    return "%s-%s-%s" % (occurrence.start.strftime(CURSOR_FORMAT),
+        occurrence.event_id, occurrence.pk or '')
+
+def parse_cursor(cursor):
+    """
+    Returns (start, event_id, pk) from a cursor, or None if it's not valid.
+    pk is None for a virtual occurrence.
+    """
+    try:
+        start, event_id, pk = cursor.split('-')
+        return datetime.strptime(start, CURSOR_FORMAT), int(event_id), \
+            int(pk) if pk else None
+    except (AttributeError, ValueError):
+        return None
+
+def _after(key):
+    start, event_id, pk = key
+    if pk is None:
+        return Q(start__gt=start)
+    return Q(start__gt=start) | Q(start=start, event__gt=event_id) | \
+        Q(start=start, event=event_id, pk__gt=pk)
+
+def _before(key):
+    start, event_id, pk = key
+    if pk is None:
+        return Q(start__lte=start)
+    return Q(start__lt=start) | Q(start=start, event__lt=event_id) | \
+        Q(start=start, event=event_id, pk__lt=pk)
+
+def _key(occurrence):
+    return occurrence.start, occurrence.event_id, occurrence.pk
+
+def _sort_key(key):
+    start, event_id, pk = key
+    if pk is None:
+        return start, 1, event_id
+    return start, 0, event_id, pk
+
+def _filter_after(pool, key):
+    if getattr(pool, '_with_virtual', False):
+        return pool._virtual_aware().filter(_after(key))._filter_virtual(
+            lambda o: _sort_key(_key(o)) > _sort_key(key))
+    return pool.filter(_after(key))
+
+def _filter_before(pool, key):
+    if getattr(pool, '_with_virtual', False):
+        return pool._virtual_aware().filter(_before(key))._filter_virtual(
+            lambda o: _sort_key(_key(o)) < _sort_key(key))
+    return pool.filter(_before(key))
+
+
+class KeysetPage(object):
+    """
+    A page of occurrences, with links to the pages either side of it, but no
+    page numbers or counts (use paginate() if you need those).
+    """
+    def __init__(self, object_list, has_previous, has_next, GET=None):
+        self.object_list = object_list
+        self._has_previous = has_previous
+        self._has_next = has_next
+        self.GET = GET
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_other_pages(self):
+        return self._has_previous or self._has_next
+
+    def previous_cursor(self):
+        if self._has_previous:
+            return make_cursor(self.object_list[0])
+
+    def next_cursor(self):
+        if self._has_next:
+            return make_cursor(self.object_list[-1])
+
+    def _query(self, param, cursor):
+        GET = self.GET.copy() if self.GET is not None else QueryDict('', mutable=True)
+        for p in ('after', 'before', 'page'):
+            if p in GET:
+                del GET[p]
+        GET[param] = cursor
+        return GET.urlencode()
+
+    def previous_query(self):
+        """
+        The query string for the previous page (keeping other GET params).
+        """
+        if self._has_previous:
+            return self._query('before', self.previous_cursor())
+
+    def next_query(self):
+        if self._has_next:
+            return self._query('after', self.next_cursor())
+
+def keyset_paginate(request, pool, per_page=None):
+    """
+    Returns the KeysetPage of pool after the occurrence in the 'after' GET
+    param, or before the one in 'before' (or the first page). This takes two
+    queries, whichever page it is: one for the page and one to see if there
+    are occurrences on the other side of it. If there are no occurrences
+    after the cursor, the last page is returned.
+    """
+    per_page = per_page or settings.OCCURRENCES_PER_PAGE
+    pool = pool.order_by(*KEYSET_ORDERING)
+    after = parse_cursor(request.GET.get('after'))
+    before = parse_cursor(request.GET.get('before'))
+
+    if before is not None:
+        objects = list(_filter_before(pool, before).reverse()[:per_page + 1])
+        has_previous = len(objects) > per_page
+        objects = objects[:per_page][::-1]
+        has_next = bool(objects) and \
+            _filter_after(pool, _key(objects[-1])).exists()
+    else:
+        if after is not None:
+            objects = list(_filter_after(pool, after)[:per_page + 1])
+        else:
+            objects = list(pool[:per_page + 1])
+        has_next = len(objects) > per_page
+        objects = objects[:per_page]
+        if not objects and after is not None:
+            # past the end: show the last page
+            objects = list(pool.reverse()[:per_page])[::-1]
+        has_previous = bool(objects) and (after is not None) and \
+            _filter_before(pool, _key(objects[0])).exists()
+
+    return KeysetPage(objects, has_previous, has_next, request.GET)
+
+class CountedPool(object):
+    """
+    Stands in for an object list that has already been counted, so that a
+    Paginator can be made without the list itself.
+    """
+    def __init__(self, count):
+        self._count = count
+
+    def count(self):
+        return self._count
+
+    def __len__(self):
+        return self._count
+
+def cacheable_page(page):
+    """
+    Returns a copy of page which can be pickled (eg to cache it) without
+    fetching every object in its paginator's object list.
+    """
+    paginator = page.paginator
+    counted = Paginator(CountedPool(paginator.count), paginator.per_page,
+        paginator.orphans, paginator.allow_empty_first_page)
+    return Page(list(page.object_list), page.number, counted)
+
+def _datetime(value):
+    # some backends (sqlite) return aggregates of datetimes as strings
+    if isinstance(value, basestring):
+        return typecast_timestamp(value)
+    return value
+
+def _modified_stats(model):
+    stats = model._default_manager.order_by().aggregate(
+        count=Count('pk'), modified=Max('modified'))
+    return stats['count'], _datetime(stats['modified'])
+
+def etag_for_occurrences(occurrences, *parts):
+    """
+    Returns an ETag for a response showing occurrences (a queryset), using
+    the number of occurrences and when they (and their events) were last
+    modified. parts are anything else the response depends on.
+
+    Virtual occurrences (and occurrences that are yet to be generated) come
+    from the generators and exclusions rather than saved rows, so the ETag
+    changes whenever any generator or exclusion of the event model does.
+
+    There's no Last-Modified to go with it: deleting an occurrence doesn't
+    make the latest modification of the others any later, but it does change
+    the count. Responses may show things that depend on the date (eg
+    forthcoming occurrences), so the ETag changes daily too.
+    """
+    stats = occurrences.order_by().aggregate(
+        count=Count('pk'),
+        modified=Max('modified'),
+        event_modified=Max('event__modified'),
+    )
+    EventModel = occurrences.model.EventModel()
+    return md5(repr((
+        stats['count'],
+        _datetime(stats['modified']),
+        _datetime(stats['event_modified']),
+        _modified_stats(EventModel.GeneratorModel()),
+        _modified_stats(EventModel.ExclusionModel()),
+        date.today(),
+    ) + tuple(parts))).hexdigest()
+
 def parse_GET_date(GET={}):
     mapped_GET = {}
     for k, v in GET.iteritems():
@@ -47,20 +270,15 @@ def parse_GET_date(GET={}):
             
     return fr, to
     
-def response_as_ical(request, occurrences):
-    ical = iCalendar()
-    ical.add('X-WR-CALNAME').value = settings.ICAL_CALNAME
-    ical.add('X-WR-CALDESC').value = settings.ICAL_CALDESC
-    ical.add('method').value = 'PUBLISH'  # IE/Outlook needs this
-
-    if hasattr(occurrences, '__iter__'):
-        for occ in occurrences:
-            ical = occ.as_icalendar(ical, request)
-    else:
-        ical = occurrences.as_icalendar(ical, request)
-    
-    icalstream = ical.serialize()
-    response = HttpResponse(icalstream, mimetype='text/calendar')
-    response['Filename'] = 'events.ics'  # IE needs this
-    response['Content-Disposition'] = 'attachment; filename=events.ics'
+def response_as_ical(request, occurrences, filename='events.ics'):
+    """
+    Returns a response which streams occurrences (a queryset, an iterable or
+    a single occurrence) as an iCalendar file. See eventtools.utils.ical.
+    """
+    if not hasattr(occurrences, '__iter__'):
+        occurrences = [occurrences]
+    stream = ICalWriter(request).stream(occurrences)
+    response = StreamingHttpResponse(stream, content_type='text/calendar; charset=utf-8')
+    response['Filename'] = filename  # IE needs this
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
     return response
@@ -2,27 +2,45 @@ from dateutil.relativedelta import relativedelta
 
 from django.conf.urls.defaults import *
 from django.core.paginator import Paginator, EmptyPage, InvalidPage
+from django.db.models import Max
+from django.http import Http404
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template.context import RequestContext
 from django.utils.safestring import mark_safe
+from django.views.decorators.http import condition
 
+from eventtools.caching import occurrence_cache, queryset_identity
 from eventtools.conf import settings
 from eventtools.utils.pprint_timespan import humanized_date_range
-from eventtools.utils.viewutils import paginate, response_as_ical, parse_GET_date
+from eventtools.utils.viewutils import paginate, keyset_paginate, cacheable_page, \
+    etag_for_occurrences, response_as_ical, parse_GET_date
 
 import datetime
 
 
 class EventViews(object):
 
-    # Have currently disabled icals.
-
     """
     use Event.eventobjects.all() for event_qs.
 
     It will get filtered to .in_listings() where appropriate.
+
+    With a MATERIALISATION_WINDOW, the occurrence lists, feeds and event
+    pages include the virtual occurrences after it, so occurrence_qs should
+    only be filtered in ways that apply to them (see
+    OccurrenceQuerySet.with_virtual()).
+
+    The occurrences shown are cached by occurrence_cache (see
+    eventtools.caching), which you can replace in a subclass.
     """
 
+    occurrence_cache = occurrence_cache
+
+    # occurrence_list pages are found with a (start, event, pk) cursor, using
+    # ?after= and ?before=, rather than counted and numbered. Set this to
+    # False to use ?page= and Django's Paginator.
+    keyset_pagination = True
+
     def __init__(self, event_qs, occurrence_qs=None):
         self.event_qs = event_qs
 
@@ -36,25 +54,95 @@ class EventViews(object):
 
         return (
             patterns('',
-                url(r'^$', self.index, name='index'),
-                url(r'^(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/$', self.on_date, name='on_date'),
-                url(r'^(?P<event_slug>[-\w]+)/$', self.event, name='event'),
-                url(r'^(?P<event_slug>[-\w]+)/(?P<occurrence_pk>[\d]+)/$', self.occurrence, name='occurrence'),
-
-                #ical - needs rethinking
-                # url(r'^ical\.ics$', self.occurrence_list_ical, name='occurrence_list_ical'),
-                # url(r'^(?P<event_slug>[-\w]+)/ical\.ics$', self.event_ical, name='event_ical'),
-                # url(r'^(?P<event_slug>[-\w]+)/(?P<occurrence_id>\d+)/ical\.ics$', \
-                #     self.occurrence_ical, name='occurrence_ical'),
+                url(r'^$', self._conditional(self.index, self.index_validators), name='index'),
+                url(r'^(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/$',
+                    self._conditional(self.on_date, self.on_date_validators), name='on_date'),
+                url(r'^(?P<event_slug>[-\w]+)/$',
+                    self._conditional(self.event, self.event_validators), name='event'),
+                url(r'^(?P<event_slug>[-\w]+)/(?P<occurrence_pk>[\d]+)/$',
+                    self._conditional(self.occurrence, self.occurrence_validators), name='occurrence'),
+
+                url(r'^ical\.ics$',
+                    self._conditional(self.occurrence_list_ical, self.occurrence_list_validators),
+                    name='occurrence_list_ical'),
+                url(r'^(?P<event_slug>[-\w]+)/ical\.ics$',
+                    self._conditional(self.event_ical, self.event_validators), name='event_ical'),
+                url(r'^(?P<event_slug>[-\w]+)/(?P<occurrence_pk>\d+)/ical\.ics$', \
+                    self._conditional(self.occurrence_ical, self.occurrence_validators),
+                    name='occurrence_ical'),
             ),
             "events", # application namespace
             "events", # instance namespace
         )
                     
+    # Conditional GET. Each view has a validators method, which returns an
+    # ETag, cheaply, so that unchanged pages can get a 304 Not Modified
+    # without being rendered.
+
+    def _conditional(self, view, validators):
+        def validate(request, *args, **kwargs):
+            if not hasattr(request, '_eventtools_validators'):
+                request._eventtools_validators = \
+                    validators(request, *args, **kwargs)
+            return request._eventtools_validators
+        return condition(etag_func=validate)(view)
+
+    def _request_parts(self, request):
+        # pages can vary by who's looking, as well as what they ask for.
+        user = getattr(request, 'user', None)
+        return (request.path, request.GET.urlencode(), getattr(user, 'pk', None))
+
+    def occurrence_list_validators(self, request):
+        fr, to, pool = self._occurrence_pool(request, self.occurrence_qs)
+        return etag_for_occurrences(pool, *self._request_parts(request))
+
+    # override this if you override index()
+    index_validators = occurrence_list_validators
+
+    def on_date_validators(self, request, year, month, day):
+        day = datetime.date(int(year), int(month), int(day))
+        return etag_for_occurrences(
+            self.occurrence_qs.with_virtual_in_window().starts_on(day),
+            *self._request_parts(request))
+
+    def _event_validators(self, request, event):
+        return etag_for_occurrences(
+            event.occurrences_in_listing(),
+            event.modified,
+            event.generators.aggregate(Max('modified'))['modified__max'],
+            event.exclusions.aggregate(Max('modified'))['modified__max'],
+            *self._request_parts(request)
+        )
+
+    def event_validators(self, request, event_slug):
+        try:
+            event = self.event_qs.get(slug=event_slug)
+        except self.event_qs.model.DoesNotExist:
+            return None # the view will 404
+        return self._event_validators(request, event)
+
+    def occurrence_validators(self, request, event_slug, occurrence_pk):
+        try:
+            occurrence = self.occurrence_qs.select_related('event')\
+                .get(pk=occurrence_pk)
+        except self.occurrence_qs.model.DoesNotExist:
+            return None # the view will 404
+        return self._event_validators(request, occurrence.event)
+
+    def _cached(self, name, parts, f, event_id=None):
+        return self.occurrence_cache.get_or_set(
+            name, parts, f, self.event_qs.model, event_id=event_id)
+
+    def _event_occurrences(self, event):
+        return self._cached('event', (), lambda: list(
+            event.occurrences_in_listing().select_related('event')
+        ), event_id=event.pk)
+
     def event(self, request, event_slug):
         event = get_object_or_404(self.event_qs, slug=event_slug)
         context = RequestContext(request)
         context['event'] = event
+        context['occurrence_pool'] = self._event_occurrences(event)
 
         return render_to_response('eventtools/event.html', context)
 
@@ -66,33 +154,66 @@ class EventViews(object):
         it would be nice if URLs continued to work.
         """
 
-        occurrence = get_object_or_404(self.occurrence_qs, pk=occurrence_pk)
+        qs = self.occurrence_qs
+        occurrence = self._cached('occurrence',
+            (queryset_identity(qs), occurrence_pk),
+            lambda: list(qs.select_related('event').filter(pk=occurrence_pk)[:1])
+        )
+        if not occurrence:
+            raise Http404
+        occurrence = occurrence[0]
         event = occurrence.event
         context = RequestContext(request)
         context['occurrence'] = occurrence
         context['event'] = event
+        context['occurrence_pool'] = self._event_occurrences(event)
 
         return render_to_response('eventtools/event.html', context)
 
 
-    # def event_ical(self, request, event_slug):
-    #     event_context = self._event_context(request, event_slug)
-    #     return response_as_ical(request, event_context['occurrence_pool'])
+    def event_ical(self, request, event_slug):
+        event = get_object_or_404(self.event_qs, slug=event_slug)
+        return response_as_ical(request, event.occurrences_in_listing())
+
+    def occurrence_ical(self, request, event_slug, occurrence_pk):
+        occurrences = self.occurrence_qs.filter(pk=occurrence_pk)
+        if not occurrences.exists():
+            raise Http404
+        return response_as_ical(request, occurrences)
 
     #occurrence_list
-    def _occurrence_list_context(self, request, qs):
+    def _occurrence_pool(self, request, qs):
         fr, to = parse_GET_date(request.GET)
+        qs = qs.with_virtual_in_window()
 
         if to is None:
             occurrence_pool = qs.after(fr)
         else:
             occurrence_pool = qs.between(fr, to)
+        return fr, to, occurrence_pool
+
+    def _occurrence_list_context(self, request, qs):
+        fr, to, occurrence_pool = self._occurrence_pool(request, qs)
+
+        if self.keyset_pagination:
+            paginate_pool = lambda: keyset_paginate(
+                request, occurrence_pool.select_related('event'))
+            pagination_template = 'eventtools/_keyset_pagination.html'
+        else:
+            paginate_pool = lambda: cacheable_page(
+                paginate(request, occurrence_pool.select_related('event')))
+            pagination_template = 'eventtools/_pagination.html'
 
-        pageinfo = paginate(request, occurrence_pool)
+        pageinfo = self._cached('occurrence_list', (
+                queryset_identity(qs), fr, to, self.keyset_pagination,
+                request.GET.get('page'), request.GET.get('after'),
+                request.GET.get('before'), settings.OCCURRENCES_PER_PAGE,
+            ), paginate_pool)
 
         return {
             'bounded': False,
             'pageinfo': pageinfo,
+            'pagination_template': pagination_template,
             'occurrence_pool': occurrence_pool,
             'occurrence_page': pageinfo.object_list,            
             'day': fr,
@@ -106,15 +227,17 @@ class EventViews(object):
         context.update(self._occurrence_list_context(request, self.occurrence_qs))        
         return render_to_response(template, context)
     
-    # def occurrence_list_ical(self, request):
-    #     occurrence_list_context = self._occurrence_list_context(request, self.occurrence_qs)
-    #     pool = occurrence_list_context['occurrence_pool']
-    #     return response_as_ical(request, pool)
+    def occurrence_list_ical(self, request):
+        fr, to, pool = self._occurrence_pool(request, self.occurrence_qs)
+        return response_as_ical(request, pool)
 
     def on_date(self, request, year, month, day):
         template = 'eventtools/occurrence_list.html'
         day = datetime.date(int(year), int(month), int(day))
-        event_pool = self.occurrence_qs.starts_on(day)
+        qs = self.occurrence_qs
+        event_pool = self._cached('on_date', (queryset_identity(qs), day),
+            lambda: list(qs.with_virtual_in_window().starts_on(day)\
+                .select_related('event')))
 
         context = RequestContext(request)
         context['occurrence_pool'] = event_pool
@@ -21,6 +21,10 @@ setup(
                  'Programming Language :: Python',
                  'Topic :: Utilities'],
     install_requires=['setuptools', 'vobject==0.8.1c', 'python-dateutil==1.5', 'django-mptt'],
+    extras_require={
+        # faster expansion of repetition rules (see eventtools.utils.expansion)
+        'numpy': ['numpy>=1.13,<1.17'], # isin() is 1.13; 1.16 is the last for python 2
+    },
     license='BSD',
     test_suite = "eventtools.tests",
 )